@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from journal import Journal
+from storage import engineFor
+
+
+class AsyncJournal(object):
+    '''asyncio facade over a Journal and its storage engine.
+
+       Every storage call runs on a single dedicated worker thread which owns
+       its own connection, so the event loop is never blocked by disk I/O and
+       sqlite never sees the connection cross threads.'''
+    def __init__(self, journal=None, storage=None):
+        self.journal = journal or Journal()
+        # An engine passed in is kept for every file; otherwise new() and
+        # load() pick the one the file name belongs to.
+        self.fixed = storage is not None
+        self.storage = storage or self.journal.makeStorage()
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='mentarius-storage')
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args, **kwargs))
+
+    def useStorage(self, filename):
+        ''' Switch to the engine for filename. Runs on the storage thread,
+            which the old engine's connection belongs to. '''
+        if not self.fixed:
+            self.storage.close()
+            self.storage = engineFor(filename,
+                                     self.journal.config).fromConfig(self.journal.config)
+
+    def openStorage(self, filename):
+        self.useStorage(filename)
+        self.storage.open(filename)
+
+    async def new(self, filename):
+        await self.run(self.useStorage, filename)
+        await self.run(self.journal.new, filename, self.storage)
+
+    async def load(self, filename):
+        await self.run(self.openStorage, filename)
+        await self.run(self.journal.load, filename, self.storage)
+
+    async def save(self):
+        await self.run(self.journal.save, self.storage)
+
+    async def entries(self, chunksize=500):
+        '''Iterate the entries stored on disk, chunksize rows per hop to the
+           storage thread.'''
+        it = self.storage.iterEntries(self.journal.config['filename'], chunksize)
+        try:
+            while True:
+                chunk = await self.run(list, itertools.islice(it, chunksize))
+                if not chunk:
+                    break
+                for entry in chunk:
+                    yield entry
+        finally:
+            await self.run(it.close)
+
+    async def search(self, text):
+        return await self.run(self.storage.search,
+                              self.journal.config['filename'],
+                              text)
+
+    async def close(self):
+        await self.run(self.storage.close)
+        self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
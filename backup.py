@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import os
+import re
+import sys
+
+import journal  # storage needs journal imported first
+import metrics
+from storage import engineFor
+
+BACKUPS = metrics.counter('backup.completed')
+BACKUP_FAILURES = metrics.counter('backup.failed')
+BACKUP_SECONDS = metrics.histogram('backup.seconds')
+
+STAMP = '%Y%m%d-%H%M%S'
+
+
+def backupDirectory(dbfile, directory=None):
+    return directory or os.path.join(os.path.dirname(os.path.abspath(dbfile)),
+                                     'backups')
+
+
+def backupPath(dbfile, directory=None, when=None):
+    ''' Where a backup of dbfile taken at when goes: the journal's name with
+        a timestamp added, as journal-20200131-091500.mentdb. '''
+    stem, extension = os.path.splitext(os.path.basename(dbfile))
+    when = when or datetime.datetime.now()
+    return os.path.join(backupDirectory(dbfile, directory),
+                        '{0}-{1}{2}'.format(stem, when.strftime(STAMP), extension))
+
+
+def listBackups(dbfile, directory=None):
+    ''' The backups of dbfile in directory, oldest first. '''
+    directory = backupDirectory(dbfile, directory)
+    stem, extension = os.path.splitext(os.path.basename(dbfile))
+    pattern = re.compile(r'{0}-\d{{8}}-\d{{6}}{1}$'.format(re.escape(stem),
+                                                          re.escape(extension)))
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, x) for x in sorted(names) if pattern.match(x)]
+
+
+def rotateBackups(dbfile, directory=None, keep=7):
+    ''' Delete all but the newest keep backups of dbfile, and return the
+        paths deleted. '''
+    old = listBackups(dbfile, directory)[:-keep] if keep else []
+    for path in old:
+        os.remove(path)
+    return old
+
+
+def backup(dbfile, directory=None, keep=7, pages=256, progress=None,
+           storage=None):
+    ''' Back dbfile up into directory while it stays open for editing,
+        check the copy's integrity, then drop all but the newest keep
+        backups. Returns the path of the new backup. progress(remaining,
+        total) is called as pages are copied; raising from it abandons the
+        backup. A copy that fails its check is deleted and IOError raised. '''
+    storage = storage or engineFor(dbfile)()
+    target = backupPath(dbfile, directory)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Only a finished, checked copy gets a name listBackups() picks up.
+    partial = target + '.part'
+
+    try:
+        with BACKUP_SECONDS.time():
+            storage.backup(dbfile, partial, pages, progress)
+            problems = storage.check(partial)
+        if problems:
+            raise IOError('Backup of {0} failed its integrity check: '
+                          '{1}'.format(dbfile, '; '.join(problems[:5])))
+        os.replace(partial, target)
+    except BaseException:
+        BACKUP_FAILURES.inc()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    BACKUPS.inc()
+    rotateBackups(dbfile, directory, keep)
+    return target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Back up a journal while it '
+                                                 'is in use.')
+    parser.add_argument('file', help='journal to back up')
+    parser.add_argument('--dir', help='where backups go (default: a backups '
+                                      'directory next to the journal)')
+    parser.add_argument('--keep', type=int, default=7,
+                        help='number of backups to keep (default: 7)')
+    parser.add_argument('--pages', type=int, default=256,
+                        help='database pages copied per step')
+    args = parser.parse_args()
+
+    path = backup(args.file, args.dir, args.keep, args.pages)
+    print('Backed up to {0}.'.format(path), file=sys.stderr)
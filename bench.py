@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from htmlutils import QT_HEADS, QT_TAIL
+from journal import Entry, Journal
+from memorystorage import MemoryStorage
+from storage import ENGINES, Sqlite3Storage, getEngine
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+QT_HEAD = (QT_HEADS[0] + '<body style=" font-family:\'Sans Serif\'; '
+           'font-size:9pt; font-weight:400; font-style:normal;">\n')
+QT_PARAGRAPH = ('<p style=" margin-top:0px; margin-bottom:0px; '
+                'margin-left:0px; margin-right:0px; -qt-block-indent:0; '
+                'text-indent:0px;">{0}</p>')
+QT_EMPTY = ('<p style="-qt-paragraph-type:empty; margin-top:0px; '
+            'margin-bottom:0px; margin-left:0px; margin-right:0px; '
+            '-qt-block-indent:0; text-indent:0px;"><br /></p>')
+QT_BULLET = ('<li style=" margin-top:0px; margin-bottom:0px; '
+             'margin-left:0px; margin-right:0px; -qt-block-indent:0; '
+             'text-indent:0px;">{0}</li>')
+
+WORDS = ('the of and to in is was it for on with he as you at be this had '
+         'by not but from or have an they which one were her all she there '
+         'would their we him been has when who will more no if out so said '
+         'what up its about into than them can only other new some could '
+         'time these two may then do first any my now such like our over '
+         'man me even most made after also did many before must through '
+         'back years where much your way well down should because each just '
+         'those people how too little state good very make world still own '
+         'see men work long get here between both life being under never '
+         'day same another know while last might us great old year off come '
+         'since against go came right used take three morning coffee walked '
+         'garden letter train rain evening dinner friend mother wrote read '
+         'book city river quiet tired happy worried remember tomorrow').split()
+
+
+def sentence(rnd):
+    words = [rnd.choice(WORDS) for i in range(rnd.randint(5, 18))]
+    if rnd.random() < 0.15:
+        i = rnd.randrange(len(words))
+        words[i] = '<span style=" font-weight:600;">{0}</span>'.format(words[i])
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + '.'
+
+
+def body(rnd):
+    '''Build an entry body shaped like QTextEdit.toHtml() output.'''
+    blocks = list()
+    for i in range(rnd.choice((1, 2, 3, 3, 4, 6, 10))):
+        if blocks and rnd.random() < 0.3:
+            blocks.append(QT_EMPTY)
+        if rnd.random() < 0.1:
+            items = ''.join(QT_BULLET.format(sentence(rnd))
+                            for j in range(rnd.randint(2, 5)))
+            blocks.append('<ul style="margin-top: 0px; margin-bottom: 0px; '
+                          'margin-left: 0px; margin-right: 0px; '
+                          '-qt-list-indent: 1;">' + items + '</ul>')
+        else:
+            text = ' '.join(sentence(rnd) for j in range(rnd.randint(1, 6)))
+            blocks.append(QT_PARAGRAPH.format(text))
+    return QT_HEAD + '\n'.join(blocks) + QT_TAIL
+
+
+def generate(filename, count, seed=0):
+    '''Write a journal of count entries to filename, deterministic in seed.'''
+    rnd = random.Random(seed)
+    storage = Sqlite3Storage()
+    storage.new(filename)
+
+    def rows():
+        day = datetime.date(2020, 12, 31)
+        for i in range(count):
+            if rnd.random() < 0.6:
+                day -= datetime.timedelta(days=rnd.choice((1, 1, 1, 2, 3)))
+            created = datetime.datetime.combine(day, datetime.time(rnd.randint(6, 23),
+                                                                   rnd.randint(0, 59)))
+            modified = created + datetime.timedelta(minutes=rnd.randint(0, 600))
+            title = ' '.join(rnd.choice(WORDS) for j in range(rnd.randint(1, 6))).capitalize()
+            yield storage.entryRow(Entry(created, modified, day, None, title, body(rnd)))
+
+    storage.bulkInsert(filename, rows(), 10000)
+
+
+def journalCopy(filename, directory, name, engine):
+    '''Copy the generated journal filename into a journal stored with engine,
+       and return where it went.'''
+    cls = getEngine(engine)
+    if cls.prefixes:
+        target = cls.prefixes[0] + os.path.join(directory, name)
+    else:
+        target = os.path.join(directory, name + cls.extensions[0])
+
+    if engine == 'sqlite3':
+        shutil.copyfile(filename, target)
+    else:
+        storage = cls()
+        storage.new(target)
+        storage.save(target, Sqlite3Storage().load(filename), [])
+    return target
+
+
+def dropCopy(target):
+    if target.startswith(MemoryStorage.prefixes):
+        MemoryStorage().drop(target)
+
+
+def timed(func, repeat):
+    runs = list()
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+
+def filterDate(entries, text):
+    '''What EntryFilterProxy does for every row when the calendar moves.'''
+    return [x for x in entries if text in x.date_published.strftime('%Y-%m-%d')]
+
+
+def searchMemory(entries, text):
+    return [x for x in entries if text in x.title.lower() or text in x.body.lower()]
+
+
+def run(filename, repeat, seed=0, engine='sqlite3'):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = journalCopy(filename, tmp, 'journal', engine)
+        try:
+            return runOn(source, tmp, filename, repeat, seed, engine)
+        finally:
+            dropCopy(source)
+
+
+def runOn(source, tmp, filename, repeat, seed, engine):
+    results = dict()
+    rnd = random.Random(seed)
+    storage = getEngine(engine)
+
+    results['storage.load'] = timed(lambda: storage().load(source), repeat)
+
+    journal = Journal()
+    journal.load(source)
+    entries = journal.entries
+    dates = sorted(set(x.date_published for x in entries))
+    probes = [rnd.choice(dates) for i in range(100)]
+    words = [rnd.choice(WORDS) + ' ' + rnd.choice(WORDS) for i in range(5)]
+
+    results['journal.publishedDateList'] = timed(
+        lambda: [journal.publishedDateList(d.month, d.year) for d in probes[:12]],
+        repeat)
+    results['journal.nextDate'] = timed(
+        lambda: [journal.nextDate(d) for d in probes], repeat)
+    results['journal.previousDate'] = timed(
+        lambda: [journal.previousDate(d) for d in probes], repeat)
+    results['filter.date'] = timed(
+        lambda: [filterDate(entries, d.isoformat()) for d in probes[:10]], repeat)
+    results['search.memory'] = timed(
+        lambda: [searchMemory(entries, w) for w in words], repeat)
+    results['search.storage'] = timed(
+        lambda: [storage().search(source, w) for w in words], repeat)
+
+    def save():
+        copy = journalCopy(filename, tmp, 'save', engine)
+        try:
+            j = Journal()
+            j.load(copy)
+            for entry in rnd.sample(j.entries, max(1, len(j.entries) // 100)):
+                j.updateEntry(entry, title=entry.title + ' (edited)')
+            start = time.perf_counter()
+            j.save()
+            return time.perf_counter() - start
+        finally:
+            dropCopy(copy)
+    runs = [save() for i in range(repeat)]
+    results['storage.save'] = {'min': min(runs),
+                               'median': statistics.median(runs),
+                               'runs': runs}
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Print the change against a baseline report and return the names of the
+       benchmarks whose median slowed down by more than tolerance.'''
+    regressions = list()
+    for size, benches in sorted(results['results'].items()):
+        for name, result in sorted(benches.items()):
+            try:
+                old = baseline['results'][size][name]['median']
+            except KeyError:
+                continue
+            change = (result['median'] - old) / old if old else 0.0
+            flag = ''
+            if change > tolerance:
+                flag = '  REGRESSION'
+                regressions.append('{0}/{1}'.format(size, name))
+            print('{0:>5} {1:<28} {2:10.4f}s {3:+8.1%}{4}'.format(size,
+                                                                name,
+                                                                result['median'],
+                                                                change,
+                                                                flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark journal operations.')
+    parser.add_argument('--sizes', default='1k',
+                        help='comma separated sizes out of: ' + ', '.join(SIZES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data', default='bench_data',
+                        help='directory to keep generated journals in')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='sqlite3',
+                        help='storage engine to run against; memory leaves '
+                             'out disk I/O')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='report from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown before a result counts as a '
+                             'regression (default: 0.25)')
+    args = parser.parse_args()
+
+    os.makedirs(args.data, exist_ok=True)
+    report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'sqlite': sqlite3.sqlite_version,
+                       'seed': args.seed,
+                       'repeat': args.repeat,
+                       'engine': args.engine},
+              'results': dict()}
+
+    for size in args.sizes.split(','):
+        filename = os.path.join(args.data,
+                                'journal-{0}-{1}.mentdb'.format(size, args.seed))
+        if not os.path.exists(filename):
+            print('Generating {0}...'.format(filename), file=sys.stderr)
+            generate(filename, SIZES[size], args.seed)
+        print('Running {0}...'.format(size), file=sys.stderr)
+        report['results'][size] = run(filename, args.repeat, args.seed,
+                                      args.engine)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
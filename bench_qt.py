@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+# Must be set before Qt is imported.
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from PyQt5.QtCore import QDate
+from PyQt5.QtGui import QTextCursor
+from PyQt5.QtTest import QTest
+from PyQt5.QtWidgets import QApplication
+
+import bench
+from main import MainWindow
+
+
+def percentiles(runs):
+    runs = sorted(runs)
+
+    def pick(p):
+        return runs[min(len(runs) - 1, int(round(p * (len(runs) - 1))))]
+
+    return {'p50': pick(0.50),
+            'p90': pick(0.90),
+            'p99': pick(0.99),
+            'max': runs[-1],
+            # Lets bench.compare() treat these like the storage results.
+            'median': pick(0.50),
+            'count': len(runs)}
+
+
+class Replay(object):
+    '''Drives a MainWindow through scripted interactions, timing each one
+       until the event queue has drained.'''
+    def __init__(self, app, window, seed=0):
+        self.app = app
+        self.window = window
+        self.rnd = random.Random(seed)
+        self.timings = dict()
+
+        self.dates = sorted(set(x.date_published for x in window.journal.entries))
+        self.calendar = window.dock_calendar.calendar
+        self.edit = window.main_entry.entry_editpage
+
+    def time(self, name, func):
+        start = time.perf_counter()
+        func()
+        self.app.processEvents()
+        self.timings.setdefault(name, []).append(time.perf_counter() - start)
+
+    def select(self, day):
+        self.calendar.setSelectedDate(QDate(day.year, day.month, day.day))
+
+    def clickDate(self):
+        day = self.rnd.choice(self.dates)
+        self.time('calendar.click', lambda: self.select(day))
+
+    def stepDates(self):
+        self.time('calendar.next', self.window.dock_calendar.nextEntry)
+        self.time('calendar.previous', self.window.dock_calendar.prevEntry)
+
+    def changeMonth(self):
+        day = self.rnd.choice(self.dates)
+        self.time('calendar.month',
+                  lambda: self.calendar.setCurrentPage(day.year, day.month))
+
+    def switchEntry(self):
+        entrylist = self.window.dock_entrylist.entrylist
+        rows = entrylist.model().rowCount()
+        if rows < 2:
+            return
+        index = entrylist.model().index(self.rnd.randrange(rows),
+                                        entrylist.modelColumn())
+        self.time('entry.switch', lambda: entrylist.setCurrentIndex(index))
+
+    def typeTitle(self):
+        if not self.window.main_entry.isEnabled():
+            return
+        self.time('type.title',
+                  lambda: QTest.keyClicks(self.edit.titletext, ' note'))
+
+    def typeBody(self):
+        if not self.window.main_entry.isEnabled():
+            return
+        self.edit.bodytext.moveCursor(QTextCursor.End)
+        self.time('type.body',
+                  lambda: QTest.keyClicks(self.edit.bodytext, 'a few words'))
+
+    def newAndDelete(self):
+        self.time('entry.new', self.window.new_entry)
+        self.time('entry.delete', self.window.delete_entry)
+
+    def run(self, rounds):
+        self.select(self.dates[len(self.dates) // 2])
+        self.app.processEvents()
+        steps = (self.clickDate, self.stepDates, self.changeMonth,
+                 self.switchEntry, self.typeTitle, self.typeBody,
+                 self.newAndDelete)
+        for i in range(rounds):
+            self.rnd.choice(steps)()
+        return dict((name, percentiles(runs))
+                    for name, runs in self.timings.items())
+
+
+def run(app, filename, rounds, seed=0, config=None, engine='sqlite3'):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = bench.journalCopy(filename, tmp, 'journal', engine)
+
+        window = MainWindow(config)
+        window.show()
+
+        start = time.perf_counter()
+        window.load_journal(copy)
+        app.processEvents()
+        results['window.load'] = percentiles([time.perf_counter() - start])
+
+        results.update(Replay(app, window, seed).run(rounds))
+
+        window.close()
+        window.deleteLater()
+        app.processEvents()
+        bench.dropCopy(copy)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Qt frontend '
+                                                 'headlessly.')
+    parser.add_argument('--sizes', default='1k',
+                        help='comma separated sizes out of: ' + ', '.join(bench.SIZES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=500,
+                        help='number of scripted interactions per journal')
+    parser.add_argument('--data', default='bench_data',
+                        help='directory to keep generated journals in')
+    parser.add_argument('--output', default='bench_qt_output.json')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='report from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--lazy', action='store_true',
+                        help='load entry bodies on demand')
+    parser.add_argument('--engine', choices=sorted(bench.ENGINES),
+                        default='sqlite3',
+                        help='storage engine to run against; memory leaves '
+                             'out disk I/O')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+
+    os.makedirs(args.data, exist_ok=True)
+    report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'qpa': os.environ['QT_QPA_PLATFORM'],
+                       'seed': args.seed,
+                       'rounds': args.rounds,
+                       'lazy': args.lazy,
+                       'engine': args.engine},
+              'results': dict()}
+
+    for size in args.sizes.split(','):
+        filename = os.path.join(args.data,
+                                'journal-{0}-{1}.mentdb'.format(size, args.seed))
+        if not os.path.exists(filename):
+            print('Generating {0}...'.format(filename), file=sys.stderr)
+            bench.generate(filename, bench.SIZES[size], args.seed)
+        print('Running {0}...'.format(size), file=sys.stderr)
+        report['results'][size] = run(app, filename, args.rounds, args.seed,
+                                      {'lazy_bodies': args.lazy}, args.engine)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for size, results in sorted(report['results'].items()):
+        for name, r in sorted(results.items()):
+            print('{0:>5} {1:<20} p50 {2:8.2f}ms  p90 {3:8.2f}ms  '
+                  'p99 {4:8.2f}ms  (n={5})'.format(size, name,
+                                                   r['p50'] * 1000,
+                                                   r['p90'] * 1000,
+                                                   r['p99'] * 1000,
+                                                   r['count']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if bench.compare(report, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import html
+import itertools
+import json
+import os
+import re
+import sys
+
+import journal  # storage needs journal imported first
+import metrics
+from htmlutils import htmlFragment, htmlToMarkdown
+from storage import engineFor
+from tags import formatTags
+from utils import mapChunks
+
+EXPORTED = metrics.counter('export.entries')
+EXPORT_SECONDS = metrics.histogram('export.seconds')
+
+
+# Each writer's prepare() turns an entry into what write() puts out. It runs
+# in worker processes when exporting in parallel, so it has to be a plain
+# module-level function.
+
+def prepareJson(entry):
+    return json.dumps(entry.toDict(), ensure_ascii=False) + '\n'
+
+
+def prepareMarkdown(entry):
+    header = ['---',
+              'title: {0}'.format(json.dumps(entry.title, ensure_ascii=False)),
+              'date: {0}'.format(entry.date_published.isoformat()),
+              'created: {0}'.format(entry.date_created.isoformat()),
+              'modified: {0}'.format(entry.date_modified.isoformat())]
+    if entry.tags:
+        header.append('tags: {0}'.format(formatTags(entry.tags)))
+    header.extend(['---', ''])
+    return '\n'.join(header) + '\n' + htmlToMarkdown(entry.body) + '\n'
+
+
+def prepareHtml(entry):
+    return ('<article id="entry-{0}">\n'
+            '<h2>{1}</h2>\n'
+            '<p class="date">{2}</p>\n'
+            '{3}\n'
+            '</article>\n').format(entry.entry_id,
+                                   html.escape(entry.title or '(Untitled Entry)'),
+                                   entry.date_published.strftime('%A, %d %B %Y'),
+                                   htmlFragment(entry.body))
+
+
+def slug(text, length=50):
+    text = re.sub(r'[^\w]+', '-', text.lower()).strip('-')
+    return text[:length].rstrip('-') or 'untitled'
+
+
+class JsonLinesWriter(object):
+    '''One JSON object per line, as Entry.toDict() gives them.'''
+    prepare = staticmethod(prepareJson)
+
+    def __init__(self, path, title=None):
+        self.file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8')
+
+    def write(self, entry, text):
+        self.file.write(text)
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class MarkdownWriter(object):
+    '''One Markdown file per entry, named after its date, id and title.'''
+    prepare = staticmethod(prepareMarkdown)
+
+    def __init__(self, path, title=None):
+        self.directory = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, entry, text):
+        name = '{0}-{1}-{2}.md'.format(entry.date_published.isoformat(),
+                                       entry.entry_id,
+                                       slug(entry.title))
+        with open(os.path.join(self.directory, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def close(self):
+        pass
+
+
+class HtmlBookWriter(object):
+    '''A single HTML document holding every entry in turn.'''
+    prepare = staticmethod(prepareHtml)
+
+    HEAD = ('<!DOCTYPE html>\n'
+            '<html><head><meta charset="utf-8" />\n'
+            '<title>{0}</title>\n'
+            '<style>\n'
+            'body {{ max-width: 40em; margin: auto; font-family: serif; }}\n'
+            'article {{ margin-bottom: 3em; }}\n'
+            '.date {{ color: #666; font-style: italic; }}\n'
+            '</style></head>\n'
+            '<body>\n'
+            '<h1>{0}</h1>\n')
+    TAIL = '</body></html>\n'
+
+    def __init__(self, path, title=None):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write(self.HEAD.format(html.escape(title or 'Journal')))
+
+    def write(self, entry, text):
+        self.file.write(text)
+
+    def close(self):
+        self.file.write(self.TAIL)
+        self.file.close()
+
+
+WRITERS = {'jsonl': JsonLinesWriter,
+           'markdown': MarkdownWriter,
+           'html': HtmlBookWriter}
+
+
+def export(dbfile, writer, start=None, end=None, text=None, processes=0,
+           chunksize=500, storage=None):
+    ''' Write the entries of dbfile published from start to end that mention
+        text to writer, oldest first, and return how many there were. Only a
+        chunk of entries at a time is held in memory, or a couple of chunks
+        per worker when processes is set. '''
+    storage = storage or engineFor(dbfile)()
+    entries = storage.iterEntries(dbfile, chunksize, start, end, text)
+    chunks = iter(lambda: list(itertools.islice(entries, chunksize)), [])
+
+    count = 0
+    with EXPORT_SECONDS.time():
+        for chunk, prepared in mapChunks(writer.prepare, chunks, processes):
+            for entry, item in zip(chunk, prepared):
+                writer.write(entry, item)
+            count += len(chunk)
+            EXPORTED.inc(len(chunk))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export journal entries.')
+    parser.add_argument('file', help='journal to export')
+    parser.add_argument('output',
+                        help='file to write, or directory for markdown; '
+                             '- writes jsonl to standard output')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='jsonl')
+    parser.add_argument('--from', dest='start', type=datetime.date.fromisoformat,
+                        metavar='YYYY-MM-DD', help='first published date')
+    parser.add_argument('--to', dest='end', type=datetime.date.fromisoformat,
+                        metavar='YYYY-MM-DD', help='last published date')
+    parser.add_argument('--search', help='only entries mentioning this text')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='convert entries in this many worker processes')
+    args = parser.parse_args()
+
+    title = os.path.splitext(os.path.basename(args.file))[0]
+    writer = WRITERS[args.format](args.output, title)
+    try:
+        count = export(args.file, writer, args.start, args.end, args.search,
+                       args.processes)
+    finally:
+        writer.close()
+    print('Exported {0} entries.'.format(count), file=sys.stderr)
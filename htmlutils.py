@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import html
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+# Document heads QTextEdit.toHtml() has been seen to emit. Stored bodies
+# refer to them by position (plus one), so only ever append to this list.
+QT_HEADS = [
+    '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" '
+    '"http://www.w3.org/TR/REC-html40/strict.dtd">\n'
+    '<html><head><meta name="qrichtext" content="1" />'
+    '<style type="text/css">\n'
+    'p, li { white-space: pre-wrap; }\n'
+    '</style></head>',
+]
+QT_TAIL = '</body></html>'
+
+# Block styles Qt repeats on nearly every paragraph and list item, with the
+# short stand-ins stored in their place. Qt never writes class attributes
+# itself, so the stand-ins cannot collide with real markup.
+QT_BLOCK_STYLES = [
+    (' style=" margin-top:0px; margin-bottom:0px; margin-left:0px; '
+     'margin-right:0px; -qt-block-indent:0; text-indent:0px;"',
+     ' class="q0"'),
+    (' style="-qt-paragraph-type:empty; margin-top:0px; margin-bottom:0px; '
+     'margin-left:0px; margin-right:0px; -qt-block-indent:0; '
+     'text-indent:0px;"',
+     ' class="q1"'),
+]
+
+FORMAT_RAW = 0
+
+
+def minifyHtml(html):
+    ''' Strip the boilerplate from a QTextEdit HTML document.
+
+        Returns (format, text), where format is FORMAT_RAW if html was left
+        alone and otherwise identifies the head that expandHtml() puts back.
+        The round trip is exact. '''
+    if not html.endswith(QT_TAIL):
+        return FORMAT_RAW, html
+
+    for i, head in enumerate(QT_HEADS):
+        if html.startswith(head):
+            inner = html[len(head):-len(QT_TAIL)]
+            break
+    else:
+        return FORMAT_RAW, html
+
+    for style, short in QT_BLOCK_STYLES:
+        if short in inner:
+            return FORMAT_RAW, html
+    for style, short in QT_BLOCK_STYLES:
+        inner = inner.replace(style, short)
+
+    return i + 1, inner
+
+
+def expandHtml(format, text):
+    ''' Rebuild the document minifyHtml() returned format and text for. '''
+    if format == FORMAT_RAW:
+        return text
+
+    for style, short in QT_BLOCK_STYLES:
+        text = text.replace(short, style)
+
+    return QT_HEADS[format - 1] + text + QT_TAIL
+
+
+# Tags that start a new line of text, and tags whose content is not shown.
+TEXT_BLOCKS = frozenset(['address', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt',
+                         'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol',
+                         'p', 'pre', 'table', 'td', 'th', 'tr', 'ul'])
+HIDDEN_TAGS = frozenset(['head', 'script', 'style', 'title'])
+RAW_TAGS = frozenset(['script', 'style'])
+
+# Comments, declarations and processing instructions, or a start or end tag
+# whose quoted attribute values may hold a ">".
+MARKUP = re.compile(r'<!--.*?-->|<![^>]*>|<\?[^>]*>'
+                    r'|<(/?)([a-zA-Z][^\s/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>',
+                    re.DOTALL)
+
+
+def plainText(html):
+    ''' The text a reader sees in html, with blank lines collapsed. '''
+    # A regular expression scan rather than an HTMLParser, which is several
+    # times slower and runs on every body saved or imported.
+    parts = list()
+    hidden = 0
+    position = 0
+    while True:
+        match = MARKUP.search(html, position)
+        if match is None:
+            break
+        if not hidden and match.start() > position:
+            parts.append(unescape(html[position:match.start()]))
+        position = match.end()
+
+        tag = match.group(2)
+        if not tag:
+            continue
+        tag = tag.lower()
+        if match.group(1):
+            events = (True, )
+        elif match.group(3).endswith('/'):
+            # <br /> counts as both a start and an end tag.
+            events = (False, True)
+        else:
+            events = (False, )
+        for closing in events:
+            if tag in HIDDEN_TAGS:
+                hidden = max(0, hidden - 1) if closing else hidden + 1
+            elif tag in TEXT_BLOCKS:
+                parts.append('\n')
+
+        if tag in RAW_TAGS and events == (False, ):
+            # Script and style content is not markup; skip to its end tag.
+            end = html.lower().find('</' + tag, position)
+            position = len(html) if end < 0 else end
+    if not hidden:
+        parts.append(unescape(html[position:]))
+
+    lines = list()
+    for line in ''.join(parts).splitlines():
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    return '\n'.join(lines).strip('\n')
+
+
+def snippet(text, length=160):
+    ''' The start of text on one line, cut at a word boundary. '''
+    text = ' '.join(text.split())
+    if len(text) <= length:
+        return text
+    cut = text.rfind(' ', 0, length)
+    return text[:cut if cut > 0 else length] + '…'
+
+
+def htmlFragment(html):
+    ''' The markup inside the body of an HTML document. '''
+    match = re.search(r'<body[^>]*>(.*)</body>', html, re.DOTALL | re.IGNORECASE)
+    return match.group(1).strip() if match else html
+
+
+class MarkdownConverter(HTMLParser):
+    ''' Rewrites an HTML document as Markdown, keeping the formatting a
+        QTextEdit can produce: headings, lists, quotes, code, links, images
+        and bold, italic or struck out text, including Qt's styled spans. '''
+    HEADINGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+    INLINE = {'b': '**', 'strong': '**', 'i': '*', 'em': '*', 'code': '`',
+              's': '~~', 'del': '~~', 'strike': '~~'}
+    BLOCKS = TEXT_BLOCKS
+    HIDDEN = HIDDEN_TAGS
+
+    ESCAPE = re.compile(r'([\\`*_\[\]])')
+    MARKER_START = re.compile(r'([#>+-]|\d+\.)(\s|$)')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = list()
+        self.line = list()
+        self.inline = list()
+        self.lists = list()
+        self.list_start = False
+        self.item = None
+        self.heading = 0
+        self.quote = 0
+        self.pre = 0
+        self.hidden = 0
+
+    def flush(self):
+        text = ''.join(self.line)
+        self.line = list()
+        self.inline = list()
+        if not self.pre:
+            text = text.strip()
+            if self.MARKER_START.match(text):
+                text = '\\' + text
+        if not text.strip():
+            return
+
+        if self.heading:
+            prefix = '#' * self.heading + ' '
+        elif self.item:
+            prefix, self.item = self.item, None
+        else:
+            prefix = ''
+        indent = '    ' * max(0, len(self.lists) - 1)
+
+        if self.pre:
+            lines = ['```'] + text.split('\n') + ['```']
+        else:
+            lines = [x.strip() for x in text.split('\n')]
+            lines = [x + '\\' for x in lines[:-1]] + lines[-1:]
+        lines = [indent + (prefix if i == 0 else ' ' * len(prefix)) + x
+                 for i, x in enumerate(lines)]
+        if self.quote:
+            lines = ['> ' * self.quote + x for x in lines]
+
+        # Items of one list follow each other without a blank line.
+        self.blocks.append(('\n'.join(lines), bool(self.lists) and not self.list_start))
+        self.list_start = False
+
+    def spanMarker(self, style):
+        style = style.replace(' ', '')
+        marker = ''
+        if re.search(r'font-weight:([6-9]00|bold)', style):
+            marker += '**'
+        if 'font-style:italic' in style:
+            marker += '*'
+        if 'line-through' in style:
+            marker += '~~'
+        return marker
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.HIDDEN:
+            self.hidden += 1
+        elif tag == 'br':
+            self.line.append('\n')
+        elif tag == 'img':
+            self.line.append('![{0}]({1})'.format(attrs.get('alt') or '',
+                                                  attrs.get('src') or ''))
+        elif tag == 'a':
+            self.inline.append((tag, attrs.get('href'), len(self.line)))
+        elif tag == 'span':
+            self.inline.append((tag, self.spanMarker(attrs.get('style') or ''),
+                                len(self.line)))
+        elif tag in self.INLINE:
+            self.inline.append((tag, self.INLINE[tag], len(self.line)))
+        elif tag in self.BLOCKS:
+            self.flush()
+            if tag in self.HEADINGS:
+                self.heading = self.HEADINGS[tag]
+            elif tag in ('ul', 'ol'):
+                self.list_start = not self.lists
+                self.lists.append(None if tag == 'ul' else 0)
+            elif tag == 'li' and self.lists:
+                if self.lists[-1] is None:
+                    self.item = '- '
+                else:
+                    self.lists[-1] += 1
+                    self.item = '{0}. '.format(self.lists[-1])
+            elif tag == 'blockquote':
+                self.quote += 1
+            elif tag == 'pre':
+                self.pre += 1
+            elif tag == 'hr':
+                self.blocks.append(('---', False))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in ('br', 'img', 'hr'):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.HIDDEN:
+            self.hidden = max(0, self.hidden - 1)
+        elif tag in ('a', 'span') or tag in self.INLINE:
+            self.closeInline(tag)
+        elif tag in self.BLOCKS:
+            self.flush()
+            if tag in self.HEADINGS:
+                self.heading = 0
+            elif tag in ('ul', 'ol') and self.lists:
+                self.lists.pop()
+            elif tag == 'blockquote':
+                self.quote = max(0, self.quote - 1)
+            elif tag == 'pre':
+                self.pre = max(0, self.pre - 1)
+
+    def closeInline(self, tag):
+        for i in range(len(self.inline) - 1, -1, -1):
+            if self.inline[i][0] == tag:
+                break
+        else:
+            return
+        tag, marker, position = self.inline.pop(i)
+        text = ''.join(self.line[position:])
+        core = text.strip()
+        if tag == 'a':
+            if marker:
+                core = '[{0}]({1})'.format(core, marker)
+        elif core and marker:
+            core = marker + core + marker
+        if core:
+            lead = text[:len(text) - len(text.lstrip())]
+            trail = text[len(text.rstrip()):]
+            text = lead + core + trail
+        self.line[position:] = [text]
+
+    def handle_data(self, data):
+        if self.hidden:
+            return
+        if self.pre or any(x[0] == 'code' for x in self.inline):
+            self.line.append(data)
+        else:
+            data = self.ESCAPE.sub(r'\\\1', re.sub(r'\s+', ' ', data))
+            self.line.append(data)
+
+    def markdown(self):
+        self.flush()
+        parts = list()
+        for text, tight in self.blocks:
+            if parts:
+                parts.append('\n' if tight else '\n\n')
+            parts.append(text)
+        return ''.join(parts)
+
+
+def htmlToMarkdown(html):
+    ''' html rewritten as Markdown. '''
+    parser = MarkdownConverter()
+    parser.feed(html)
+    parser.close()
+    return parser.markdown()
+
+
+def textToHtml(text):
+    ''' Plain text as HTML paragraphs, one per run of non-blank lines. '''
+    paragraphs = re.split(r'\n\s*\n', text.strip())
+    return '\n'.join('<p>{0}</p>'.format('<br />'.join(html.escape(x.strip())
+                                                       for x in p.splitlines()))
+                     for p in paragraphs if p.strip())
+
+
+MARKDOWN_INLINE = [
+    (re.compile(r'!\[([^\]]*)\]\(([^)\s]*)\)'), r'<img src="\2" alt="\1" />'),
+    (re.compile(r'\[([^\]]+)\]\(([^)\s]*)\)'), r'<a href="\2">\1</a>'),
+    (re.compile(r'\*\*\*(?=\S)(.+?)(?<=\S)\*\*\*'), r'<b><i>\1</i></b>'),
+    (re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*'), r'<b>\1</b>'),
+    (re.compile(r'\b__(?=\S)(.+?)(?<=\S)__\b'), r'<b>\1</b>'),
+    (re.compile(r'\*(?=\S)(.+?)(?<=\S)\*'), r'<i>\1</i>'),
+    (re.compile(r'\b_(?=\S)(.+?)(?<=\S)_\b'), r'<i>\1</i>'),
+    (re.compile(r'~~(?=\S)(.+?)(?<=\S)~~'), r'<s>\1</s>'),
+]
+MARKDOWN_LIST_ITEM = re.compile(r'( *)([-*+]|\d+\.) +(.*)')
+
+
+def markdownInline(text):
+    ''' One block's worth of Markdown inline markup as HTML. '''
+    # Code spans and escaped characters are set aside first so that the
+    # rules below cannot touch them.
+    stash = list()
+
+    def keep(markup):
+        stash.append(markup)
+        return '\x00{0}\x00'.format(len(stash) - 1)
+
+    text = re.sub(r'`([^`]+)`',
+                  lambda m: keep('<code>{0}</code>'.format(html.escape(m.group(1)))),
+                  text)
+    text = re.sub(r'\\([\\`*_\[\](){}#+\-.!>~])',
+                  lambda m: keep(html.escape(m.group(1))),
+                  text)
+    text = html.escape(text)
+    for pattern, replacement in MARKDOWN_INLINE:
+        text = pattern.sub(replacement, text)
+    text = re.sub(r'(\\| {2,})\n', '<br />', text)
+    return re.sub('\x00(\\d+)\x00', lambda m: stash[int(m.group(1))], text)
+
+
+def markdownToHtml(text):
+    ''' Markdown as HTML, covering what htmlToMarkdown() writes: headings,
+        paragraphs, lists, quotes, fenced code, rules and inline markup. '''
+    lines = text.splitlines()
+    blocks = list()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if not stripped:
+            i += 1
+        elif stripped.startswith('```'):
+            code = list()
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith('```'):
+                code.append(lines[i])
+                i += 1
+            blocks.append('<pre>{0}</pre>'.format(html.escape('\n'.join(code))))
+            i += 1
+        elif re.match(r'#{1,6} ', stripped):
+            level = len(stripped) - len(stripped.lstrip('#'))
+            blocks.append('<h{0}>{1}</h{0}>'.format(level,
+                                                     markdownInline(stripped[level:].strip())))
+            i += 1
+        elif re.match(r'([-*_] *){3,}$', stripped):
+            blocks.append('<hr />')
+            i += 1
+        elif stripped.startswith('>'):
+            quoted = list()
+            while i < len(lines) and lines[i].strip().startswith('>'):
+                quoted.append(re.sub(r'^\s*> ?', '', lines[i]))
+                i += 1
+            blocks.append('<blockquote>{0}</blockquote>'.format(markdownToHtml('\n'.join(quoted))))
+        elif MARKDOWN_LIST_ITEM.match(line):
+            indent = len(MARKDOWN_LIST_ITEM.match(line).group(1))
+            ordered = MARKDOWN_LIST_ITEM.match(line).group(2)[0].isdigit()
+            items = list()
+            while i < len(lines):
+                match = MARKDOWN_LIST_ITEM.match(lines[i])
+                if match and len(match.group(1)) == indent:
+                    items.append([match.group(3)])
+                elif lines[i].strip() and (match or lines[i].startswith(' ' * (indent + 2))):
+                    # Nested lists and continuation lines belong to the item.
+                    items[-1].append(lines[i][indent + 2:] if not match
+                                     else lines[i][indent:])
+                else:
+                    break
+                i += 1
+            tag = 'ol' if ordered else 'ul'
+            blocks.append('<{0}>{1}</{0}>'.format(tag, ''.join(
+                '<li>{0}</li>'.format(markdownItem(x)) for x in items)))
+        else:
+            paragraph = list()
+            while i < len(lines) and lines[i].strip() and not (
+                    lines[i].lstrip().startswith(('#', '>', '```'))
+                    or MARKDOWN_LIST_ITEM.match(lines[i])):
+                paragraph.append(lines[i].lstrip())
+                i += 1
+            if not paragraph:
+                paragraph.append(line)
+                i += 1
+            blocks.append('<p>{0}</p>'.format(markdownInline('\n'.join(paragraph))))
+    return '\n'.join(blocks)
+
+
+def markdownItem(lines):
+    first = markdownInline(lines[0])
+    if len(lines) == 1:
+        return first
+    rest = [x[2:] if x.startswith('  ') else x for x in lines[1:]]
+    return first + markdownToHtml('\n'.join(rest))
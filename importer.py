@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import functools
+import itertools
+import json
+import os
+import re
+import sys
+
+import metrics
+from htmlutils import markdownToHtml, textToHtml
+from journal import Entry
+from storage import engineFor
+from tags import parseTags
+from utils import mapChunks
+
+IMPORTED = metrics.counter('import.entries')
+SKIPPED = metrics.counter('import.skipped')
+IMPORT_SECONDS = metrics.histogram('import.seconds')
+
+FILE_DATE = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})[-_ .]*(.*)')
+JRNL_HEADER = re.compile(r'\[?(\d{4}-\d{2}-\d{2})[ T](\d{1,2}:\d{2})(?::\d{2})?'
+                         r'(?: ?([AaPp][Mm]))?\]? ?(.*)')
+SENTENCE_END = re.compile(r'(?<=[.?!])\s+')
+
+TEXT_EXTENSIONS = ('.txt', '.text')
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.mdown')
+
+
+# Parsers take one item from a reader and return (entry, plain text) for it,
+# or None to skip it, and raise ValueError or OSError for an item that cannot
+# be imported. They run in worker processes when importing in parallel, so
+# they have to be plain module-level functions.
+
+def parseJsonLine(line):
+    line = line.strip()
+    if not line:
+        return None
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError('not a JSON object')
+    # Dates may be null or left out, and fall back to the current time.
+    for key, default in (('title', ''), ('body', ''), ('date_created', None),
+                         ('date_modified', None), ('date_published', None)):
+        if data.get(key, default) is not default and not isinstance(data[key], str):
+            raise ValueError('{0} is not a string'.format(key))
+    tags = data.get('tags') or []
+    if not isinstance(tags, list) or not all(isinstance(x, str) for x in tags):
+        raise ValueError('tags is not a list of strings')
+    entry = Entry.fromDict(data)
+    # Exported entries carry their old ids, which mean nothing here, and
+    # importing is making new entries rather than copies to sync.
+    entry.entry_id = None
+    entry.uuid = None
+    if not entry.body.lstrip().startswith('<'):
+        return withBody(entry, textToHtml(entry.body), entry.body)
+    return entry, None
+
+
+def parseFrontMatter(text):
+    ''' Split a leading "---" block of "key: value" lines off text. '''
+    lines = text.splitlines()
+    if not lines or lines[0].strip() != '---':
+        return dict(), text
+    for i, line in enumerate(lines[1:], 1):
+        if line.strip() == '---':
+            break
+    else:
+        return dict(), text
+
+    fields = dict()
+    for line in lines[1:i]:
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        value = value.strip()
+        if value.startswith('"'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        fields[key.strip().lower()] = value
+    return fields, '\n'.join(lines[i + 1:])
+
+
+def parseDatedFile(path):
+    ''' An entry from a Markdown or text file named after its date, as
+        2020-01-31-some-title.md or 20200131 Some title.txt. '''
+    name, extension = os.path.splitext(os.path.basename(path))
+    match = FILE_DATE.match(name)
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+
+    fields, text = parseFrontMatter(text)
+    try:
+        published = datetime.date.fromisoformat(fields['date'])
+    except (KeyError, ValueError):
+        if match is None:
+            raise ValueError('no date in its name or front matter')
+        published = datetime.date(int(match.group(1)),
+                                  int(match.group(2)),
+                                  int(match.group(3)))
+    words = match.group(4) if match else name
+    title = fields.get('title') or re.sub(r'[-_]+', ' ', words).strip()
+
+    entry = Entry(date_published=published)
+    entry.tags = parseTags(fields.get('tags', '').strip('[]'))
+    for key, attr in (('created', 'date_created'), ('modified', 'date_modified')):
+        try:
+            setattr(entry, attr, datetime.datetime.fromisoformat(fields[key]))
+        except (KeyError, ValueError):
+            setattr(entry, attr, datetime.datetime.combine(published, datetime.time()))
+
+    if extension.lower() in TEXT_EXTENSIONS:
+        entry.title = title[:1].upper() + title[1:]
+        return withBody(entry, textToHtml(text), text)
+
+    heading = re.match(r'\s*# (.*)\n?', text)
+    if heading and not title:
+        title, text = heading.group(1).strip(), text[heading.end():]
+    entry.title = title[:1].upper() + title[1:]
+    return withBody(entry, markdownToHtml(text), None)
+
+
+def parseJrnlEntry(text):
+    ''' An entry from one "[2020-01-31 09:15 AM] Title. Body" block of a
+        jrnl plain text journal. '''
+    header, sep, body = text.partition('\n')
+    match = JRNL_HEADER.match(header)
+    date = datetime.date.fromisoformat(match.group(1))
+    hour, minute = (int(x) for x in match.group(2).split(':'))
+    if match.group(3):
+        hour = hour % 12 + (12 if match.group(3).lower() == 'pm' else 0)
+    created = datetime.datetime.combine(date, datetime.time(hour, minute))
+
+    # jrnl takes the first sentence as the title.
+    parts = SENTENCE_END.split(match.group(4).strip(), 1)
+    title = parts[0]
+    text = ((parts[1] if len(parts) > 1 else '') + '\n' + body).strip()
+
+    entry = Entry(date_created=created,
+                  date_modified=created,
+                  date_published=date,
+                  title=title.rstrip(' *'))
+    return withBody(entry, textToHtml(text), text)
+
+
+def withBody(entry, body, text):
+    entry.body = body
+    return entry, text
+
+
+# Readers turn a source into items for a parser, lazily, so a large source
+# never has to be read into memory at once.
+
+def readJsonLines(source):
+    with open(source, encoding='utf-8') as f:
+        yield from f
+
+
+def readDatedFiles(source):
+    for directory, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            if (name.lower().endswith(TEXT_EXTENSIONS + MARKDOWN_EXTENSIONS)
+                    and FILE_DATE.match(name)):
+                yield os.path.join(directory, name)
+
+
+def readJrnl(source):
+    block = list()
+    with open(source, encoding='utf-8') as f:
+        for line in f:
+            if JRNL_HEADER.match(line):
+                if block:
+                    yield ''.join(block)
+                block = [line]
+            elif block:
+                block.append(line)
+    if block:
+        yield ''.join(block)
+
+
+FORMATS = {'jsonl': (readJsonLines, parseJsonLine),
+           'folder': (readDatedFiles, parseDatedFile),
+           'jrnl': (readJrnl, parseJrnlEntry)}
+
+
+def detectFormat(source):
+    if os.path.isdir(source):
+        return 'folder'
+    if source.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'jrnl'
+
+
+def parseRow(storage, parse, item):
+    ''' The row for item, or None to skip it, as (row, problem), with
+        problem saying why an item that could not be parsed was left out. '''
+    try:
+        parsed = parse(item)
+    except (OSError, ValueError) as e:
+        return None, '{0}: {1}'.format(item.splitlines()[0][:80] if item else '', e)
+    if parsed is None:
+        return None, None
+    return storage.entryRow(*parsed), None
+
+
+def importEntries(dbfile, source, format=None, processes=0, chunksize=500,
+                  batchsize=50000, storage=None, skipped=None):
+    ''' Add the entries found in source to the journal dbfile, creating it if
+        need be, and return how many there were. Items are parsed a chunk at
+        a time, in processes worker processes if given, and written in
+        transactions of batchsize rows. Items that cannot be parsed are left
+        out, with why added to the list skipped if one is given. '''
+    storage = storage or engineFor(dbfile)()
+    if not storage.exists(dbfile):
+        storage.new(dbfile)
+
+    read, parse = FORMATS[format or detectFormat(source)]
+    items = read(source)
+    chunks = iter(lambda: list(itertools.islice(items, chunksize)), [])
+
+    def rows():
+        for chunk, parsed in mapChunks(functools.partial(parseRow, storage, parse),
+                                       chunks,
+                                       processes):
+            for row, problem in parsed:
+                if problem is not None:
+                    SKIPPED.inc()
+                    if skipped is not None:
+                        skipped.append(problem)
+                elif row is not None:
+                    yield row
+
+    with IMPORT_SECONDS.time():
+        count = storage.bulkInsert(dbfile, rows(), batchsize)
+    IMPORTED.inc(count)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import entries into a journal.')
+    parser.add_argument('file', help='journal to import into; created if missing')
+    parser.add_argument('sources', nargs='+',
+                        help='JSON Lines file, folder of dated .md/.txt files '
+                             'or jrnl text file')
+    parser.add_argument('--format', choices=sorted(FORMATS),
+                        help='format of the sources (default: guessed)')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='parse in this many worker processes')
+    parser.add_argument('--batch', type=int, default=50000,
+                        help='entries written per transaction')
+    args = parser.parse_args()
+
+    for source in args.sources:
+        skipped = list()
+        count = importEntries(args.file, source, args.format, args.processes,
+                              batchsize=args.batch, skipped=skipped)
+        for problem in skipped:
+            print('Skipped {0}'.format(problem), file=sys.stderr)
+        print('Imported {0} entries from {1}.'.format(count, source),
+              file=sys.stderr)
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import bisect
 import datetime
+import sys
+import threading
 
 class Entry(object):
     def __init__(self,
@@ -10,7 +13,11 @@ class Entry(object):
                  date_published=datetime.date.today(),
                  entry_id=None,
                  title='',
-                 body=''):
+                 body='',
+                 snippet='',
+                 word_count=0,
+                 uuid=None,
+                 tags=()):
         self.date_created = date_created
         self.date_modified = date_modified
         self.date_published = date_published
@@ -18,6 +25,18 @@ class Entry(object):
         self.title = title
         self.body = body
 
+        # Derived from body by the storage engine when the entry is saved.
+        self.snippet = snippet
+        self.word_count = word_count
+
+        # Names the entry across every copy of the journal, for sync. The
+        # storage engine assigns one when the entry is first saved.
+        self.uuid = uuid
+
+        # Normalized tag names, as tags.normalizeTags() gives them. Replaced
+        # rather than changed in place, which the tag index relies on.
+        self.tags = list(tags)
+
         self.modified = False
 
     def __repr__(self):
@@ -26,79 +45,440 @@ class Entry(object):
         else:
             return '(Untitled Entry)'
 
-from storage import Sqlite3Storage
+    def toDict(self):
+        ''' Return the entry as a dict of JSON-friendly values. '''
+        return {'entry_id': self.entry_id,
+                'date_created': self.date_created.isoformat(),
+                'date_modified': self.date_modified.isoformat(),
+                'date_published': self.date_published.isoformat(),
+                'title': self.title,
+                'body': self.body,
+                'snippet': self.snippet,
+                'word_count': self.word_count,
+                'uuid': self.uuid,
+                'tags': list(self.tags)}
+
+    @classmethod
+    def fromDict(cls, data):
+        ''' Build an entry from the output of toDict(). Missing dates fall
+            back to the current time. '''
+        now = datetime.datetime.now()
+        entry = cls(date_created=now, date_modified=now,
+                    date_published=now.date())
+        for key in ('date_created', 'date_modified'):
+            if data.get(key):
+                setattr(entry, key,
+                        datetime.datetime.fromisoformat(data[key]))
+        if data.get('date_published'):
+            entry.date_published = datetime.date.fromisoformat(data['date_published'])
+        entry.entry_id = data.get('entry_id')
+        entry.uuid = data.get('uuid')
+        entry.tags = normalizeTags(data.get('tags', ()))
+        entry.title = data.get('title', '')
+        entry.body = data.get('body', '')
+        return entry
+
+import metrics
+from storage import contentHash, engineFor
+from tags import TagIndex, normalizeTags
+from utils import ReadWriteLock
+# Imported to register their engines.
+import logstorage
+import memorystorage
+import snapshot
+
+ENTRIES = metrics.gauge('journal.entries')
+BODY_BYTES = metrics.gauge('journal.body_bytes')
+SNAPSHOT_HITS = metrics.counter('journal.snapshot.hits')
+SNAPSHOT_MISSES = metrics.counter('journal.snapshot.misses')
+
+def bodySize(entry):
+    ''' Memory held by an entry's body text. '''
+    return sys.getsizeof(entry.body) if entry.body is not None else 0
 
 class Journal(object):
+    ''' A journal's entries plus the bookkeeping needed to save them.
+
+        Mutations go through insertEntry/removeEntry/updateEntry (or hold
+        lock.write() themselves) and bump version. Readers on other threads
+        should work from snapshot(), which is rebuilt only after a change, so
+        a long export or search never holds the lock while it runs.
+
+        With the lazy_bodies config key set, or an engine that prefers it,
+        load() leaves every body as None and fetchBodies() reads them in when
+        they are needed.
+
+        tags is an inverted index of the entries by tag, kept up to date by
+        the same methods, for taggedWith().
+
+        Other processes may save to the same file. externalChanges() reads
+        what they changed since load(), going by the engine's change log,
+        and reloadChanges() brings it in. '''
 
     name = None
 
-    def __init__(self, config=dict()):
-        self.config = config
+    def __init__(self, config=None):
+        self.config = config if config is not None else dict()
         self.entries = list()
         self.to_delete = list()
         self.current_entry = None
 
-    def new(self, filename):
+        self.lock = ReadWriteLock()
+        self.version = 0
+        self._snapshot = (self.version, tuple())
+        self._dates = (self.version, [], dict())
+        self.tags = TagIndex()
+
+        # How far into the file's change log the entries are up to date,
+        # and the content hash of each entry as this journal last saved it,
+        # by uuid, so its own saves are not taken for someone else's.
+        self.seq = 0
+        self.saved = dict()
+
+    def makeStorage(self):
+        ''' The storage engine for the journal file, as engineFor() picks it,
+            set up from the config. '''
+        return engineFor(self.config.get('filename'),
+                         self.config).fromConfig(self.config)
+
+    def lazyBodies(self, storage):
+        return bool(self.config.get('lazy_bodies') or storage.lazy_bodies)
+
+    def new(self, filename, storage=None):
         self.config['filename'] = filename
-        s = Sqlite3Storage()
+        s = storage or self.makeStorage()
         s.new(filename)
 
-    def load(self, filename):
+    def load(self, filename, storage=None):
         self.config['filename'] = filename
-        s = Sqlite3Storage()
-        self.entries = s.load(filename)
+        s = storage or self.makeStorage()
+        # Read first: anything saved while loading is then reloaded later,
+        # which is harmless, rather than missed.
+        seq = s.sequence(filename)
+        entries = s.load(filename, bodies=not self.lazyBodies(s))
+        with self.lock.write():
+            self.entries = entries
+            self.to_delete = list()
+            self.version += 1
+            self.tags = TagIndex(entries)
+            self.seq = seq
+            self.saved = dict()
         self.name = filename
 
-    def save(self):
-        s = Sqlite3Storage()
-        modified_entries = [x for x in self.entries if x.modified]
-        s.save(self.config['filename'], modified_entries, self.to_delete)
+        ENTRIES.set(len(entries))
+        BODY_BYTES.set(sum(bodySize(x) for x in entries))
+
+    def attach(self, filename):
+        ''' Point the journal at filename without loading anything, for a
+            caller that streams the entries in with appendEntries(). That
+            caller sets seq to what the engine's sequence() was before it
+            started reading. '''
+        self.config['filename'] = filename
+        with self.lock.write():
+            self.entries = list()
+            self.to_delete = list()
+            self.version += 1
+            self.tags = TagIndex()
+            self.seq = 0
+            self.saved = dict()
+        self.name = filename
+
+        ENTRIES.set(0)
+        BODY_BYTES.set(0)
+
+    def appendEntries(self, entries):
+        with self.lock.write():
+            self.entries.extend(entries)
+            for entry in entries:
+                self.tags.add(entry)
+            self.version += 1
+        ENTRIES.inc(len(entries))
+        BODY_BYTES.inc(sum(bodySize(x) for x in entries))
+
+    def save(self, storage=None):
+        if not self.config.get('filename'):
+            raise ValueError('No journal file is open to save to.')
+        s = storage or self.makeStorage()
+        with self.lock.write():
+            modified_entries = [x for x in self.entries if x.modified]
+            self.fetchBodies(modified_entries, s)
+            s.save(self.config['filename'], modified_entries, self.to_delete)
+            self.to_delete = list()
+            self.version += 1
+            for entry in modified_entries:
+                if entry.uuid:
+                    self.saved[entry.uuid] = contentHash(entry)
+
+    def externalChanges(self, storage=None):
+        ''' What other processes have saved to the file since load() or the
+            last call, as a dict of:
+
+            - updated: (entry, stored entry) pairs, for refreshEntry();
+            - added: stored entries the journal does not have;
+            - removed: entries deleted from the file, for dropEntry();
+            - conflicts: entries changed or deleted in the file while they
+              had unsaved edits here, or were deleted here but not saved.
+              They are left alone; saving writes over the other version,
+              which engines with history keep.
+
+            The journal itself is not changed, apart from moving on past
+            these changes, so the caller has to apply them. '''
+        changes = {'updated': [], 'added': [], 'removed': [], 'conflicts': []}
+        filename = self.config.get('filename')
+        if not filename:
+            return changes
+        s = storage or self.makeStorage()
+        log = s.changesSince(filename, self.seq)
+        if not log:
+            return changes
+
+        latest = dict((x['uuid'], x['content_hash']) for x in log)
+        with self.lock.read():
+            local = dict((x.uuid, x) for x in self.entries if x.uuid in latest)
+            deleted = dict((x.uuid, x) for x in self.to_delete if x.uuid in latest)
+
+        wanted = list()
+        for uuid, content_hash in latest.items():
+            if content_hash is not None and self.saved.pop(uuid, None) == content_hash:
+                continue
+            entry = local.get(uuid)
+            if uuid in deleted:
+                changes['conflicts'].append(deleted[uuid])
+            elif entry is None:
+                if content_hash is not None:
+                    wanted.append(uuid)
+            elif entry.modified:
+                changes['conflicts'].append(entry)
+            elif content_hash is None:
+                changes['removed'].append(entry)
+            elif entry.body is None or contentHash(entry) != content_hash:
+                wanted.append(uuid)
+
+        for stored in s.entriesByUuid(filename, wanted, bodies=not self.lazyBodies(s)):
+            if stored.uuid in local:
+                changes['updated'].append((local[stored.uuid], stored))
+            else:
+                changes['added'].append(stored)
+
+        self.seq = log[-1]['seq']
+        return changes
+
+    def reloadChanges(self, storage=None):
+        ''' Bring in what other processes have saved, as externalChanges()
+            finds it, and return that. '''
+        changes = self.externalChanges(storage)
+        for entry, stored in changes['updated']:
+            self.refreshEntry(entry, stored)
+        for entry in changes['removed']:
+            self.dropEntry(entry)
+        self.appendEntries(changes['added'])
+        return changes
+
+    def fetchBodies(self, entries, storage=None):
+        ''' Read in the bodies a lazy load() left out of entries. '''
+        missing = [x for x in entries if x.body is None and x.entry_id]
+        if not missing:
+            return
+        s = storage or self.makeStorage()
+        bodies = s.loadBodies(self.config['filename'],
+                              [x.entry_id for x in missing])
+        with self.lock.write():
+            for entry in missing:
+                if entry.body is None:
+                    entry.body = bodies.get(entry.entry_id, '')
+                    BODY_BYTES.inc(bodySize(entry))
+
+    def addAttachment(self, stream, size, mime_type, storage=None):
+        ''' Store size bytes from stream in the journal file straight away,
+            for a body to refer to as attachment:ID, and return the ID. '''
+        s = storage or self.makeStorage()
+        return s.addAttachment(self.config['filename'], stream, size, mime_type)
+
+    def readAttachment(self, attachment_id, storage=None):
+        ''' Iterate over the data of an attachment a chunk at a time. '''
+        s = storage or self.makeStorage()
+        return s.readAttachment(self.config['filename'], attachment_id)
+
+    def openAttachment(self, attachment_id, storage=None):
+        ''' The data of an attachment as a seekable file, to be closed. '''
+        s = storage or self.makeStorage()
+        return s.openAttachment(self.config['filename'], attachment_id)
+
+    def attachmentInfo(self, attachment_id, storage=None):
+        ''' The mime_type, size and sha256 of an attachment, or None. '''
+        s = storage or self.makeStorage()
+        return s.attachmentInfo(self.config['filename'], attachment_id)
+
+    def pruneAttachments(self, storage=None):
+        ''' Save, then delete the attachments that neither an entry nor its
+            history refers to, such as ones pasted into an entry that was
+            thrown away before it was saved. Returns how many there were. '''
+        s = storage or self.makeStorage()
+        with self.lock.write():
+            self.save(s)
+            return s.pruneAttachments(self.config['filename'])
+
+    def revisions(self, entry, storage=None):
+        ''' The saved revisions of entry, newest first. '''
+        if not entry.entry_id:
+            return []
+        s = storage or self.makeStorage()
+        return s.revisions(self.config['filename'], entry.entry_id)
+
+    def deletedEntries(self, storage=None):
+        ''' The last revision of each deleted entry, newest first. '''
+        s = storage or self.makeStorage()
+        return s.deletedEntries(self.config['filename'])
+
+    def revisionEntry(self, revision_id, storage=None):
+        ''' The entry as a revision saved it. Marked modified, so adding it
+            back to the journal and saving brings a deleted entry back. '''
+        s = storage or self.makeStorage()
+        entry = s.revisionEntry(self.config['filename'], revision_id)
+        entry.modified = True
+        return entry
+
+    def restoreRevision(self, entry, revision_id, storage=None):
+        ''' Put entry back the way a revision saved it. The next save records
+            that as a revision of its own, so nothing is lost. '''
+        old = self.revisionEntry(revision_id, storage)
+        self.updateEntry(entry,
+                         title=old.title,
+                         body=old.body,
+                         date_published=old.date_published,
+                         tags=old.tags)
+
+    def recompress(self):
+        ''' Start re-encoding the stored bodies with the configured
+            compression on a background thread, and return the thread. '''
+        thread = threading.Thread(target=self.makeStorage().recompress,
+                                  args=(self.config['filename'],),
+                                  name='mentarius-recompress',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def snapshot(self):
+        ''' Return the entries as an immutable tuple that later edits will
+            not touch. '''
+        with self.lock.read():
+            version, entries = self._snapshot
+            if version != self.version:
+                SNAPSHOT_MISSES.inc()
+                entries = tuple(self.entries)
+                self._snapshot = (self.version, entries)
+            else:
+                SNAPSHOT_HITS.inc()
+            return entries
+
+    def insertEntry(self, position, entry):
+        ''' Add a new entry, to be saved even if it is left blank. '''
+        with self.lock.write():
+            entry.modified = True
+            self.entries.insert(position, entry)
+            self.tags.add(entry)
+            self.version += 1
+        ENTRIES.inc()
+        BODY_BYTES.inc(bodySize(entry))
+
+    def removeEntry(self, entry):
+        ''' Drop an entry, queueing it for deletion if it was ever saved. '''
+        with self.lock.write():
+            self.entries.remove(entry)
+            self.tags.discard(entry)
+            if entry.entry_id:
+                self.to_delete.append(entry)
+            self.version += 1
+        ENTRIES.dec()
+        BODY_BYTES.dec(bodySize(entry))
+
+    def dropEntry(self, entry):
+        ''' Forget an entry deleted from the file by another process. '''
+        with self.lock.write():
+            self.entries.remove(entry)
+            self.tags.discard(entry)
+            self.version += 1
+        ENTRIES.dec()
+        BODY_BYTES.dec(bodySize(entry))
+
+    def refreshEntry(self, entry, stored):
+        ''' Make entry what another process saved it as. '''
+        with self.lock.write():
+            size = bodySize(entry)
+            self.tags.discard(entry)
+            for key in ('date_created', 'date_modified', 'date_published',
+                        'title', 'body', 'snippet', 'word_count', 'tags'):
+                setattr(entry, key, getattr(stored, key))
+            self.tags.add(entry)
+            BODY_BYTES.inc(bodySize(entry) - size)
+            entry.modified = False
+            self.version += 1
+
+    def updateEntry(self, entry, **values):
+        ''' Set the given fields of entry. Values it already has are left
+            alone, so writing back an unedited entry neither marks it
+            modified nor invalidates snapshot(). '''
+        with self.lock.write():
+            if 'tags' in values:
+                values['tags'] = normalizeTags(values['tags'])
+            values = dict((k, v) for k, v in values.items()
+                          if getattr(entry, k) != v)
+            if not values:
+                return
+            size = bodySize(entry)
+            if 'tags' in values:
+                self.tags.discard(entry)
+            for key, value in values.items():
+                setattr(entry, key, value)
+            if 'tags' in values:
+                self.tags.add(entry)
+            BODY_BYTES.inc(bodySize(entry) - size)
+            entry.date_modified = datetime.datetime.now()
+            entry.modified = True
+            self.version += 1
+
+    def taggedWith(self, tags):
+        ''' The set of entries carrying every one of tags. '''
+        with self.lock.read():
+            return self.tags.find(tags)
+
+    def tagCounts(self):
+        ''' Each tag in use with how many entries carry it, by name. '''
+        with self.lock.read():
+            return self.tags.counts()
+
+    def dateIndex(self):
+        ''' The published dates in order, and a dict of the entries on each,
+            built once and kept until the journal next changes. '''
+        with self.lock.read():
+            version, dates, by_date = self._dates
+            if version != self.version:
+                by_date = dict()
+                for entry in self.entries:
+                    by_date.setdefault(entry.date_published, []).append(entry)
+                dates = sorted(by_date)
+                self._dates = (self.version, dates, by_date)
+            return dates, by_date
+
+    def publishedOn(self, date):
+        return list(self.dateIndex()[1].get(date, ()))
 
     def publishedDateList(self,
                           month=datetime.date.today().month,
                           year=datetime.date.today().year):
-        pub = [x.date_published
-               for x in self.entries
-               if x.date_published.month == month and x.date_published.year == year]
-        return sorted(list(set(pub)))
+        dates = self.dateIndex()[0]
+        first = datetime.date(year, month, 1)
+        last = datetime.date(year + month // 12, month % 12 + 1, 1)
+        return dates[bisect.bisect_left(dates, first):bisect.bisect_left(dates, last)]
 
     def nextDate(self, date):
-        datelist = list(set([x.date_published for x in self.entries]))
-        datelist.sort()
-        try:
-            founddate = datelist.index(date)
-            nextdate = datelist[founddate + 1]
-        except (IndexError, ValueError):
-            nextdate = self.closestNext(datelist, date)
-
-        return nextdate
+        ''' The first published date after date, or None. '''
+        dates = self.dateIndex()[0]
+        found = bisect.bisect_right(dates, date)
+        return dates[found] if found < len(dates) else None
 
     def previousDate(self, date):
-        datelist = list(set([x.date_published for x in self.entries]))
-        datelist.sort()
-        try:
-            founddate = datelist.index(date)
-            # This stops the negative index wrapping.
-            prevdate = datelist[founddate - 1] if founddate > 0 else None
-        except (IndexError, ValueError):
-            prevdate = self.closestPrevious(datelist, date)
-
-        return prevdate
-
-    def closestNext(self, datelist, date):
-        def deltafunc(x):
-            delta = x - date if x > date else datetime.timedelta.max
-            return delta
-        if date >= datelist[len(datelist) - 1]:
-            return None
-        else:
-            return min(datelist, key=deltafunc)
-
-    def closestPrevious(self, datelist, date):
-        def deltafunc(x):
-            delta = date - x if x < date else datetime.timedelta.max
-            return delta
-        if date <= datelist[0]:
-            return None
-        else:
-            return min(datelist, key=deltafunc)
+        ''' The last published date before date, or None. '''
+        dates = self.dateIndex()[0]
+        found = bisect.bisect_left(dates, date)
+        return dates[found - 1] if found > 0 else None
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' An append-only storage engine.
+
+    A journal is a log of checksummed records. Every save appends the new
+    version of each changed entry and a tombstone for each deleted one, with
+    a single fsync, under an flock() that other processes respect too. Where
+    the live version of each entry sits is kept in an
+    in-memory index, built by replaying the log through mmap and from then on
+    brought up to date by replaying only what was appended since. Once most
+    of a log is dead versions, save() compacts it by copying the live records
+    into a new file. '''
+
+import contextlib
+import datetime
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+import metrics
+from htmlutils import expandHtml, minifyHtml, plainText, snippet
+from journal import Entry
+from storage import (CODECS, CODEC_IDS, CODEC_NONE, LOAD_SECONDS, ROWS_LOADED,
+                     ROWS_SAVED, SAVE_SECONDS, UUID_NAMESPACE, BaseStorage,
+                     entryMatches, registerEngine)
+
+COMPACTIONS = metrics.counter('log.compactions')
+
+# The last byte is the format version. The CRC of a version 1 record leaves
+# out its length; those logs are still read and appended to, and compaction
+# rewrites them as version 2.
+MAGIC = b'MENTLOG\x02'
+MAGICS = {b'MENTLOG\x01': 1, MAGIC: 2}
+
+# Payload length, CRC-32 of the rest of the record, kind and entry id, then
+# the payload itself.
+RECORD = struct.Struct('<IIBq')
+CRC_FIELD = 4
+CRC_START = 8
+
+PUT = 1
+DELETE = 2
+# Written by compaction to carry the highest id ever handed out, so ids of
+# deleted entries are never given to new ones.
+LAST_ID = 3
+KINDS = (PUT, DELETE, LAST_ID)
+
+# Open logs by real path, and the locks that serialise access to each.
+INDEXES = dict()
+LOCKS = dict()
+LOCKS_LOCK = threading.Lock()
+
+
+def checksum(data, offset, end, version=2):
+    ''' The CRC of the record in data from offset to end, all of it but the
+        CRC itself. '''
+    crc = 0 if version == 1 else zlib.crc32(data[offset:offset + CRC_FIELD])
+    return zlib.crc32(data[offset + CRC_START:end], crc)
+
+def record(kind, entry_id, payload=b'', version=2):
+    data = RECORD.pack(len(payload), 0, kind, entry_id) + payload
+    crc = checksum(data, 0, len(data), version)
+    return RECORD.pack(len(payload), crc, kind, entry_id) + payload
+
+def recordEnd(data, offset, size, version=2):
+    ''' Where the record at offset ends, or None unless it is whole and its
+        CRC matches. '''
+    if offset + RECORD.size > size:
+        return None
+    length, crc, kind, entry_id = RECORD.unpack_from(data, offset)
+    end = offset + RECORD.size + length
+    if kind not in KINDS or end > size or checksum(data, offset, end, version) != crc:
+        return None
+    return end
+
+def logUuid(entry):
+    ''' The uuid of an entry saved before the log kept them, which must
+        come out the same every time it is loaded. '''
+    name = '{0}/{1}'.format(entry.date_created.isoformat(), entry.entry_id)
+    return str(uuid.uuid5(UUID_NAMESPACE, name))
+
+
+class LogIndex(object):
+    '''Where the live version of each entry sits in one log file.'''
+    def __init__(self, identity, version):
+        self.identity = identity
+        self.version = version
+        # Everything before size has been replayed and found intact.
+        self.size = len(MAGIC)
+        # entry_id -> (offset, length) of its latest PUT record.
+        self.records = dict()
+        # offset -> published date of the PUT records iterEntries() has
+        # looked at, so ranges after the first cost no decoding.
+        self.dates = dict()
+        self.live = 0
+        self.last_id = 0
+
+
+@registerEngine
+class LogStorage(BaseStorage):
+    name = 'log'
+    description = 'Append-only Log Storage Engine'
+    extensions = ('.mentlog',)
+
+    # Compact a log of at least COMPACT_MIN bytes once this share of it is
+    # taken up by replaced or deleted entries.
+    COMPACT_RATIO = 0.5
+    COMPACT_MIN = 1 << 20
+
+    def __init__(self, compression='zlib', threshold=1024):
+        super().__init__()
+
+        if compression and compression not in CODEC_IDS:
+            raise ValueError('Unknown compression: {0}'.format(compression))
+        self.codec = CODEC_IDS[compression] if compression else CODEC_NONE
+        self.threshold = threshold
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.get('compression', 'zlib'),
+                   config.get('compress_threshold', 1024))
+
+    @contextlib.contextmanager
+    def opened(self, dbfile, write=False):
+        ''' Hold the lock of dbfile and yield its index, brought up to date
+            with whatever has been appended since it was last read. Other
+            processes are kept out by flock(), shared unless write is set,
+            so none of them is ever seen halfway through an append. '''
+        path = os.path.realpath(dbfile)
+        with LOCKS_LOCK:
+            lock = LOCKS.setdefault(path, threading.Lock())
+        with lock:
+            while True:
+                f = open(path, 'rb')
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+                stat = os.fstat(f.fileno())
+                identity = (stat.st_dev, stat.st_ino)
+                # Another process may have compacted the log into a new file
+                # while this one waited for the lock of the old one.
+                current = os.stat(path)
+                if (current.st_dev, current.st_ino) == identity:
+                    break
+                f.close()
+            with f:
+                index = INDEXES.get(path)
+                if (index is None or index.identity != identity
+                        or stat.st_size < index.size):
+                    magic = f.read(len(MAGIC))
+                    if magic not in MAGICS:
+                        raise ValueError('Not a journal log: {0}'.format(dbfile))
+                    index = INDEXES[path] = LogIndex(identity, MAGICS[magic])
+                if stat.st_size > index.size:
+                    self.replay(f, index, stat.st_size)
+                yield index
+
+    def replay(self, f, index, size):
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                offset = index.size
+                while offset < size:
+                    end = recordEnd(view, offset, size, index.version)
+                    if end is None:
+                        # Only a write that never finished, with nothing
+                        # whole after it, may be cut off by the next save.
+                        if any(recordEnd(view, x, size, index.version)
+                               for x in range(offset + 1, size - RECORD.size + 1)):
+                            raise ValueError('Corrupt record at offset {0} of '
+                                             '{1}'.format(offset, f.name))
+                        break
+                    kind, entry_id = RECORD.unpack_from(view, offset)[2:]
+                    if kind == LAST_ID:
+                        # Names no entry, only the highest id handed out.
+                        index.last_id = max(index.last_id, entry_id)
+                        offset = end
+                        continue
+                    old = index.records.pop(entry_id, None)
+                    if old:
+                        index.live -= old[1]
+                        index.dates.pop(old[0], None)
+                    if kind == PUT:
+                        index.records[entry_id] = (offset, end - offset)
+                        index.live += end - offset
+                    index.last_id = max(index.last_id, entry_id)
+                    offset = end
+        # Anything left over is a write that never finished; the next save
+        # cuts it off.
+        index.size = offset
+
+    def encode(self, entry):
+        ''' The PUT payload for entry, and the plain text of its body. '''
+        text = plainText(entry.body)
+        body_format, body = minifyHtml(entry.body)
+        data = body.encode('utf-8')
+        codec = CODEC_NONE
+        if self.codec and len(data) >= self.threshold:
+            packed = CODECS[self.codec][1](data)
+            if len(packed) < len(data):
+                codec, data = self.codec, packed
+        meta = {'date_created': entry.date_created.isoformat(),
+                'date_modified': entry.date_modified.isoformat(),
+                'date_published': entry.date_published.isoformat(),
+                'title': entry.title,
+                'snippet': snippet(text),
+                'word_count': len(text.split()),
+                'format': body_format,
+                'codec': codec,
+                'uuid': entry.uuid,
+                'tags': list(entry.tags)}
+        # json.dumps escapes newlines, so the first one ends the metadata.
+        return json.dumps(meta).encode('utf-8') + b'\n' + data, meta
+
+    def publishedDate(self, data, offset, length):
+        start = offset + RECORD.size
+        split = data.find(b'\n', start, offset + length)
+        return datetime.date.fromisoformat(json.loads(data[start:split])['date_published'])
+
+    def decode(self, data, offset, length, bodies=True):
+        entry_id = RECORD.unpack_from(data, offset)[3]
+        start = offset + RECORD.size
+        end = offset + length
+        split = data.find(b'\n', start, end)
+        meta = json.loads(data[start:split])
+        body = None
+        if bodies:
+            body = data[split + 1:end]
+            if meta['codec']:
+                body = CODECS[meta['codec']][2](body)
+            body = expandHtml(meta['format'], body.decode('utf-8'))
+        entry = Entry(datetime.datetime.fromisoformat(meta['date_created']),
+                      datetime.datetime.fromisoformat(meta['date_modified']),
+                      datetime.date.fromisoformat(meta['date_published']),
+                      entry_id,
+                      meta['title'],
+                      body,
+                      meta['snippet'],
+                      meta['word_count'],
+                      meta.get('uuid'),
+                      meta.get('tags', ()))
+        if entry.uuid is None:
+            entry.uuid = logUuid(entry)
+        return entry
+
+    def new(self, dbfile):
+        path = os.path.realpath(dbfile)
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        INDEXES.pop(path, None)
+
+    def load(self, dbfile, bodies=True):
+        entries = list()
+
+        with LOAD_SECONDS.time():
+            with self.opened(dbfile) as index, open(dbfile, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for offset, length in sorted(index.records.values()):
+                        entries.append(self.decode(data, offset, length, bodies))
+
+        ROWS_LOADED.inc(len(entries))
+        return entries
+
+    def iterEntries(self, dbfile, chunksize=500, start=None, end=None,
+                    text=None, bodies=True):
+        ''' Only the records published between start and end are decoded.
+            They are read through a mapping of the file as it was when the
+            iteration began, which appends and compaction leave alone. '''
+        with contextlib.ExitStack() as stack:
+            with self.opened(dbfile) as index:
+                f = stack.enter_context(open(dbfile, 'rb'))
+                data = stack.enter_context(mmap.mmap(f.fileno(), 0,
+                                                     access=mmap.ACCESS_READ))
+                wanted = list()
+                for entry_id, (offset, length) in index.records.items():
+                    date = index.dates.get(offset)
+                    if date is None:
+                        date = index.dates[offset] = self.publishedDate(data, offset, length)
+                    if (start is None or date >= start) and (end is None or date <= end):
+                        wanted.append((date, entry_id, offset, length))
+            wanted.sort()
+            for date, entry_id, offset, length in wanted:
+                entry = self.decode(data, offset, length, bodies or bool(text))
+                ROWS_LOADED.inc()
+                if text and not entryMatches(entry, text=text):
+                    continue
+                if not bodies:
+                    entry.body = None
+                yield entry
+
+    def loadBodies(self, dbfile, entry_ids):
+        bodies = dict()
+        with self.opened(dbfile) as index, open(dbfile, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for entry_id in entry_ids:
+                    if entry_id in index.records:
+                        offset, length = index.records[entry_id]
+                        bodies[entry_id] = self.decode(data, offset, length).body
+        return bodies
+
+    def count(self, dbfile):
+        with self.opened(dbfile) as index:
+            return len(index.records)
+
+    def save(self, dbfile, entries, to_delete):
+        with SAVE_SECONDS.time():
+            with self.opened(dbfile, write=True) as index:
+                self.appendEntries(dbfile, index, entries, to_delete)
+                if (index.size >= self.COMPACT_MIN
+                        and index.live < index.size * (1 - self.COMPACT_RATIO)):
+                    self.compactLog(dbfile, index)
+        ROWS_SAVED.inc(len(entries) + len(to_delete))
+
+    def appendEntries(self, dbfile, index, entries, to_delete):
+        records = list()
+        metas = list()
+        for entry in entries:
+            if not entry.entry_id:
+                index.last_id += 1
+                entry.entry_id = index.last_id
+            if not entry.uuid:
+                entry.uuid = str(uuid.uuid4())
+            payload, meta = self.encode(entry)
+            records.append(record(PUT, entry.entry_id, payload, index.version))
+            metas.append(meta)
+        for entry in to_delete:
+            records.append(record(DELETE, entry.entry_id, version=index.version))
+
+        with open(dbfile, 'r+b') as f:
+            f.truncate(index.size)
+            f.seek(index.size)
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+            self.replay(f, index, f.tell())
+
+        for entry, meta in zip(entries, metas):
+            entry.snippet = meta['snippet']
+            entry.word_count = meta['word_count']
+            entry.modified = False
+
+    def compact(self, dbfile):
+        ''' Rewrite dbfile with only the live version of each entry. '''
+        with self.opened(dbfile, write=True) as index:
+            self.compactLog(dbfile, index)
+
+    def compactLog(self, dbfile, index):
+        path = os.path.realpath(dbfile)
+        temp = path + '.compact'
+        with open(path, 'rb') as f, open(temp, 'wb') as out:
+            out.write(MAGIC)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length in sorted(index.records.values()):
+                    # Checksummed again, in case the log is an older version.
+                    kind, entry_id = RECORD.unpack_from(data, offset)[2:]
+                    out.write(record(kind, entry_id,
+                                     data[offset + RECORD.size:offset + length]))
+            out.write(record(LAST_ID, index.last_id))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temp, path)
+
+        directory = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        # The next call replays the new file from the start.
+        INDEXES.pop(path, None)
+        COMPACTIONS.inc()
@@ -1,27 +1,54 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
 import datetime
+import html
+import io
+import mimetypes
+import os
 import sqlite3
 
-from PyQt5.QtCore import (pyqtSignal, pyqtSlot, QAbstractTableModel, QDate,
-                          QItemSelection, QMetaObject, QModelIndex, QSize,
-                          QSortFilterProxyModel, Qt, QUrl)
-from PyQt5.QtGui import (QFont, QIcon, QTextCharFormat, QTextCursor,
-                         QTextListFormat)
+from PyQt5.QtCore import (pyqtProperty, pyqtSignal, pyqtSlot,
+                          QAbstractTableModel, QBuffer, QDate, QIODevice,
+                          QItemSelection, QMetaObject, QModelIndex, QObject,
+                          QPointF, QSize, QSortFilterProxyModel, Qt, QThread,
+                          QTimer, QUrl)
+from PyQt5.QtGui import (QFont, QFontMetrics, QIcon, QImageReader, QPalette,
+                         QStaticText, QTextCharFormat, QTextCursor,
+                         QTextDocument, QTextListFormat)
 from PyQt5.QtPrintSupport import QPrintDialog, QPrintPreviewDialog
 from PyQt5.QtWebKitWidgets import QWebView
-from PyQt5.QtWidgets import (QAction, QApplication, QCalendarWidget,
-                             QColorDialog, QComboBox, QDataWidgetMapper,
-                             QDialog, QDockWidget, QFileDialog, QFontComboBox,
+from PyQt5.QtWidgets import (QAbstractItemView, QAction, QApplication,
+                             QCalendarWidget, QColorDialog, QComboBox,
+                             QDataWidgetMapper, QDialog, QDialogButtonBox,
+                             QDockWidget, QFileDialog, QFontComboBox,
                              QGridLayout, QLabel, QLineEdit, QListView,
-                             QMainWindow, QMenu, QMenuBar, QMessageBox,
-                             QSizePolicy, QSpacerItem, QStackedWidget,
-                             QStatusBar, QTextEdit, QToolBar, QVBoxLayout,
-                             QWidget)
+                             QListWidget, QListWidgetItem, QMainWindow,
+                             QMenu, QMenuBar, QMessageBox, QProgressBar,
+                             QPushButton, QSizePolicy, QSpacerItem,
+                             QSplitter, QStackedWidget, QStatusBar, QStyle,
+                             QStyledItemDelegate, QTextBrowser, QTextEdit,
+                             QToolBar, QTreeWidget, QTreeWidgetItem,
+                             QVBoxLayout, QWidget)
 import icons
 
+import backup
+import metrics
 from journal import Entry, Journal
+from storage import EXTENSIONS
+from tags import formatTags, parseTags
+
+FILTER_SECONDS = metrics.histogram('ui.filter_seconds')
+TAG_FILTER_SECONDS = metrics.histogram('ui.tag_filter_seconds')
+SHOW_ENTRIES_SECONDS = metrics.histogram('ui.show_entries_seconds')
+PREVIEW_HITS = metrics.counter('ui.preview_layouts.hits')
+PREVIEW_MISSES = metrics.counter('ui.preview_layouts.misses')
+DOCUMENT_HITS = metrics.counter('ui.documents.hits')
+DOCUMENT_MISSES = metrics.counter('ui.documents.misses')
+PREFETCHED = metrics.counter('ui.prefetched_documents')
+THUMBNAIL_HITS = metrics.counter('ui.thumbnails.hits')
+THUMBNAIL_MISSES = metrics.counter('ui.thumbnails.misses')
 
 
 class EntryTitleText(QLineEdit):
@@ -36,6 +63,252 @@ class EntryTitleText(QLineEdit):
         self.titlechanged.emit()
 
 
+class EntryTagsText(QLineEdit):
+    '''QLineEdit for an entry's tags, separated by commas. The mapper reads
+       and writes them as a list through the tagList property.'''
+    def getTagList(self):
+        return parseTags(self.text())
+
+    def setTagList(self, tags):
+        self.setText(formatTags(tags or []))
+
+    tagList = pyqtProperty('QStringList', fget=getTagList, fset=setTagList)
+
+
+class AttachmentDevice(QIODevice):
+    '''A read-only QIODevice over a journal attachment opened as a file,
+       so Qt reads it from the journal only as it needs it.'''
+    def __init__(self, stream, parent=None):
+        super().__init__(parent)
+        self.stream = stream
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+    def isSequential(self):
+        return False
+
+    def size(self):
+        return len(self.stream)
+
+    def seek(self, pos):
+        super().seek(pos)
+        self.stream.seek(pos)
+        return True
+
+    def readData(self, maxlen):
+        return self.stream.read(maxlen)
+
+    def writeData(self, data):
+        return -1
+
+    def close(self):
+        super().close()
+        self.stream.close()
+
+
+class EntryBodyText(QTextEdit):
+    '''QTextEdit that keeps the parsed documents of recently shown entries.
+
+       The mapper reads and writes the body through the entryHtml property.
+       Showing an entry whose document is cached, and whose body has not
+       changed since, swaps that document back in instead of parsing the
+       HTML again, so each entry also keeps its own undo history.
+
+       Pasted and dropped images and files are stored as journal attachments
+       and referred to as attachment:ID, rather than inlined into the body.
+       Images are shown as thumbnails, decoded at their display size and
+       kept for the most recently shown attachments.'''
+    CACHE_SIZE = 16
+    THUMBNAIL_CACHE_SIZE = 32
+    THUMBNAIL_WIDTH = 640
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entry = None
+        self.journal = None
+        self.documents = collections.OrderedDict()
+        self.thumbnails = collections.OrderedDict()
+        # Owned here rather than by the text control, which deletes its own
+        # document as soon as another one is set.
+        self.blank = QTextDocument(self)
+        self.blank.setDefaultFont(self.font())
+        self.setDocument(self.blank)
+
+    def cacheDocument(self, html, document, entry=None):
+        if entry is None:
+            entry = self.entry
+        self.documents[entry] = (html, document)
+        self.documents.move_to_end(entry)
+        while len(self.documents) > self.CACHE_SIZE:
+            old_html, old_document = self.documents.popitem(last=False)[1]
+            if old_document is not self.document():
+                old_document.deleteLater()
+
+    def getEntryHtml(self):
+        document = self.document()
+        cached = self.documents.get(self.entry)
+        # An unedited document gives back the body it was made from, rather
+        # than Qt's own rendering of it, which would read as a change.
+        if (cached is not None and cached[1] is document
+                and not document.isModified()):
+            return cached[0]
+        html = self.toHtml()
+        if self.entry is not None:
+            self.cacheDocument(html, document)
+            document.setModified(False)
+        return html
+
+    def setEntryHtml(self, html):
+        if self.entry is None:
+            self.setDocument(self.blank)
+            self.setHtml(html)
+            return
+
+        cached = self.documents.get(self.entry)
+        if cached is not None and cached[0] == html:
+            document = cached[1]
+            if document is not self.document():
+                DOCUMENT_HITS.inc()
+        else:
+            DOCUMENT_MISSES.inc()
+            if cached is not None and cached[1] is not self.document():
+                cached[1].deleteLater()
+            document = QTextDocument(self)
+            document.setDefaultFont(self.blank.defaultFont())
+            document.setHtml(html)
+            document.setModified(False)
+
+        self.cacheDocument(html, document)
+        if document is not self.document():
+            self.setDocument(document)
+            self.textChanged.emit()
+
+    entryHtml = pyqtProperty(str, fget=getEntryHtml, fset=setEntryHtml)
+
+    def showEntry(self, entry):
+        ''' Make entry the one the next value from the mapper belongs to. '''
+        self.entry = entry
+
+    def prefetch(self, entry):
+        ''' Parse entry's body into the cache ahead of it being shown. '''
+        if entry is self.entry or entry.body is None:
+            return
+        cached = self.documents.get(entry)
+        if cached is not None and cached[0] == entry.body:
+            return
+        document = QTextDocument(self)
+        document.setDefaultFont(self.blank.defaultFont())
+        document.setHtml(entry.body)
+        document.setModified(False)
+        self.cacheDocument(entry.body, document, entry)
+        PREFETCHED.inc()
+
+    def reset(self):
+        self.entry = None
+        self.setDocument(self.blank)
+        self.clear()
+
+    def clearDocuments(self):
+        self.reset()
+        for html, document in self.documents.values():
+            document.deleteLater()
+        self.documents.clear()
+        self.thumbnails.clear()
+
+    def loadResource(self, type, url):
+        if type == QTextDocument.ImageResource and url.scheme() == 'attachment':
+            try:
+                attachment_id = int(url.path())
+            except ValueError:
+                return None
+            return self.thumbnail(attachment_id)
+        return super().loadResource(type, url)
+
+    def thumbnail(self, attachment_id):
+        image = self.thumbnails.get(attachment_id)
+        if image is not None:
+            THUMBNAIL_HITS.inc()
+            self.thumbnails.move_to_end(attachment_id)
+            return image
+
+        THUMBNAIL_MISSES.inc()
+        info = self.journal.attachmentInfo(attachment_id)
+        if info is None or not info['mime_type'].startswith('image/'):
+            return None
+        # The reader pulls the image out of the journal as it decodes it,
+        # rather than the whole file being read into memory first.
+        device = AttachmentDevice(self.journal.openAttachment(attachment_id))
+        try:
+            reader = QImageReader(device)
+            size = reader.size()
+            if size.width() > self.THUMBNAIL_WIDTH:
+                # Lets decoders such as JPEG's skip detail that would be
+                # thrown away.
+                reader.setScaledSize(size.scaled(self.THUMBNAIL_WIDTH,
+                                                 size.height(),
+                                                 Qt.KeepAspectRatio))
+            image = reader.read()
+        finally:
+            device.close()
+
+        self.thumbnails[attachment_id] = image
+        while len(self.thumbnails) > self.THUMBNAIL_CACHE_SIZE:
+            self.thumbnails.popitem(last=False)
+        return image
+
+    def canInsertFromMimeData(self, source):
+        return (source.hasImage() or bool(self.localFiles(source))
+                or super().canInsertFromMimeData(source))
+
+    def localFiles(self, source):
+        if not source.hasUrls():
+            return []
+        urls = source.urls()
+        if not all(x.isLocalFile() for x in urls):
+            return []
+        return [x.toLocalFile() for x in urls if os.path.isfile(x.toLocalFile())]
+
+    def insertFromMimeData(self, source):
+        if self.journal is None or 'filename' not in self.journal.config:
+            return super().insertFromMimeData(source)
+
+        try:
+            if source.hasImage():
+                buffer = QBuffer()
+                buffer.open(QBuffer.WriteOnly)
+                source.imageData().save(buffer, 'PNG')
+                data = bytes(buffer.data())
+                attachment_id = self.journal.addAttachment(io.BytesIO(data),
+                                                           len(data),
+                                                           'image/png')
+                self.textCursor().insertHtml(
+                    '<img src="attachment:{0}" />'.format(attachment_id))
+                return
+
+            files = self.localFiles(source)
+            if not files:
+                return super().insertFromMimeData(source)
+            for path in files:
+                self.attachFile(path)
+        except NotImplementedError:
+            super().insertFromMimeData(source)
+
+    def attachFile(self, path):
+        ''' Store the file at path as an attachment, streaming it, and
+            insert it as an image or else as a link. '''
+        mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as f:
+            attachment_id = self.journal.addAttachment(f,
+                                                       os.fstat(f.fileno()).st_size,
+                                                       mime_type)
+        if mime_type.startswith('image/'):
+            self.textCursor().insertHtml(
+                '<img src="attachment:{0}" />'.format(attachment_id))
+        else:
+            self.textCursor().insertHtml(
+                '<a href="attachment:{0}">{1}</a>'.format(attachment_id,
+                                                          html.escape(os.path.basename(path))))
+
+
 class EntryEdit(QWidget):
     '''Widget for handling the editing of single entries.'''
     def __init__(self, parent=None):
@@ -61,9 +334,19 @@ class EntryEdit(QWidget):
         self.titletext.setMaxLength(255)
         self.edit_layout.addWidget(self.titletext, 2, 1, 1, 1)
 
-        self.bodytext = QTextEdit(self)
+        self.tagslabel = QLabel(self)
+        self.tagslabel.setObjectName("entry_tagslabel")
+        self.tagslabel.setText("Tags:")
+        self.edit_layout.addWidget(self.tagslabel, 3, 0, 1, 1)
+
+        self.tagstext = EntryTagsText(self)
+        self.tagstext.setObjectName("entry_tagstext")
+        self.tagstext.setPlaceholderText('Separated by commas')
+        self.edit_layout.addWidget(self.tagstext, 3, 1, 1, 1)
+
+        self.bodytext = EntryBodyText(self)
         self.bodytext.setObjectName("entry_bodytext")
-        self.edit_layout.addWidget(self.bodytext, 3, 0, 1, 2)
+        self.edit_layout.addWidget(self.bodytext, 4, 0, 1, 2)
 
         self.initActions()
         self.initToolbars()
@@ -486,7 +769,8 @@ class EntryWidget(QWidget):
 
     def reset(self):
         self.entry_editpage.titletext.clear()
-        self.entry_editpage.bodytext.clear()
+        self.entry_editpage.tagstext.clear()
+        self.entry_editpage.bodytext.reset()
         self.entry_viewpage.viewer.setUrl(QUrl("about:blank"))
 
     def toggleEntry(self):
@@ -614,16 +898,17 @@ class EntryCalendar(QDockWidget):
 
     @pyqtSlot()
     def showEntries(self):
-        pubdates = self.parent().journal.publishedDateList(self.calendar.monthShown(),
-                                                           self.calendar.yearShown())
-        self.calendar.setDateTextFormat(QDate(), QTextCharFormat())
+        with SHOW_ENTRIES_SECONDS.time():
+            pubdates = self.parent().journal.publishedDateList(self.calendar.monthShown(),
+                                                               self.calendar.yearShown())
+            self.calendar.setDateTextFormat(QDate(), QTextCharFormat())
 
-        dateformat = QTextCharFormat()
-        dateformat.setFontWeight(QFont.Bold)
+            dateformat = QTextCharFormat()
+            dateformat.setFontWeight(QFont.Bold)
 
-        for d in pubdates:
-            pub = QDate(d.year, d.month, d.day)
-            self.calendar.setDateTextFormat(pub, dateformat)
+            for d in pubdates:
+                pub = QDate(d.year, d.month, d.day)
+                self.calendar.setDateTextFormat(pub, dateformat)
 
 
 class EntryListModel(QAbstractTableModel):
@@ -633,6 +918,9 @@ class EntryListModel(QAbstractTableModel):
         self.__entries = entries
         self.columns = sorted(list(vars(Entry()).keys()))
 
+    def entry(self, row):
+        return self.__entries[row]
+
     def columnCount(self, parent=QModelIndex()):
         return len(self.columns)
 
@@ -651,9 +939,7 @@ class EntryListModel(QAbstractTableModel):
         if index.isValid() and role == Qt.EditRole:
             attr_name = self.columns[index.column()]
             row = self.__entries[index.row()]
-            setattr(row, attr_name, value)
-            setattr(row, 'date_modified', datetime.datetime.now())
-            setattr(row, 'modified', True)
+            self.parent().journal.updateEntry(row, **{attr_name: value})
             self.dataChanged.emit(index, index)
             return True
         return False
@@ -664,21 +950,42 @@ class EntryListModel(QAbstractTableModel):
         sel_date = self.parent().dock_calendar.calendar.selectedDate().toPyDate()
 
         for i in range(rows):
-            self.__entries.insert(position, Entry(date_published=sel_date))
+            self.parent().journal.insertEntry(position,
+                                              Entry(date_published=sel_date))
 
         self.endInsertRows()
         return True
 
+    def appendEntries(self, entries):
+        if not entries:
+            return
+        position = len(self.__entries)
+        self.beginInsertRows(QModelIndex(), position, position + len(entries) - 1)
+        self.parent().journal.appendEntries(entries)
+        self.endInsertRows()
+
+    def applyChanges(self, changes):
+        ''' Apply what Journal.externalChanges() found, row by row. '''
+        journal = self.parent().journal
+        rows = dict()
+        if changes['updated'] or changes['removed']:
+            rows = dict((id(x), i) for i, x in enumerate(self.__entries))
+        for entry, stored in changes['updated']:
+            journal.refreshEntry(entry, stored)
+            row = rows[id(entry)]
+            self.dataChanged.emit(self.index(row, 0),
+                                  self.index(row, len(self.columns) - 1))
+        for row in sorted((rows[id(x)] for x in changes['removed']), reverse=True):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            journal.dropEntry(self.__entries[row])
+            self.endRemoveRows()
+        self.appendEntries(changes['added'])
+
     def removeRows(self, position, rows, parent=QModelIndex()):
         self.beginRemoveRows(parent, position, position + rows - 1)
 
         for i in range(rows):
-            obj = self.__entries[position]
-            if obj.entry_id:
-                index = self.__entries.index(obj)
-                self.parent().journal.to_delete.append(self.__entries.pop(index))
-            else:
-                self.__entries.remove(obj)
+            self.parent().journal.removeEntry(self.__entries[position])
 
         self.endRemoveRows()
         return True
@@ -688,8 +995,37 @@ class EntryListModel(QAbstractTableModel):
 
 
 class EntryFilterProxy(QSortFilterProxyModel):
-    '''Filter entries based on date, showing the correct ones in EntryList.'''
+    '''Filter entries based on date, showing the correct ones in EntryList,
+       or while tags are chosen in the TagList, those carrying all of them
+       whatever their date.'''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.tags = set()
+        # The entries with all of tags, as the journal's tag index found
+        # them, while the whole list is being filtered.
+        self.tagged = None
+
+    def setTags(self, tags, tagged):
+        ''' Show the entries carrying every one of tags, which are tagged;
+            no tags goes back to filtering by date. '''
+        self.tags = set(tags)
+        self.tagged = tagged
+        self.invalidateFilter()
+        # Rows filtered again later, after an edit, may have been retagged
+        # since, so those are checked against their own tags.
+        self.tagged = None
+
+    def clearTags(self):
+        ''' Stop filtering by tag, leaving the caller to filter again. '''
+        self.tags = set()
+        self.tagged = None
+
     def filterAcceptsRow(self, sourceRow, sourceParent):
+        if self.tags:
+            entry = self.sourceModel().entry(sourceRow)
+            if self.tagged is not None:
+                return entry in self.tagged
+            return self.tags.issubset(entry.tags)
         index = self.sourceModel().index(sourceRow,
                                          self.filterKeyColumn(),
                                          sourceParent)
@@ -697,6 +1033,96 @@ class EntryFilterProxy(QSortFilterProxyModel):
         return (self.filterRegExp().indexIn(data.strftime('%Y-%m-%d')) >= 0)
 
 
+class EntryPreviewDelegate(QStyledItemDelegate):
+    '''Draws an entry in EntryList as its title, date, word count and snippet.
+
+       Every row is the same height so the view only asks for the rows it
+       shows, and the prepared text of recently drawn rows is kept, keyed by
+       what it shows and the width it was laid out for.'''
+    MARGIN = 4
+    CACHE_SIZE = 256
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.layouts = collections.OrderedDict()
+
+    def entryValues(self, index):
+        # Ask the Python model directly, so dates stay datetime.date.
+        proxy = index.model()
+        source = proxy.sourceModel()
+        row = proxy.mapToSource(index).row()
+        return [source.data(source.index(row, source.columns.index(name)),
+                            Qt.DisplayRole)
+                for name in ('title', 'date_published', 'word_count', 'snippet')]
+
+    def fonts(self, option):
+        titlefont = QFont(option.font)
+        titlefont.setBold(True)
+        smallfont = QFont(option.font)
+        smallfont.setPointSizeF(option.font.pointSizeF() * 0.85)
+        return titlefont, smallfont
+
+    def sizeHint(self, option, index):
+        titlefont, smallfont = self.fonts(option)
+        height = (QFontMetrics(titlefont).height() +
+                  2 * QFontMetrics(smallfont).height() +
+                  2 * self.MARGIN)
+        return QSize(option.rect.width(), height)
+
+    def layout(self, option, index):
+        title, date, words, snippet = self.entryValues(index)
+        width = option.rect.width() - 2 * self.MARGIN
+        key = (title, date, words, snippet, width, option.font.key())
+
+        texts = self.layouts.get(key)
+        if texts is not None:
+            PREVIEW_HITS.inc()
+            self.layouts.move_to_end(key)
+            return texts
+        PREVIEW_MISSES.inc()
+
+        titlefont, smallfont = self.fonts(option)
+        titlemetrics = QFontMetrics(titlefont)
+        smallmetrics = QFontMetrics(smallfont)
+
+        meta = '{0} \u00b7 {1} words'.format(date.strftime('%a %d %b %Y'), words)
+        texts = list()
+        lines = ((title or '(Untitled Entry)', titlefont, titlemetrics),
+                 (meta, smallfont, smallmetrics),
+                 (snippet, smallfont, smallmetrics))
+        for text, font, fontmetrics in lines:
+            static = QStaticText(fontmetrics.elidedText(text, Qt.ElideRight, width))
+            static.setTextFormat(Qt.PlainText)
+            static.prepare(font=font)
+            texts.append((static, font, fontmetrics.height()))
+
+        self.layouts[key] = texts
+        if len(self.layouts) > self.CACHE_SIZE:
+            self.layouts.popitem(last=False)
+        return texts
+
+    def paint(self, painter, option, index):
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawPrimitive(QStyle.PE_PanelItemViewItem, option, painter, option.widget)
+
+        if option.state & QStyle.State_Selected:
+            color = option.palette.color(QPalette.HighlightedText)
+        else:
+            color = option.palette.color(QPalette.Text)
+
+        painter.save()
+        painter.setPen(color)
+        x = option.rect.x() + self.MARGIN
+        y = option.rect.y() + self.MARGIN
+        for i, (static, font, height) in enumerate(self.layout(option, index)):
+            if i == 1:
+                painter.setOpacity(0.7)
+            painter.setFont(font)
+            painter.drawStaticText(QPointF(x, y), static)
+            y += height
+        painter.restore()
+
+
 class EntryList(QDockWidget):
     '''A dockwidget that displays a list of entries for a given date referenced
        by the EntryCalendar.'''
@@ -719,6 +1145,9 @@ class EntryList(QDockWidget):
         sizePolicy.setHeightForWidth(self.entrylist.sizePolicy().hasHeightForWidth())
         self.entrylist.setSizePolicy(sizePolicy)
 
+        self.plain_delegate = self.entrylist.itemDelegate()
+        self.preview_delegate = EntryPreviewDelegate(self.entrylist)
+
         self.dock_widget_layout.addWidget(self.toolbar)
         self.dock_widget_layout.addWidget(self.entrylist)
 
@@ -740,15 +1169,480 @@ class EntryList(QDockWidget):
                                         statusTip='Delete the selected entry',
                                         triggered=self.parent().delete_entry)
 
+        self.act_previews = QAction('Entry &Previews',
+                                    self,
+                                    checkable=True,
+                                    statusTip='Show the date, length and opening '
+                                              'words of each entry in the list',
+                                    toggled=self.setPreviews)
+
     def initToolbars(self):
         self.toolbar.setIconSize(QSize(24, 24))
 
         self.toolbar.addAction(self.act_new_entry)
         self.toolbar.addAction(self.act_delete_entry)
 
+    @pyqtSlot(bool)
+    def setPreviews(self, enabled):
+        if enabled:
+            self.entrylist.setItemDelegate(self.preview_delegate)
+        else:
+            self.entrylist.setItemDelegate(self.plain_delegate)
+        self.entrylist.setUniformItemSizes(enabled)
+        self.entrylist.setAlternatingRowColors(enabled)
+        self.entrylist.doItemsLayout()
+
+
+class TagList(QDockWidget):
+    '''A dock widget listing the tags in use, with how many entries carry
+       each. Choosing some shows the entries that carry all of them.'''
+    tagsChanged = pyqtSignal(list)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle('Tags')
+        self.counts = None
+
+        self.dock_widget = QWidget(self)
+        self.dock_widget_layout = QVBoxLayout(self.dock_widget)
+        self.dock_widget_layout.setSpacing(0)
+        self.dock_widget_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.toolbar = QToolBar()
+
+        self.taglist = QListWidget(self.dock_widget)
+        self.taglist.setSelectionMode(QAbstractItemView.MultiSelection)
+        self.taglist.itemSelectionChanged.connect(self.on_selection)
+
+        self.dock_widget_layout.addWidget(self.toolbar)
+        self.dock_widget_layout.addWidget(self.taglist)
+
+        self.setWidget(self.dock_widget)
+
+        self.act_clear = QAction('&Clear',
+                                 self,
+                                 statusTip='Show entries by date again',
+                                 triggered=self.taglist.clearSelection)
+        self.toolbar.addAction(self.act_clear)
+
+    def selectedTags(self):
+        return sorted(x.data(Qt.UserRole) for x in self.taglist.selectedItems())
+
+    def showTags(self, counts):
+        ''' List counts, pairs of tag and entry count, keeping the chosen
+            tags chosen. '''
+        if counts == self.counts:
+            return
+        self.counts = counts
+        selected = set(self.selectedTags())
+        self.taglist.blockSignals(True)
+        self.taglist.clear()
+        for tag, count in counts:
+            item = QListWidgetItem('{0} ({1})'.format(tag, count), self.taglist)
+            item.setData(Qt.UserRole, tag)
+            item.setSelected(tag in selected)
+        self.taglist.blockSignals(False)
+        # A chosen tag no entry carries any more drops out of the filter.
+        if len(self.selectedTags()) != len(selected):
+            self.on_selection()
+
+    def deselect(self):
+        ''' Clear the chosen tags without telling anyone. '''
+        self.taglist.blockSignals(True)
+        self.taglist.clearSelection()
+        self.taglist.blockSignals(False)
+
+    @pyqtSlot()
+    def on_selection(self):
+        self.tagsChanged.emit(self.selectedTags())
+
+
+class JournalLoader(QThread):
+    '''Reads a journal on a worker thread, handing the entries over in chunks.
+
+       The entries published in the given month come first, after which
+       ready is emitted, so the calendar can be used while the rest of the
+       journal is still arriving. A journal that cannot be read emits failed
+       with the reason, which is kept in error.'''
+    loaded = pyqtSignal(list)
+    ready = pyqtSignal()
+    progress = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, storage, filename, month, year, bodies=True, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.filename = filename
+        self.bodies = bodies
+        self.cancelled = False
+
+        self.first = datetime.date(year, month, 1)
+        self.last = (self.first + datetime.timedelta(days=31)).replace(day=1)
+        # Where the change log was before reading, for Journal.seq.
+        self.seq = 0
+        self.error = None
+        # The journal open before this one, to go back to if it fails.
+        self.previous = None
+
+    def cancel(self):
+        # Qt clears its own interruption flag when the thread finishes, so
+        # keep one that can still be read afterwards.
+        self.cancelled = True
+        self.requestInterruption()
+
+    def run(self):
+        # Whatever the engine raises on a file that is not a journal, or a
+        # damaged one, has to be caught here or it is lost with the thread.
+        try:
+            self.read()
+        except Exception as e:
+            self.error = str(e) or e.__class__.__name__
+            self.failed.emit(self.error)
+
+    def read(self):
+        self.seq = self.storage.sequence(self.filename)
+        total = self.storage.count(self.filename)
+        done = 0
+        self.progress.emit(done, total)
+        day = datetime.timedelta(days=1)
+        ranges = ((self.first, self.last - day),
+                  (None, self.first - day),
+                  (self.last, None))
+        for i, (start, end) in enumerate(ranges):
+            entries = self.storage.iterEntries(self.filename,
+                                               self.CHUNK_SIZE,
+                                               start,
+                                               end,
+                                               bodies=self.bodies)
+            try:
+                chunk = list()
+                for entry in entries:
+                    chunk.append(entry)
+                    if len(chunk) < self.CHUNK_SIZE:
+                        continue
+                    if self.isInterruptionRequested():
+                        return
+                    self.loaded.emit(chunk)
+                    done += len(chunk)
+                    self.progress.emit(done, total)
+                    chunk = list()
+                if chunk:
+                    self.loaded.emit(chunk)
+                    done += len(chunk)
+                    self.progress.emit(done, total)
+            finally:
+                entries.close()
+            if i == 0:
+                self.ready.emit()
+
+
+class JournalWatcher(QObject):
+    '''Notices saves to the open journal by other processes and emits
+       changed. SQLite journals are polled with PRAGMA data_version on a
+       connection kept open for it, which costs next to nothing; journals
+       whose engine cannot tell are not watched.'''
+    changed = pyqtSignal()
+
+    INTERVAL = 1000
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.storage = None
+        self.filename = None
+        self.version = None
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+
+    def watch(self, journal):
+        self.stop()
+        filename = journal.config.get('filename')
+        if not filename:
+            return
+        storage = journal.makeStorage()
+        storage.open(filename)
+        self.version = storage.dataVersion(filename)
+        if self.version is None:
+            storage.close()
+            return
+        self.storage = storage
+        self.filename = filename
+        self.timer.start(journal.config.get('watch_interval', self.INTERVAL))
+
+    def stop(self):
+        self.timer.stop()
+        if self.storage:
+            self.storage.close()
+            self.storage = None
+
+    @pyqtSlot()
+    def poll(self):
+        version = self.storage.dataVersion(self.filename)
+        if version != self.version:
+            self.version = version
+            self.changed.emit()
+
+
+class BackupThread(QThread):
+    '''Runs backup.backup() for one journal off the GUI thread.'''
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, filename, directory, keep, parent=None):
+        super().__init__(parent)
+        self.filename = filename
+        self.directory = directory
+        self.keep = keep
+
+    def report(self, remaining, total):
+        if self.isInterruptionRequested():
+            raise InterruptedError('Backup cancelled')
+        self.progress.emit(total - remaining, total)
+
+    def run(self):
+        try:
+            path = backup.backup(self.filename, self.directory, self.keep,
+                                 progress=self.report)
+        except InterruptedError:
+            return
+        except (OSError, sqlite3.Error, NotImplementedError) as e:
+            self.failed.emit(str(e))
+            return
+        self.done.emit(path)
+
+
+class BackupScheduler(QObject):
+    '''Backs the open journal up every backup_interval minutes of its
+       config (0 turns this off), keeping the newest backup_keep backups in
+       backup_dir. The copy runs on a BackupThread, a few pages at a time,
+       so editing and saving carry on while it does. Journals whose engine
+       cannot back up online are left alone.'''
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, journal, parent=None):
+        super().__init__(parent)
+        self.journal = journal
+        self.thread = None
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.start)
+
+    def supported(self):
+        return (bool(self.journal.config.get('filename'))
+                and self.journal.makeStorage().online_backup)
+
+    def watch(self):
+        ''' Schedule backups of the journal now open. Returns False if its
+            engine cannot back it up. '''
+        self.timer.stop()
+        if not self.supported():
+            return False
+        interval = self.journal.config.get('backup_interval', 60)
+        if interval:
+            self.timer.start(int(interval * 60000))
+        return True
+
+    def running(self):
+        return self.thread is not None and self.thread.isRunning()
+
+    @pyqtSlot()
+    def start(self):
+        ''' Back the journal up now, unless there is none open or a backup
+            is already running. '''
+        filename = self.journal.config.get('filename')
+        if not self.supported() or self.running():
+            return False
+        self.thread = BackupThread(filename,
+                                   self.journal.config.get('backup_dir'),
+                                   self.journal.config.get('backup_keep', 7),
+                                   self)
+        self.thread.progress.connect(self.progress)
+        self.thread.done.connect(self.done)
+        self.thread.failed.connect(self.failed)
+        self.thread.finished.connect(self.finish)
+        self.thread.start()
+        return True
+
+    @pyqtSlot()
+    def finish(self):
+        ''' Let go of a backup thread once it has stopped. Until then the
+            scheduler keeps it, so running() never asks a deleted one. '''
+        thread = self.sender()
+        if thread is self.thread:
+            self.thread = None
+        thread.deleteLater()
+
+    def cancel(self):
+        if self.running():
+            self.thread.requestInterruption()
+            self.thread.wait()
+
+
+class EntryPrefetcher(QObject):
+    '''Reads in and parses the entries of the published dates either side of
+       the selected one while the event loop is idle, one entry per pass, so
+       stepping through the calendar finds them already in the editor's
+       document cache.'''
+    def __init__(self, window):
+        super().__init__(window)
+        self.window = window
+        self.date = None
+        self.queue = collections.deque()
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.step)
+
+    def schedule(self, date):
+        self.date = date
+        self.queue.clear()
+        self.timer.start()
+
+    def cancel(self):
+        self.date = None
+        self.queue.clear()
+        self.timer.stop()
+
+    def neighbours(self, date):
+        journal = self.window.journal
+        entries = list()
+        if journal.entries:
+            for found in (journal.nextDate(date), journal.previousDate(date)):
+                if found:
+                    entries.extend(journal.publishedOn(found))
+        # Leave room in the cache for the entries of the date being shown.
+        return entries[:EntryBodyText.CACHE_SIZE // 2]
+
+    @pyqtSlot()
+    def step(self):
+        if self.date is not None:
+            self.queue.extend(self.neighbours(self.date))
+            self.window.journal.fetchBodies(self.queue)
+            self.date = None
+        elif self.queue:
+            self.window.main_entry.entry_editpage.bodytext.prefetch(self.queue.popleft())
+        else:
+            self.timer.stop()
+
+
+class RevisionDialog(QDialog):
+    '''Lists saved revisions, shows the one selected and lets it be
+       restored. revision_id holds the choice once the dialog is accepted.'''
+    def __init__(self, journal, revisions, title, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle(title)
+        self.resize(800, 500)
+        self.journal = journal
+        self.revision_id = None
+
+        self.revision_list = QTreeWidget(self)
+        self.revision_list.setColumnCount(3)
+        self.revision_list.setHeaderLabels(['Saved', 'Date', 'Title'])
+        self.revision_list.setRootIsDecorated(False)
+        for revision in revisions:
+            item = QTreeWidgetItem(self.revision_list,
+                                   [revision['date_saved'].strftime('%Y-%m-%d %H:%M'),
+                                    revision['date_published'].isoformat(),
+                                    revision['title'] or '(Untitled Entry)'])
+            item.setData(0, Qt.UserRole, revision['revision_id'])
+
+        self.preview = QTextBrowser(self)
+
+        splitter = QSplitter(self)
+        splitter.addWidget(self.revision_list)
+        splitter.addWidget(self.preview)
+        splitter.setStretchFactor(1, 1)
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Close, self)
+        self.restore_button = self.buttons.addButton('&Restore',
+                                                     QDialogButtonBox.AcceptRole)
+        self.restore_button.setEnabled(False)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(splitter)
+        layout.addWidget(self.buttons)
+
+        self.revision_list.currentItemChanged.connect(self.showRevision)
+        self.revision_list.setCurrentItem(self.revision_list.topLevelItem(0))
+
+    @pyqtSlot(QTreeWidgetItem, QTreeWidgetItem)
+    def showRevision(self, item, previous=None):
+        if item is None:
+            self.revision_id = None
+            self.preview.clear()
+        else:
+            self.revision_id = item.data(0, Qt.UserRole)
+            entry = self.journal.revisionEntry(self.revision_id)
+            self.preview.setHtml(entry.body)
+        self.restore_button.setEnabled(self.revision_id is not None)
+
+
+class MetricsPanel(QDockWidget):
+    '''A dockwidget listing the live values in the metrics registry.'''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle('Performance')
+
+        self.tree = QTreeWidget(self)
+        self.tree.setColumnCount(2)
+        self.tree.setHeaderLabels(['Metric', 'Value'])
+        self.tree.setRootIsDecorated(False)
+        self.setWidget(self.tree)
+
+        self.items = dict()
+
+        # Only poll while someone is looking.
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.on_visibility)
+
+    @pyqtSlot(bool)
+    def on_visibility(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    @pyqtSlot()
+    def refresh(self):
+        for name, value in metrics.registry.snapshot().items():
+            if isinstance(value, dict):
+                if 'p50' in value and value['count']:
+                    value = 'n={0}  mean={1:.2f}ms  p90={2:.2f}ms  max={3:.2f}ms'.format(
+                        value['count'], value['mean'] * 1000,
+                        value['p90'] * 1000, value['max'] * 1000)
+                else:
+                    value = 'n=0'
+            elif name.endswith('.hit_rate'):
+                value = '-' if value is None else '{0:.1%}'.format(value)
+            elif name.endswith('_bytes'):
+                value = '{0:,.1f} KiB'.format(value / 1024)
+            else:
+                value = '{0:,}'.format(value)
+
+            item = self.items.get(name)
+            if item is None:
+                item = QTreeWidgetItem(self.tree, [name, value])
+                self.items[name] = item
+                self.tree.sortItems(0, Qt.AscendingOrder)
+            else:
+                item.setText(1, value)
+
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()
 
         self.setObjectName("main_window")
@@ -769,7 +1663,14 @@ class MainWindow(QMainWindow):
 
         self.setCentralWidget(self.main_widget)
 
-        self.journal = Journal()
+        self.journal = Journal(config)
+        self.main_entry.entry_editpage.bodytext.journal = self.journal
+        self.prefetcher = EntryPrefetcher(self)
+        self.backups = BackupScheduler(self.journal, self)
+        self.watcher = JournalWatcher(self)
+        self.watcher.changed.connect(self.reload_changes)
+        self.loader = None
+        self.filtering = False
 
         self.initActions()
         self.initDocks()
@@ -825,6 +1726,29 @@ class MainWindow(QMainWindow):
                                 statusTip='Save Journal',
                                 triggered=self.save_journal)
 
+        self.act_prune = QAction('&Remove Unused Attachments',
+                                 self,
+                                 statusTip='Save, then delete the attachments '
+                                           'no entry refers to',
+                                 triggered=self.prune_attachments)
+
+        self.act_backup = QAction('&Back Up Now',
+                                  self,
+                                  statusTip='Back the journal up while it '
+                                            'stays open',
+                                  triggered=self.backup_journal)
+
+        self.act_history = QAction('&History...',
+                                   self,
+                                   statusTip='Browse and restore saved '
+                                             'versions of the selected entry',
+                                   triggered=self.entry_history)
+
+        self.act_deleted = QAction('&Deleted Entries...',
+                                   self,
+                                   statusTip='Browse and restore deleted entries',
+                                   triggered=self.deleted_entries)
+
     def initDocks(self):
         self.dock_calendar = EntryCalendar(self)
         self.addDockWidget(Qt.DockWidgetArea(Qt.RightDockWidgetArea),
@@ -834,6 +1758,23 @@ class MainWindow(QMainWindow):
         self.addDockWidget(Qt.DockWidgetArea(Qt.RightDockWidgetArea),
                            self.dock_entrylist)
 
+        self.dock_tags = TagList(self)
+        self.addDockWidget(Qt.DockWidgetArea(Qt.RightDockWidgetArea),
+                           self.dock_tags)
+        self.dock_tags.tagsChanged.connect(self.filterTags)
+
+        # Tag counts are brought up to date once the model has settled,
+        # rather than on every row it reports changed.
+        self.tag_timer = QTimer(self)
+        self.tag_timer.setSingleShot(True)
+        self.tag_timer.setInterval(0)
+        self.tag_timer.timeout.connect(self.refreshTags)
+
+        self.dock_metrics = MetricsPanel(self)
+        self.addDockWidget(Qt.DockWidgetArea(Qt.BottomDockWidgetArea),
+                           self.dock_metrics)
+        self.dock_metrics.hide()
+
     def initMenus(self):
         self.main_menubar = QMenuBar(self)
         self.main_menubar.setObjectName("main_menubar")
@@ -844,14 +1785,29 @@ class MainWindow(QMainWindow):
         self.menu_file.addAction(self.act_new)
         self.menu_file.addAction(self.act_open)
         self.menu_file.addAction(self.act_save)
+        self.menu_file.addAction(self.act_backup)
+        self.menu_file.addAction(self.act_prune)
         self.menu_file.addSeparator()
         self.menu_file.addAction(self.act_quit)
 
+        self.menu_entry = QMenu(self.main_menubar)
+        self.menu_entry.setObjectName("menu_entry")
+        self.menu_entry.setTitle("&Entry")
+        self.menu_entry.addAction(self.dock_entrylist.act_new_entry)
+        self.menu_entry.addAction(self.dock_entrylist.act_delete_entry)
+        self.menu_entry.addSeparator()
+        self.menu_entry.addAction(self.act_history)
+        self.menu_entry.addAction(self.act_deleted)
+
         self.menu_view = QMenu(self.main_menubar)
         self.menu_view.setObjectName("menu_view")
         self.menu_view.setTitle("&View")
         self.menu_view.addAction(self.dock_calendar.toggleViewAction())
         self.menu_view.addAction(self.dock_entrylist.toggleViewAction())
+        self.menu_view.addAction(self.dock_tags.toggleViewAction())
+        self.menu_view.addAction(self.dock_metrics.toggleViewAction())
+        self.menu_view.addSeparator()
+        self.menu_view.addAction(self.dock_entrylist.act_previews)
 
         self.menu_help = QMenu(self.main_menubar)
         self.menu_help.setObjectName("menu_help")
@@ -860,6 +1816,7 @@ class MainWindow(QMainWindow):
         self.menu_help.addAction(self.act_about)
 
         self.main_menubar.addMenu(self.menu_file)
+        self.main_menubar.addMenu(self.menu_entry)
         self.main_menubar.addMenu(self.menu_view)
         self.main_menubar.addMenu(self.menu_help)
 
@@ -870,8 +1827,12 @@ class MainWindow(QMainWindow):
         self.entrymodel.rowsInserted.connect(self.dock_calendar.showEntries)
         self.entrymodel.rowsMoved.connect(self.dock_calendar.showEntries)
         self.entrymodel.rowsRemoved.connect(self.dock_calendar.showEntries)
+        for signal in (self.entrymodel.rowsInserted, self.entrymodel.rowsRemoved,
+                       self.entrymodel.dataChanged):
+            signal.connect(self.tag_timer.start)
 
         bodycol = self.entrymodel.columns.index('body')
+        tagscol = self.entrymodel.columns.index('tags')
         titlecol = self.entrymodel.columns.index('title')
         datepubcol = self.entrymodel.columns.index('date_published')
 
@@ -885,8 +1846,12 @@ class MainWindow(QMainWindow):
         self.entrymapper.setModel(self.entryproxy)
         self.entrymapper.addMapping(self.main_entry.entry_editpage.titletext,
                                     titlecol)
+        self.entrymapper.addMapping(self.main_entry.entry_editpage.tagstext,
+                                    tagscol,
+                                    b'tagList')
         self.entrymapper.addMapping(self.main_entry.entry_editpage.bodytext,
-                                    bodycol)
+                                    bodycol,
+                                    b'entryHtml')
 
         self.dock_calendar.calendar.selectionChanged.connect(self.filterDates)
 
@@ -895,12 +1860,34 @@ class MainWindow(QMainWindow):
         self.dock_entrylist.entrylist.selectionModel().selectionChanged.connect(self.updateEntryWidget)
 
         self.main_entry.entry_editpage.titletext.titlechanged.connect(self.entrymapper.submit)
+        self.main_entry.entry_editpage.tagstext.editingFinished.connect(self.entrymapper.submit)
+
+        self.dock_tags.deselect()
+        self.refreshTags()
 
     def initStatusBar(self):
         self.main_statusbar = QStatusBar(self)
         self.main_statusbar.setObjectName("main_statusbar")
         self.main_statusbar.showMessage("Ready.")
 
+        self.load_progress = QProgressBar(self.main_statusbar)
+        self.load_progress.setMaximumWidth(200)
+        self.load_progress.hide()
+        self.load_cancel = QPushButton('Cancel', self.main_statusbar)
+        self.load_cancel.clicked.connect(self.cancel_loading)
+        self.load_cancel.hide()
+        self.main_statusbar.addPermanentWidget(self.load_progress)
+        self.main_statusbar.addPermanentWidget(self.load_cancel)
+
+        self.backup_progress = QProgressBar(self.main_statusbar)
+        self.backup_progress.setMaximumWidth(120)
+        self.backup_progress.setFormat('Backup %p%')
+        self.backup_progress.hide()
+        self.main_statusbar.addPermanentWidget(self.backup_progress)
+        self.backups.progress.connect(self.on_backup_progress)
+        self.backups.done.connect(self.on_backup_done)
+        self.backups.failed.connect(self.on_backup_failed)
+
         self.setStatusBar(self.main_statusbar)
 
     def about(self):
@@ -918,9 +1905,21 @@ class MainWindow(QMainWindow):
             self.main_entry.reset()
             self.main_entry.setEnabled(False)
         else:
-            self.entrymapper.submit()
+            # The entry list changes selection while it is filtered again,
+            # and the filter slots have submitted the entry already.
+            if not self.filtering:
+                self.entrymapper.submit()
             self.main_entry.setEnabled(True)
-            self.entrymapper.setCurrentModelIndex(item.indexes()[0])
+            self.showEntry(item.indexes()[0])
+
+    def showEntry(self, index):
+        ''' Map the entry at a proxy index into the entry widgets. '''
+        entry = None
+        if index.isValid():
+            entry = self.entrymodel.entry(self.entryproxy.mapToSource(index).row())
+            self.journal.fetchBodies([entry])
+        self.main_entry.entry_editpage.bodytext.showEntry(entry)
+        self.entrymapper.setCurrentModelIndex(index)
 
     def new_entry(self):
         newrow = self.entrymodel.rowCount()
@@ -930,13 +1929,48 @@ class MainWindow(QMainWindow):
         newindex = self.entryproxy.mapFromSource(self.entrymodel.index(newrow,
                                                                        titlecol))
         self.dock_entrylist.entrylist.setCurrentIndex(newindex)
-        self.entrymapper.setCurrentModelIndex(newindex)
+        self.showEntry(newindex)
 
     def delete_entry(self):
         index = self.entryproxy.mapToSource(self.dock_entrylist.entrylist.currentIndex())
         self.entrymapper.submit()
         self.entrymodel.removeRows(index.row(), 1)
-        self.entrymapper.setCurrentModelIndex(self.dock_entrylist.entrylist.currentIndex())
+        self.showEntry(self.dock_entrylist.entrylist.currentIndex())
+
+    def entry_history(self):
+        index = self.dock_entrylist.entrylist.currentIndex()
+        if not index.isValid():
+            return
+        self.entrymapper.submit()
+        row = self.entryproxy.mapToSource(index).row()
+        entry = self.entrymodel.entry(row)
+
+        revisions = self.journal.revisions(entry)
+        if not revisions:
+            QMessageBox.information(self, 'Entry History',
+                                    'This entry has no saved history.')
+            return
+        dialog = RevisionDialog(self.journal, revisions,
+                                'History of {0}'.format(entry), self)
+        if dialog.exec_() == QDialog.Accepted:
+            self.journal.restoreRevision(entry, dialog.revision_id)
+            self.entrymodel.dataChanged.emit(
+                self.entrymodel.index(row, 0),
+                self.entrymodel.index(row, self.entrymodel.columnCount() - 1))
+            self.showEntry(self.dock_entrylist.entrylist.currentIndex())
+
+    def deleted_entries(self):
+        revisions = self.journal.deletedEntries()
+        if not revisions:
+            QMessageBox.information(self, 'Deleted Entries',
+                                    'No entries have been deleted.')
+            return
+        dialog = RevisionDialog(self.journal, revisions, 'Deleted Entries', self)
+        if dialog.exec_() == QDialog.Accepted:
+            entry = self.journal.revisionEntry(dialog.revision_id)
+            self.entrymapper.submit()
+            self.entrymodel.appendEntries([entry])
+            self.dock_calendar.calendar.setSelectedDate(QDate(entry.date_published))
 
     def new_journal(self):
         filename, _ = QFileDialog.getSaveFileName(self, 'Create New Journal')
@@ -944,49 +1978,281 @@ class MainWindow(QMainWindow):
         if not filename:
             return
 
-        if not filename.endswith('.mentdb'):
+        if os.path.splitext(filename)[1].lower() not in EXTENSIONS:
             filename += '.mentdb'
 
         self.journal.new(filename)
         self.resetAll()
+        self.watcher.watch(self.journal)
+        self.schedule_backups()
 
     def open_journal(self):
+        patterns = ' '.join('*' + x for x in sorted(EXTENSIONS))
         filename, _ = QFileDialog.getOpenFileName(self,
                                                   'Open Journal',
                                                   '.',
-                                                  '(*.mentdb)')
+                                                  'Journals ({0})'.format(patterns))
 
         if not filename:
             return
 
+        self.stream_journal(filename)
+
+    def load_journal(self, filename):
+        self.prefetcher.cancel()
+        self.watcher.stop()
         self.journal.load(filename)
+        self.main_entry.entry_editpage.bodytext.clearDocuments()
         self.initModels()
         self.dock_calendar.showEntries()
+        self.watcher.watch(self.journal)
+        self.schedule_backups()
+        self.journal.recompress()
+
+    def stream_journal(self, filename):
+        ''' Open filename on a worker thread, filling the entry list as the
+            entries arrive, those of the month on the calendar first. '''
+        self.cancel_loading()
+        if self.loader:
+            self.loader.wait()
+            self.loader.deleteLater()
+
+        self.prefetcher.cancel()
+        self.watcher.stop()
+        previous = self.journal.config.get('filename')
+        self.journal.attach(filename)
+        self.main_entry.entry_editpage.bodytext.clearDocuments()
+        self.initModels()
+        # Marking the calendar once per chunk would rescan the journal each
+        # time; it is redrawn when the month is in and again at the end.
+        self.entrymodel.rowsInserted.disconnect(self.dock_calendar.showEntries)
+
+        calendar = self.dock_calendar.calendar
+        storage = self.journal.makeStorage()
+        self.loader = JournalLoader(storage,
+                                    filename,
+                                    calendar.monthShown(),
+                                    calendar.yearShown(),
+                                    not self.journal.lazyBodies(storage),
+                                    self)
+        self.loader.previous = previous
+        self.loader.loaded.connect(self.on_load_chunk)
+        self.loader.failed.connect(self.on_load_failed)
+        self.loader.progress.connect(self.on_load_progress)
+        self.loader.ready.connect(self.on_load_ready)
+        self.loader.finished.connect(self.on_load_finished)
+
+        self.load_progress.setRange(0, 0)
+        self.load_progress.show()
+        self.load_cancel.show()
+        self.main_statusbar.showMessage('Opening {0}...'.format(filename))
+        self.loader.start()
+
+    @pyqtSlot()
+    def cancel_loading(self):
+        if self.loader and self.loader.isRunning():
+            self.loader.cancel()
+
+    # Signals a replaced loader queued before it stopped may still arrive, so
+    # each handler checks that it is hearing from the current one.
+
+    @pyqtSlot(list)
+    def on_load_chunk(self, entries):
+        if self.sender() is self.loader:
+            self.entrymodel.appendEntries(entries)
+
+    @pyqtSlot(int, int)
+    def on_load_progress(self, done, total):
+        if self.sender() is self.loader:
+            self.load_progress.setRange(0, total)
+            self.load_progress.setValue(done)
+
+    @pyqtSlot()
+    def on_load_ready(self):
+        if self.sender() is self.loader:
+            self.dock_calendar.showEntries()
+            self.filterDates()
+
+    @pyqtSlot(str)
+    def on_load_failed(self, message):
+        if self.sender() is self.loader:
+            text = 'Could not open {0}:\n\n{1}'.format(self.loader.filename, message)
+            QMessageBox.warning(self, 'Open Journal', text)
+
+    @pyqtSlot()
+    def on_load_finished(self):
+        if self.sender() is not self.loader:
+            return
+        self.load_progress.hide()
+        self.load_cancel.hide()
+        filename = self.journal.config['filename']
+        if self.loader.cancelled or self.loader.error is not None:
+            self.journal.attach(None)
+            self.initModels()
+            self.resetAll()
+            self.schedule_backups()
+            if self.loader.cancelled:
+                self.main_statusbar.showMessage('Opening {0} was cancelled.'.format(filename))
+            elif self.loader.previous:
+                self.stream_journal(self.loader.previous)
+            else:
+                self.main_statusbar.showMessage('Could not open {0}.'.format(filename))
+            return
+
+        self.entrymodel.rowsInserted.connect(self.dock_calendar.showEntries)
+        self.dock_calendar.showEntries()
+        self.main_statusbar.showMessage('Opened {0}.'.format(filename))
+        # Bring in whatever was saved while the entries were being read.
+        self.journal.seq = self.loader.seq
+        self.watcher.watch(self.journal)
+        self.schedule_backups()
+        self.reload_changes()
+        self.journal.recompress()
+
+    def closeEvent(self, event):
+        self.cancel_loading()
+        if self.loader:
+            self.loader.wait()
+        self.backups.cancel()
+        self.watcher.stop()
+        super().closeEvent(event)
 
     def resetAll(self):
         self.main_entry.reset()
         self.dock_calendar.reset()
 
+    def prune_attachments(self):
+        self.entrymapper.submit()
+        try:
+            count = self.journal.pruneAttachments()
+        except (PermissionError, ValueError, sqlite3.Error) as e:
+            QMessageBox.warning(self, 'Remove Unused Attachments', str(e))
+            return
+        self.main_statusbar.showMessage('Removed {0} unused '
+                                        'attachments.'.format(count), 5000)
+
+    def schedule_backups(self):
+        supported = self.backups.watch()
+        self.act_backup.setEnabled(supported)
+        if not supported and self.journal.config.get('filename'):
+            self.main_statusbar.showMessage('Backups are off: {0} journals cannot '
+                                            'be backed up online.'.format(
+                                                self.journal.makeStorage().name),
+                                            10000)
+
+    def backup_journal(self):
+        if not self.backups.start():
+            self.main_statusbar.showMessage('No backup started: no journal is '
+                                            'open, or a backup is running.', 5000)
+
+    @pyqtSlot(int, int)
+    def on_backup_progress(self, done, total):
+        self.backup_progress.setRange(0, max(total, 1))
+        self.backup_progress.setValue(done)
+        self.backup_progress.show()
+
+    @pyqtSlot(str)
+    def on_backup_done(self, path):
+        self.backup_progress.hide()
+        self.main_statusbar.showMessage('Backed up to {0}.'.format(path), 5000)
+
+    @pyqtSlot(str)
+    def on_backup_failed(self, message):
+        self.backup_progress.hide()
+        self.main_statusbar.showMessage('Backup failed: {0}'.format(message), 10000)
+
+    @pyqtSlot()
+    def reload_changes(self):
+        ''' Bring in entries another process saved to the journal file. '''
+        if self.loader and self.loader.isRunning():
+            return
+        # Edits still only in the editor count as unsaved changes, so they
+        # are kept rather than reloaded over.
+        editpage = self.main_entry.entry_editpage
+        if editpage.bodytext.document().isModified() or editpage.tagstext.isModified():
+            self.entrymapper.submit()
+        changes = self.journal.externalChanges()
+        count = sum(len(changes[x]) for x in ('updated', 'added', 'removed'))
+        if count:
+            self.entrymodel.applyChanges(changes)
+            self.dock_calendar.showEntries()
+            self.main_statusbar.showMessage('Reloaded {0} entries changed by '
+                                            'another program.'.format(count), 5000)
+        conflicts = changes['conflicts']
+        if conflicts:
+            titles = '\n'.join(str(x) for x in conflicts[:10])
+            if len(conflicts) > 10:
+                titles += '\n(and {0} more)'.format(len(conflicts) - 10)
+            QMessageBox.warning(self, 'Entries Changed Elsewhere',
+                                'Another program saved changes to entries you '
+                                'have unsaved changes to:\n\n{0}\n\nYour '
+                                'changes are kept. Saving replaces the other '
+                                'version, which stays in the entry\'s '
+                                'history.'.format(titles))
+
     def save_journal(self):
-        self.journal.save()
+        try:
+            self.journal.save()
+        except (PermissionError, ValueError) as e:
+            QMessageBox.warning(self, 'Save Journal', str(e))
 
     @pyqtSlot()
     def filterDates(self):
         self.entrymapper.submit()
         sel_date = self.dock_calendar.calendar.selectedDate()
-        self.entryproxy.setFilterRegExp(sel_date.toString(Qt.ISODate))
+        # Picking a date leaves the tag view for that date's entries.
+        if self.entryproxy.tags:
+            self.entryproxy.clearTags()
+            self.dock_tags.deselect()
+        self.filtering = True
+        try:
+            with FILTER_SECONDS.time():
+                self.entryproxy.setFilterRegExp(sel_date.toString(Qt.ISODate))
+        finally:
+            self.filtering = False
+        self.showFirstEntry()
+        self.prefetcher.schedule(sel_date.toPyDate())
+
+    @pyqtSlot(list)
+    def filterTags(self, tags):
+        if not tags:
+            self.filterDates()
+            return
+        self.entrymapper.submit()
+        self.filtering = True
+        try:
+            with TAG_FILTER_SECONDS.time():
+                self.entryproxy.setTags(tags, self.journal.taggedWith(tags))
+        finally:
+            self.filtering = False
+        self.showFirstEntry()
+
+    @pyqtSlot()
+    def refreshTags(self):
+        self.dock_tags.showTags(self.journal.tagCounts())
+
+    def showFirstEntry(self):
         if self.entryproxy.rowCount() > 0:
             titlecol = self.entrymodel.columns.index('title')
             firstindex = self.entryproxy.index(0, titlecol)
             self.dock_entrylist.entrylist.setCurrentIndex(firstindex)
-            self.entrymapper.setCurrentModelIndex(firstindex)
+            self.showEntry(firstindex)
 
 
 if __name__ == '__main__':
     import sys
 
-    app = QApplication(sys.argv)
-    mentarius = MainWindow()
+    import profiling
+
+    config, argv = profiling.parseArgs(sys.argv[1:])
+    targets = profiling.coreTargets()
+    targets.update({MainWindow: ('filterDates',),
+                    EntryCalendar: ('showEntries',),
+                    EntryWidget: ('updateViewer',)})
+    profiling.install(targets, config)
+
+    app = QApplication(sys.argv[:1] + argv)
+    mentarius = MainWindow(config)
     mentarius.show()
     sys.exit(app.exec_())
 
@@ -65,11 +65,12 @@ class MentariusCurses():
     driver = None
     selected = -1
 
-    def __init__(self):
+    def __init__(self, config=None):
+        self.config = config
         self.driver = MentariusCursesDriver()
 
     def usage(self):
-        print("Usage: " + sys.argv[0] + " [JOURNAL FILE]")
+        print("Usage: " + sys.argv[0] + " [--profile MODE] [JOURNAL FILE]")
 
     def handleArgs(self):
         numArgs = len(sys.argv)
@@ -88,6 +89,9 @@ class MentariusCurses():
         s2 = ""
         s2 = s2 + ": "
         s2 = s2 + entry.date_created.strftime("%c")
+        room = width - (len(s) + len(s2)) - 4
+        if entry.snippet and room > 10:
+            s = s + " - " + entry.snippet[:room]
         sfill = " " * (width - (len(s) + len(s2)) - 1)
         return s + sfill + s2
 
@@ -116,7 +120,7 @@ class MentariusCurses():
         return self.journal.entries[self.selected].entry_id == entry.entry_id
 
     def journalOpen(self, filename = "journal.mentdb"):
-        self.journal = Journal()
+        self.journal = Journal(self.config)
         self.journal.load(filename)
         self.selected = self.journal.entries[0].entry_id
         pass
@@ -166,8 +170,12 @@ class MentariusCurses():
                 self.redrawSelected(unselected, self.selected)
 
 if __name__ == '__main__':
+    import profiling
+
+    config, sys.argv[1:] = profiling.parseArgs(sys.argv[1:])
+    profiling.install(config=config)
     try:
-        mentarius = MentariusCurses()
+        mentarius = MentariusCurses(config)
         mentarius.main()
     finally:
         mentarius.driver.cleanup();
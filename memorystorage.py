@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' A storage engine keeping journals in memory.
+
+    Nothing is read from or written to disk, so benchmarks and tests running
+    against it see only the CPU cost of the journal and its storage. Journals
+    are shared by every MemoryStorage in the process, by name, and last until
+    dropped or the process ends. Names starting with ":memory:" select this
+    engine. '''
+
+import copy
+import threading
+
+from htmlutils import plainText, snippet
+from storage import (LOAD_SECONDS, ROWS_LOADED, ROWS_SAVED, SAVE_SECONDS,
+                     BaseStorage, entryMatches, registerEngine)
+
+# Journals by name.
+JOURNALS = dict()
+JOURNALS_LOCK = threading.Lock()
+
+
+class MemoryJournal(object):
+    '''The saved entries of one journal, by entry id.'''
+    def __init__(self):
+        self.entries = dict()
+        # The plain text of each body, kept for search as sqlite3 keeps
+        # body_text.
+        self.texts = dict()
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+
+@registerEngine
+class MemoryStorage(BaseStorage):
+    name = 'memory'
+    description = 'In-memory Storage Engine'
+    prefixes = (':memory:',)
+
+    def journal(self, dbfile):
+        with JOURNALS_LOCK:
+            try:
+                return JOURNALS[dbfile]
+            except KeyError:
+                raise FileNotFoundError('No journal in memory: {0}'.format(dbfile))
+
+    def exists(self, dbfile):
+        with JOURNALS_LOCK:
+            return dbfile in JOURNALS
+
+    def new(self, dbfile):
+        with JOURNALS_LOCK:
+            JOURNALS[dbfile] = MemoryJournal()
+
+    def drop(self, dbfile):
+        ''' Forget the journal dbfile. '''
+        with JOURNALS_LOCK:
+            JOURNALS.pop(dbfile, None)
+
+    def load(self, dbfile, bodies=True):
+        journal = self.journal(dbfile)
+        with LOAD_SECONDS.time(), journal.lock:
+            entries = [copy.copy(x) for x in journal.entries.values()]
+        if not bodies:
+            for entry in entries:
+                entry.body = None
+        ROWS_LOADED.inc(len(entries))
+        return entries
+
+    def loadBodies(self, dbfile, entry_ids):
+        journal = self.journal(dbfile)
+        with journal.lock:
+            return dict((x, journal.entries[x].body)
+                        for x in entry_ids if x in journal.entries)
+
+    def iterEntries(self, dbfile, chunksize=500, start=None, end=None,
+                    text=None, bodies=True):
+        journal = self.journal(dbfile)
+        text = text.lower() if text else None
+        with journal.lock:
+            entries = [x for x in journal.entries.values()
+                       if entryMatches(x, start, end)
+                       and (not text or text in x.title.lower()
+                            or text in journal.texts[x.entry_id])]
+        entries.sort(key=lambda x: (x.date_published, x.entry_id))
+        for entry in entries:
+            entry = copy.copy(entry)
+            if not bodies:
+                entry.body = None
+            yield entry
+
+    def count(self, dbfile):
+        return len(self.journal(dbfile).entries)
+
+    def save(self, dbfile, entries, to_delete):
+        journal = self.journal(dbfile)
+        with SAVE_SECONDS.time(), journal.lock:
+            for entry in entries:
+                if not entry.entry_id:
+                    journal.last_id += 1
+                    entry.entry_id = journal.last_id
+                else:
+                    journal.last_id = max(journal.last_id, entry.entry_id)
+                text = plainText(entry.body)
+                entry.snippet = snippet(text)
+                entry.word_count = len(text.split())
+                entry.modified = False
+                journal.entries[entry.entry_id] = copy.copy(entry)
+                journal.texts[entry.entry_id] = text.lower()
+            for entry in to_delete:
+                journal.entries.pop(entry.entry_id, None)
+                journal.texts.pop(entry.entry_id, None)
+        ROWS_SAVED.inc(len(entries) + len(to_delete))
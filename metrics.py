@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import bisect
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+class Counter(object):
+    '''A value that only goes up.'''
+    kind = 'counter'
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    '''A value that is set, or moved up and down, as state changes.'''
+    kind = 'gauge'
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    '''Counts observations into fixed buckets, by default doubling from one
+       microsecond to a couple of minutes, which suits durations in seconds.'''
+    kind = 'histogram'
+
+    BOUNDS = [1e-6 * 2 ** i for i in range(28)]
+
+    def __init__(self, name, bounds=None):
+        self.name = name
+        self.bounds = bounds or self.BOUNDS
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def percentile(self, p):
+        '''Upper bound of the bucket holding the p-th observation.'''
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                if i < len(self.bounds):
+                    return max(self.min, min(self.bounds[i], self.max))
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(0.50),
+                'p90': self.percentile(0.90),
+                'p99': self.percentile(0.99)}
+
+
+class Registry(object):
+    '''Holds metrics by name, creating them on first use.'''
+    def __init__(self):
+        self.metrics = dict()
+        self._lock = threading.Lock()
+
+    def get(self, cls, name):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(name, cls(name))
+        if not isinstance(metric, cls):
+            raise TypeError('{0} is a {1}, not a {2}'.format(name,
+                                                             metric.kind,
+                                                             cls.kind))
+        return metric
+
+    def counter(self, name):
+        return self.get(Counter, name)
+
+    def gauge(self, name):
+        return self.get(Gauge, name)
+
+    def histogram(self, name):
+        return self.get(Histogram, name)
+
+    def hitRate(self, name):
+        '''Share of hits for a cache counting into NAME.hits and NAME.misses.'''
+        hits = self.counter(name + '.hits').value
+        misses = self.counter(name + '.misses').value
+        return hits / (hits + misses) if hits + misses else None
+
+    def snapshot(self):
+        '''All metrics as plain values, plus a NAME.hit_rate for every cache
+           that counts hits and misses.'''
+        result = dict((name, metric.snapshot())
+                      for name, metric in sorted(self.metrics.items()))
+        for name in list(result):
+            if name.endswith('.hits'):
+                cache = name[:-len('.hits')]
+                result[cache + '.hit_rate'] = self.hitRate(cache)
+        return result
+
+
+registry = Registry()
+
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return '{0:.6g}'.format(value)
+    return str(value)
+
+
+def formatSnapshot(snapshot):
+    lines = list()
+    for name, value in sorted(snapshot.items()):
+        if isinstance(value, dict):
+            value = '  '.join('{0}={1}'.format(k, formatValue(v))
+                              for k, v in value.items())
+        else:
+            value = formatValue(value)
+        lines.append('{0:<32} {1}'.format(name, value))
+    return '\n'.join(lines)
+
+
+def stats(filename=None, socket_path=None):
+    '''Metrics of a running journal server, or of loading filename here.'''
+    if socket_path:
+        from server import JournalClient
+        client = JournalClient(socket_path)
+        try:
+            return client.call('stats')
+        finally:
+            client.close()
+
+    from journal import Journal
+    journal = Journal()
+    with histogram('journal.load_seconds').time():
+        journal.load(filename)
+    return registry.snapshot()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show journal metrics.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    stats_parser = commands.add_parser('stats',
+                                       help='load a journal, or ask a running '
+                                            'server, and print its metrics')
+    stats_parser.add_argument('file', nargs='?')
+    stats_parser.add_argument('--socket', help='ask the server on this socket')
+    stats_parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    if not args.file and not args.socket:
+        stats_parser.error('a journal file or --socket is required')
+
+    # Run against the module the journal and storage code record into, not
+    # the separate copy executing as __main__.
+    import metrics
+
+    result = metrics.stats(args.file, args.socket)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print(metrics.formatSnapshot(result))
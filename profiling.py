@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Opt-in profiling of journal, storage and UI operations.
+
+    Set MENTARIUS_PROFILE to "cprofile" or "tracemalloc" (or pass the same as
+    the "profile" config key, or with --profile to any of the programs) and
+    every call to a wrapped method writes its own dump to
+    MENTARIUS_PROFILE_DIR, by default the current directory.
+    When profiling is off install() returns without touching anything. '''
+
+import argparse
+import cProfile
+import datetime
+import functools
+import itertools
+import os
+import threading
+import tracemalloc
+
+ENV_MODE = 'MENTARIUS_PROFILE'
+ENV_DIR = 'MENTARIUS_PROFILE_DIR'
+
+MODES = ('cprofile', 'tracemalloc')
+
+_counter = itertools.count(1)
+_local = threading.local()
+
+# Tracing is shared by every thread, so it is started by the first run that
+# needs it and stopped only once the last overlapping run is done.
+_tracing_lock = threading.Lock()
+_tracing = {'runs': 0, 'started': False}
+
+
+def dumpPath(directory, name, extension):
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(directory, '{0}-{1}-{2}.{3}'.format(name,
+                                                            stamp,
+                                                            next(_counter),
+                                                            extension))
+
+
+def runCProfile(name, directory, func, args, kwargs):
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats(dumpPath(directory, name, 'prof'))
+
+
+def startTracing():
+    with _tracing_lock:
+        if _tracing['runs'] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            _tracing['started'] = True
+        _tracing['runs'] += 1
+
+
+def stopTracing():
+    ''' Stop tracing once no run needs it, unless it was on before any. '''
+    with _tracing_lock:
+        _tracing['runs'] -= 1
+        if _tracing['runs'] == 0 and _tracing['started']:
+            tracemalloc.stop()
+            _tracing['started'] = False
+
+
+def runTracemalloc(name, directory, func, args, kwargs):
+    startTracing()
+    tracemalloc.reset_peak()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        current, peak = tracemalloc.get_traced_memory()
+        stopTracing()
+        with open(dumpPath(directory, name, 'txt'), 'w') as f:
+            f.write('{0}: current {1} B, peak {2} B\n\n'.format(name, current, peak))
+            for stat in after.compare_to(before, 'lineno')[:50]:
+                f.write('{0}\n'.format(stat))
+
+
+RUNNERS = {'cprofile': runCProfile, 'tracemalloc': runTracemalloc}
+
+
+def profiled(name, func, mode, directory):
+    ''' Wrap func so each outermost call is profiled into its own dump. Calls
+        made while another wrapped call is running on the same thread are
+        already captured by the outer dump and run untouched. '''
+    runner = RUNNERS[mode]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'active', False):
+            return func(*args, **kwargs)
+        _local.active = True
+        try:
+            return runner(name, directory, func, args, kwargs)
+        finally:
+            _local.active = False
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+def coreTargets():
+    from journal import Journal
+    from storage import Sqlite3Storage
+
+    return {Journal: ('new', 'load', 'save'),
+            Sqlite3Storage: ('new', 'load', 'save', 'search')}
+
+
+def parseArgs(argv):
+    ''' Take --profile MODE and --profile-dir DIR out of argv. Returns the
+        config keys they set and the arguments left over. '''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--profile', choices=MODES)
+    parser.add_argument('--profile-dir')
+    args, rest = parser.parse_known_args(argv)
+    config = dict()
+    if args.profile:
+        config['profile'] = args.profile
+    if args.profile_dir:
+        config['profile_dir'] = args.profile_dir
+    return config, rest
+
+
+def install(targets=None, config=None):
+    ''' Wrap the methods named in targets, a dict of class to method names,
+        defaulting to the Journal and Sqlite3Storage operations. Returns
+        whether profiling is on. '''
+    config = config or dict()
+    mode = config.get('profile') or os.environ.get(ENV_MODE)
+    if not mode:
+        return False
+    if mode not in MODES:
+        raise ValueError('Unknown profiling mode: {0}'.format(mode))
+
+    directory = config.get('profile_dir') or os.environ.get(ENV_DIR) or '.'
+    os.makedirs(directory, exist_ok=True)
+
+    for cls, names in (targets or coreTargets()).items():
+        for name in names:
+            func = getattr(cls, name)
+            if getattr(func, '__profiled__', False):
+                continue
+            setattr(cls, name, profiled('{0}.{1}'.format(cls.__name__, name),
+                                        func, mode, directory))
+    return True
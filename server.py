@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import json
+import os
+import socket
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import profiling
+from journal import Entry, Journal
+
+REQUESTS = metrics.counter('server.requests')
+ERRORS = metrics.counter('server.errors')
+REQUEST_SECONDS = metrics.histogram('server.request_seconds')
+
+
+class ServiceError(Exception):
+    '''Raised for requests the journal service cannot fulfil.'''
+    pass
+
+
+class JournalService(object):
+    '''Serves JSON requests against one shared, in-memory Journal.
+
+       Reads run concurrently under the read side of the journal's lock,
+       writes take the write side and are saved through to disk before it is
+       released, so readers never see an entry the file does not have. A
+       write that fails to save is undone by loading the file again.'''
+    def __init__(self, journal):
+        self.journal = journal
+        self.storage = journal.makeStorage()
+        # Bodies a lazy load left on disk are read in by the readers that
+        # return them, which then need the write side of the lock.
+        self.lazy = journal.lazyBodies(self.storage)
+
+        self.readers = {'entries': self.entries,
+                        'entry': self.entry,
+                        'dates': self.dates,
+                        'next_date': self.nextDate,
+                        'previous_date': self.previousDate,
+                        'search': self.search,
+                        'stats': self.stats}
+        self.loaders = set(['entries', 'entry', 'search'])
+        self.writers = {'create': self.create,
+                        'update': self.update,
+                        'delete': self.delete,
+                        'save': self.save}
+
+        # What the running writer added and removed, for by_id once saved.
+        self.added = list()
+        self.removed = list()
+        self.reindex()
+
+    def reindex(self):
+        self.by_id = dict((x.entry_id, x) for x in self.journal.entries)
+
+    def dispatch(self, request):
+        method = request.get('method')
+        params = request.get('params') or dict()
+
+        if method in self.readers:
+            if self.lazy and method in self.loaders:
+                lock = self.journal.lock.write()
+            else:
+                lock = self.journal.lock.read()
+            with lock:
+                return self.readers[method](**params)
+        elif method in self.writers:
+            with self.journal.lock.write():
+                self.added = list()
+                self.removed = list()
+                result = self.writers[method](**params)
+                try:
+                    self.journal.save()
+                except Exception:
+                    self.journal.load(self.journal.config['filename'])
+                    self.reindex()
+                    raise
+                # New entries only have an id once saved.
+                for entry in self.added:
+                    self.by_id[entry.entry_id] = entry
+                for entry in self.removed:
+                    del self.by_id[entry.entry_id]
+                # Encoded before another writer can change the entry.
+                return result.toDict() if isinstance(result, Entry) else result
+        raise ServiceError('Unknown method: {0}'.format(method))
+
+    def handle(self, data):
+        '''Decode one request, run it and return the encoded response.'''
+        request = dict()
+        REQUESTS.inc()
+        try:
+            with REQUEST_SECONDS.time():
+                request = json.loads(data)
+                response = {'result': self.dispatch(request)}
+        except Exception as e:
+            # Anything a request runs into, sqlite3.Error included, is
+            # reported to the client rather than dropping its connection.
+            ERRORS.inc()
+            response = {'error': str(e)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        return json.dumps(response)
+
+    def lookup(self, entry_id):
+        try:
+            return self.by_id[entry_id]
+        except KeyError:
+            raise ServiceError('No entry with id {0}'.format(entry_id))
+
+    def entries(self, date=None, body=False):
+        if date:
+            found = self.journal.publishedOn(datetime.date.fromisoformat(date))
+        else:
+            found = self.journal.entries
+        if body:
+            self.journal.fetchBodies(found, self.storage)
+        result = [x.toDict() for x in found]
+        if not body:
+            for x in result:
+                del x['body']
+        return result
+
+    def entry(self, entry_id):
+        entry = self.lookup(entry_id)
+        self.journal.fetchBodies([entry], self.storage)
+        return entry.toDict()
+
+    def dates(self, month=None, year=None):
+        today = datetime.date.today()
+        return [x.isoformat()
+                for x in self.journal.publishedDateList(month or today.month,
+                                                        year or today.year)]
+
+    def nextDate(self, date):
+        if not self.journal.entries:
+            return None
+        found = self.journal.nextDate(datetime.date.fromisoformat(date))
+        return found.isoformat() if found else None
+
+    def previousDate(self, date):
+        if not self.journal.entries:
+            return None
+        found = self.journal.previousDate(datetime.date.fromisoformat(date))
+        return found.isoformat() if found else None
+
+    def search(self, text):
+        # Every write is saved before its lock is let go, so the engine's
+        # search, over the plain text it keeps, sees what is in memory.
+        found = [self.by_id[x.entry_id]
+                 for x in self.storage.search(self.journal.config['filename'], text)
+                 if x.entry_id in self.by_id]
+        self.journal.fetchBodies(found, self.storage)
+        return [x.toDict() for x in found]
+
+    def stats(self):
+        return metrics.registry.snapshot()
+
+    def create(self, title='', body='', date_published=None):
+        entry = Entry.fromDict({'title': title,
+                                'body': body,
+                                'date_published': date_published})
+        self.journal.insertEntry(len(self.journal.entries), entry)
+        self.added.append(entry)
+        return entry
+
+    def update(self, entry_id, **fields):
+        entry = self.lookup(entry_id)
+        unknown = set(fields) - set(['date_published', 'title', 'body'])
+        if unknown:
+            raise ServiceError('Cannot update: {0}'.format(', '.join(sorted(unknown))))
+        if 'date_published' in fields:
+            fields['date_published'] = datetime.date.fromisoformat(fields['date_published'])
+        self.journal.updateEntry(entry, **fields)
+        return entry
+
+    def delete(self, entry_id):
+        entry = self.lookup(entry_id)
+        self.journal.removeEntry(entry)
+        self.removed.append(entry)
+        return None
+
+    def save(self):
+        return None
+
+
+class UnixRequestHandler(socketserver.StreamRequestHandler):
+    '''Reads newline-delimited JSON requests and answers each on one line.'''
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.service.handle(line.decode('utf-8'))
+            self.wfile.write(response.encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class HTTPRequestHandler(BaseHTTPRequestHandler):
+    '''Accepts a JSON request as the body of a POST to any path.'''
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length).decode('utf-8')
+        response = self.server.service.handle(data).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixJournalServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, UnixRequestHandler)
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class HTTPJournalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, service):
+        super().__init__(('127.0.0.1', port), HTTPRequestHandler)
+        self.service = service
+
+
+class JournalClient(object):
+    '''Talks to a UnixJournalServer, one request per call.'''
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.stream = self.sock.makefile('rwb')
+        self.request_id = 0
+
+    def call(self, method, **params):
+        self.request_id += 1
+        request = {'id': self.request_id, 'method': method, 'params': params}
+        self.stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.stream.flush()
+        response = json.loads(self.stream.readline().decode('utf-8'))
+        if 'error' in response:
+            raise ServiceError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+def serve(filename, socket_path=None, port=None, config=None):
+    journal = Journal(config)
+    journal.load(filename)
+    service = JournalService(journal)
+
+    if port:
+        server = HTTPJournalServer(port, service)
+    else:
+        server = UnixJournalServer(socket_path or filename + '.sock', service)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a journal over JSON.')
+    parser.add_argument('file', help='journal file to serve')
+    parser.add_argument('--socket', help='unix socket path (default: FILE.sock)')
+    parser.add_argument('--port', type=int,
+                        help='serve HTTP on localhost:PORT instead of a socket')
+    parser.add_argument('--profile', choices=profiling.MODES,
+                        help='write a profile of every journal operation')
+    parser.add_argument('--profile-dir', help='where profiles go')
+    args = parser.parse_args()
+
+    config = dict()
+    if args.profile:
+        config['profile'] = args.profile
+    if args.profile_dir:
+        config['profile_dir'] = args.profile_dir
+    profiling.install(config=config)
+    serve(args.file, args.socket, args.port, config)
+    sys.exit(0)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Read-only journal snapshots.
+
+    A snapshot is a journal compiled into one file that is read through mmap
+    without parsing it first. After a header come:
+
+    - the metadata table, one fixed-width ROW per entry, ordered by date
+      published and then entry id;
+    - the date index, the ordinal of each row's date published, for finding
+      a range of dates by bisection;
+    - the id index, (entry id, row) pairs ordered by entry id;
+    - the string heap holding titles and snippets as UTF-8;
+    - the body heap holding each body as Sqlite3Storage stores it, minified
+      and possibly compressed.
+
+    Opening a snapshot only maps it, so it takes the same time whatever its
+    size, and an entry is only decoded when it is asked for. '''
+
+import argparse
+import bisect
+import datetime
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+
+import journal  # storage needs journal imported first
+from htmlutils import expandHtml, minifyHtml, plainText, snippet
+from journal import Entry
+from storage import (CODECS, CODEC_IDS, CODEC_NONE, LOAD_SECONDS, ROWS_LOADED,
+                     BaseStorage, engineFor, entryMatches, registerEngine)
+
+MAGIC = b'MENTSNAP'
+VERSION = 1
+
+# Magic, version, entry count, then the offsets of the metadata table, date
+# index, id index, string heap and body heap.
+HEADER = struct.Struct('<8sIIQQQQQ')
+# Entry id, created and modified (microseconds since datetime.min), date
+# published (ordinal), word count, title, snippet and body (offset and
+# length in their heaps), body format and codec.
+ROW = struct.Struct('<qqqIIQIQIQIBB')
+DATE = struct.Struct('<I')
+ID = struct.Struct('<qI')
+
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Open snapshots by real path.
+SNAPSHOTS = dict()
+SNAPSHOTS_LOCK = threading.Lock()
+
+
+def timestamp(value):
+    return (value - datetime.datetime.min) // MICROSECOND
+
+
+class Column(object):
+    '''The first field of each record in a section, as a sequence bisect
+       can search without copying the section.'''
+    def __init__(self, view, offset, record, count):
+        self.view = view
+        self.offset = offset
+        self.record = record
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.record.unpack_from(self.view, self.offset + i * self.record.size)[0]
+
+
+class Snapshot(object):
+    '''An open snapshot file.'''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        if len(self.view) < HEADER.size:
+            raise ValueError('Not a journal snapshot: {0}'.format(path))
+        (magic, version, self.count, self.rows, dates, ids, self.strings,
+         self.bodies) = HEADER.unpack_from(self.view, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a journal snapshot: {0}'.format(path))
+        if version != VERSION:
+            raise ValueError('Unsupported snapshot version {0}: {1}'.format(version, path))
+
+        self.dates = Column(self.view, dates, DATE, self.count)
+        self.ids = Column(self.view, ids, ID, self.count)
+
+    def string(self, offset, length):
+        start = self.strings + offset
+        return str(self.view[start:start + length], 'utf-8')
+
+    def body(self, offset, length, body_format, body_codec):
+        start = self.bodies + offset
+        data = self.view[start:start + length]
+        if body_codec:
+            data = CODECS[body_codec][2](data)
+        return expandHtml(body_format, str(data, 'utf-8'))
+
+    def rowToEntry(self, row, bodies=True):
+        (entry_id, created, modified, published, word_count,
+         title, title_length, snippet, snippet_length,
+         body, body_length, body_format, body_codec) = row
+        return Entry(datetime.datetime.min + created * MICROSECOND,
+                     datetime.datetime.min + modified * MICROSECOND,
+                     datetime.date.fromordinal(published),
+                     entry_id,
+                     self.string(title, title_length),
+                     self.body(body, body_length, body_format, body_codec) if bodies else None,
+                     self.string(snippet, snippet_length),
+                     word_count)
+
+    def entries(self, first, last, bodies=True):
+        ''' Entries of rows first to last, not including last. '''
+        rows = self.view[self.rows + first * ROW.size:self.rows + last * ROW.size]
+        return [self.rowToEntry(row, bodies) for row in ROW.iter_unpack(rows)]
+
+    def dateRange(self, start=None, end=None):
+        ''' The rows published from start to end, as (first, last). '''
+        first = bisect.bisect_left(self.dates, start.toordinal()) if start else 0
+        last = bisect.bisect_right(self.dates, end.toordinal()) if end else self.count
+        return first, max(first, last)
+
+    def findBody(self, entry_id):
+        i = bisect.bisect_left(self.ids, entry_id)
+        if i == self.count or self.ids[i] != entry_id:
+            return None
+        row = ID.unpack_from(self.view, self.ids.offset + i * ID.size)[1]
+        row = ROW.unpack_from(self.view, self.rows + row * ROW.size)
+        return self.body(*row[9:])
+
+
+def openSnapshot(dbfile):
+    ''' The open Snapshot of dbfile, mapped again if the file was replaced. '''
+    path = os.path.realpath(dbfile)
+    stat = os.stat(path)
+    with SNAPSHOTS_LOCK:
+        snapshot = SNAPSHOTS.get(path)
+        if (snapshot is None
+                or snapshot.identity != (stat.st_ino, stat.st_size, stat.st_mtime_ns)):
+            snapshot = SNAPSHOTS[path] = Snapshot(path)
+        return snapshot
+
+
+def compileSnapshot(dbfile, output, storage=None, compression='zlib',
+                    threshold=1024, chunksize=500):
+    ''' Write the journal dbfile out as a snapshot at output and return how
+        many entries it holds. Entries are read a chunk at a time and the
+        heaps are spooled to temporary files, so memory use stays small. '''
+    storage = storage or engineFor(dbfile)()
+    codec = CODEC_IDS[compression] if compression else CODEC_NONE
+    directory = os.path.dirname(os.path.abspath(output))
+
+    rows = list()
+    dates = list()
+    entry_ids = list()
+    temp = output + '.tmp'
+    with tempfile.TemporaryFile(dir=directory) as strings, \
+            tempfile.TemporaryFile(dir=directory) as bodies:
+        string_size = body_size = 0
+
+        def addString(text):
+            nonlocal string_size
+            data = text.encode('utf-8')
+            strings.write(data)
+            string_size += len(data)
+            return string_size - len(data), len(data)
+
+        for entry in storage.iterEntries(dbfile, chunksize):
+            text = plainText(entry.body)
+            body_format, body = minifyHtml(entry.body)
+            data = body.encode('utf-8')
+            body_codec = CODEC_NONE
+            if codec and len(data) >= threshold:
+                packed = CODECS[codec][1](data)
+                if len(packed) < len(data):
+                    body_codec, data = codec, packed
+            bodies.write(data)
+            body_size += len(data)
+
+            rows.append(ROW.pack(entry.entry_id,
+                                 timestamp(entry.date_created),
+                                 timestamp(entry.date_modified),
+                                 entry.date_published.toordinal(),
+                                 len(text.split()),
+                                 *addString(entry.title),
+                                 *addString(snippet(text)),
+                                 body_size - len(data),
+                                 len(data),
+                                 body_format,
+                                 body_codec))
+            dates.append(entry.date_published.toordinal())
+            entry_ids.append(entry.entry_id)
+
+        count = len(rows)
+        ids = sorted(zip(entry_ids, range(count)))
+
+        offset = HEADER.size
+        sections = list()
+        for size in (ROW.size * count, DATE.size * count, ID.size * count,
+                     string_size):
+            sections.append(offset)
+            offset += size
+        sections.append(offset)
+
+        with open(temp, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, count, *sections))
+            out.write(b''.join(rows))
+            out.write(b''.join(DATE.pack(x) for x in dates))
+            out.write(b''.join(ID.pack(*x) for x in ids))
+            for heap in (strings, bodies):
+                heap.seek(0)
+                shutil.copyfileobj(heap, out)
+            out.flush()
+            os.fsync(out.fileno())
+    os.replace(temp, output)
+    return count
+
+
+@registerEngine
+class SnapshotStorage(BaseStorage):
+    name = 'snapshot'
+    description = 'Read-only Snapshot Storage Engine'
+    extensions = ('.mentsnap',)
+    lazy_bodies = True
+
+    def exists(self, dbfile):
+        return os.access(dbfile, os.R_OK)
+
+    def new(self, dbfile):
+        raise PermissionError('Snapshots are read-only: {0}'.format(dbfile))
+
+    def save(self, dbfile, entries, to_delete):
+        raise PermissionError('Snapshots are read-only: {0}'.format(dbfile))
+
+    def load(self, dbfile, bodies=True):
+        with LOAD_SECONDS.time():
+            snapshot = openSnapshot(dbfile)
+            entries = snapshot.entries(0, snapshot.count, bodies)
+        ROWS_LOADED.inc(len(entries))
+        return entries
+
+    def loadBodies(self, dbfile, entry_ids):
+        snapshot = openSnapshot(dbfile)
+        bodies = dict()
+        for entry_id in entry_ids:
+            body = snapshot.findBody(entry_id)
+            if body is not None:
+                bodies[entry_id] = body
+        return bodies
+
+    def count(self, dbfile):
+        return openSnapshot(dbfile).count
+
+    def iterEntries(self, dbfile, chunksize=500, start=None, end=None,
+                    text=None, bodies=True):
+        snapshot = openSnapshot(dbfile)
+        first, last = snapshot.dateRange(start, end)
+        for offset in range(first, last, chunksize):
+            chunk = snapshot.entries(offset, min(last, offset + chunksize),
+                                     bodies or bool(text))
+            ROWS_LOADED.inc(len(chunk))
+            for entry in chunk:
+                if text and not entryMatches(entry, text=text):
+                    continue
+                if not bodies:
+                    entry.body = None
+                yield entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a journal into a '
+                                                 'read-only snapshot.')
+    parser.add_argument('file', help='journal to compile')
+    parser.add_argument('output', nargs='?',
+                        help='snapshot to write (default: FILE with a '
+                             '.mentsnap extension)')
+    parser.add_argument('--compression', choices=sorted(CODEC_IDS) + ['none'],
+                        default='zlib', help='codec for long bodies')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.file)[0] + '.mentsnap'
+    count = compileSnapshot(args.file, output,
+                            compression=None if args.compression == 'none'
+                            else args.compression)
+    print('Compiled {0} entries into {1}.'.format(count, output), file=sys.stderr)
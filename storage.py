@@ -1,33 +1,902 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import datetime
+import difflib
+import hashlib
+import io
+import itertools
+import json
+import lzma
+import os
+import re
 import sqlite3
+import uuid
+import zlib
 
+import metrics
+from htmlutils import expandHtml, minifyHtml, plainText, snippet
 from journal import Entry
 from utils import file_exists
 
+ROWS_LOADED = metrics.counter('storage.rows_loaded')
+ROWS_SAVED = metrics.counter('storage.rows_saved')
+STATEMENTS = metrics.counter('storage.statements')
+LOAD_SECONDS = metrics.histogram('storage.load_seconds')
+SAVE_SECONDS = metrics.histogram('storage.save_seconds')
+SEARCH_SECONDS = metrics.histogram('storage.search_seconds')
+ATTACHMENT_BYTES = metrics.counter('storage.attachment_bytes_written')
+
+# Body compression codecs by the id stored in body_codec. 0 means the body
+# column holds the text itself.
+CODEC_NONE = 0
+CODECS = {1: ('zlib', zlib.compress, zlib.decompress),
+          2: ('lzma', lzma.compress, lzma.decompress)}
+CODEC_IDS = dict((name, codec) for codec, (name, c, d) in CODECS.items())
+
+# What loading an Entry needs; the derived body_text stays on disk.
+ENTRY_COLUMNS = ('entry_id, date_created, date_modified, date_published, '
+                 'title, body, body_format, body_codec, body_z, snippet, '
+                 'word_count, uuid')
+# What a lazy load() reads, leaving bodies for loadBodies().
+HEADER_COLUMNS = ('entry_id, date_created, date_modified, date_published, '
+                  'title, snippet, word_count, uuid')
+BODY_COLUMNS = 'entry_id, body, body_format, body_codec, body_z'
+
+# What a row of the revisions table holds: the whole body, a delta against
+# the revision before it, or the whole body of an entry as it was deleted.
+REVISION_FULL = 0
+REVISION_DELTA = 1
+REVISION_DELETED = 2
+
+# How a body refers to an attachment, as in <img src="attachment:12" />.
+ATTACHMENT_URL = re.compile(r'\battachment:(\d+)')
+
+# Entries saved before they had uuids are given one derived from when they
+# were created, so copies of the same journal agree on it.
+UUID_NAMESPACE = uuid.UUID('6d656e74-6172-6975-732d-656e74727921')
+
+# Adds a row built by Sqlite3Storage.entryRow().
+INSERT_ENTRY = '''
+    INSERT INTO entries(
+        entry_id,
+        date_created,
+        date_modified,
+        date_published,
+        body,
+        body_format,
+        body_codec,
+        body_z,
+        body_text,
+        snippet,
+        word_count,
+        title,
+        uuid,
+        content_hash
+    )
+    VALUES (:entry_id, :date_created, :date_modified, :date_published,
+            :body, :body_format, :body_codec, :body_z,
+            :body_text, :snippet, :word_count, :title,
+            :uuid, :content_hash)
+'''
+
+# Records the latest change to an entry in the change log, replacing the
+# one before, so the log holds one row per entry ever saved.
+LOG_CHANGE = '''
+    INSERT OR REPLACE INTO changes(uuid, content_hash, date_modified)
+    VALUES (:uuid, :content_hash, :date_modified)
+'''
+
+def countStatement(statement):
+    STATEMENTS.inc()
+
+def likePattern(text):
+    ''' A LIKE pattern, for use with ESCAPE '\\', matching text anywhere. '''
+    return '%{0}%'.format(text.replace('\\', '\\\\')
+                              .replace('%', '\\%')
+                              .replace('_', '\\_'))
+
+def entryFilter(start=None, end=None, text=None):
+    ''' A WHERE clause and its parameters selecting the entries published
+        from start to end inclusive that mention text. Each part is
+        optional. '''
+    clauses = list()
+    params = dict()
+    if start:
+        clauses.append('date_published >= :start')
+        params['start'] = start.isoformat()
+    if end:
+        clauses.append('date_published <= :end')
+        params['end'] = end.isoformat()
+    if text:
+        clauses.append('(title LIKE :pattern ESCAPE \'\\\' '
+                       'OR body_text LIKE :pattern ESCAPE \'\\\')')
+        params['pattern'] = likePattern(text)
+    return ' AND '.join(clauses) or '1', params
+
+def entryMatches(entry, start=None, end=None, text=None):
+    ''' What entryFilter() selects, for engines without SQL. '''
+    if start and entry.date_published < start:
+        return False
+    if end and entry.date_published > end:
+        return False
+    if text:
+        text = text.lower()
+        return text in entry.title.lower() or text in plainText(entry.body).lower()
+    return True
+
+def lineDelta(base, text):
+    ''' A delta rebuilding text from base by lines: a list in which [i, j]
+        copies lines i to j of base and a string is a line of its own. '''
+    base_lines = base.split('\n')
+    lines = text.split('\n')
+    delta = list()
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            delta.extend(lines[j1:j2])
+    return delta
+
+def contentHash(entry):
+    ''' A digest of what entry holds, which copies of it compare by when
+        syncing. The body is minified first, as it is stored, so the digest
+        does not depend on how it was written out. '''
+    body_format, body = minifyHtml(entry.body)
+    parts = [entry.title, entry.date_published.isoformat(), str(body_format), body]
+    # Left out when empty, so entries from before tags keep their digests.
+    if entry.tags:
+        parts.append(','.join(sorted(entry.tags)))
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def createSettingsTable(db):
+    ''' Named values a journal keeps about itself, such as the compression
+        its bodies were last brought in line with. '''
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY ( name )
+        )
+    ''')
+
+def createSyncTables(db):
+    ''' The change log and sync records of a journal, and of anything else
+        that syncs with one.
+
+        changes holds the latest change to each entry, by uuid: its content
+        hash, or NULL once deleted. Every change gets a higher seq than any
+        before it, so "what changed since seq N" is a range query.
+        sync_peers records, for each copy synced with, the seq of both sides
+        when they last agreed. '''
+    db.execute('''
+        CREATE TABLE changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT NOT NULL UNIQUE,
+            content_hash TEXT,
+            date_modified TIMESTAMP NOT NULL
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE sync_peers (
+            identity TEXT NOT NULL,
+            local_seq INTEGER NOT NULL,
+            remote_seq INTEGER NOT NULL,
+            date_synced TIMESTAMP NOT NULL,
+            PRIMARY KEY ( identity )
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE sync_state (
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY ( name )
+        )
+    ''')
+    db.execute('''
+        INSERT INTO sync_state(name, value)
+        VALUES ('identity', ?)
+    ''', (str(uuid.uuid4()),))
+
+def applyDelta(base, delta):
+    base_lines = base.split('\n')
+    lines = list()
+    for op in delta:
+        if isinstance(op, str):
+            lines.append(op)
+        else:
+            lines.extend(base_lines[op[0]:op[1]])
+    return '\n'.join(lines)
+
+# Storage engines by name, and by the file extensions and name prefixes
+# they claim, as registered with registerEngine().
+ENGINES = dict()
+EXTENSIONS = dict()
+PREFIXES = dict()
+
+def registerEngine(cls):
+    ''' Class decorator making a storage engine selectable by its name. '''
+    ENGINES[cls.name] = cls
+    for extension in cls.extensions:
+        EXTENSIONS[extension] = cls
+    for prefix in cls.prefixes:
+        PREFIXES[prefix] = cls
+    return cls
+
+def getEngine(name):
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError('Unknown storage engine: {0}'.format(name))
+
+def engineFor(filename, config=None):
+    ''' The engine for filename: the one named by the engine key of config
+        if there is one, else the one its prefix or extension belongs to,
+        else sqlite3. '''
+    if config and config.get('engine'):
+        return getEngine(config['engine'])
+    if filename:
+        for prefix, cls in PREFIXES.items():
+            if filename.startswith(prefix):
+                return cls
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in EXTENSIONS:
+            return EXTENSIONS[extension]
+    return getEngine('sqlite3')
+
+
+class BlobFile(io.RawIOBase):
+    ''' A read-only file over an open SQLite blob, which reads from the
+        database only as much as is asked for. Closing it runs done. '''
+    def __init__(self, blob, done=None):
+        super().__init__()
+        self.blob = blob
+        self.done = done
+
+    def __len__(self):
+        return len(self.blob)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.blob.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.blob.seek(offset, whence)
+        return self.blob.tell()
+
+    def tell(self):
+        return self.blob.tell()
+
+    def close(self):
+        if not self.closed:
+            self.blob.close()
+            if self.done:
+                self.done()
+        super().close()
+
+
 class BaseStorage(object):
+    ''' What Journal and the tools expect of a storage engine.
+
+        An engine needs new(), load() and save(); everything else has a
+        default here built on those, which an engine can override with
+        something quicker. '''
+    name = None
+    description = None
+    # What engineFor() recognises the engine's journals by.
+    extensions = ()
+    prefixes = ()
+    # Whether journals should be opened with bodies left for loadBodies()
+    # even without the lazy_bodies setting.
+    lazy_bodies = False
+    # Whether backup() can copy a journal while it is open.
+    online_backup = False
+
     def __init__(self):
         pass
 
-    def new(self):
+    @classmethod
+    def fromConfig(cls, config):
+        ''' An engine set up from a journal's config dict. '''
+        return cls()
+
+    def new(self, dbfile):
+        return None
+
+    def load(self, dbfile, bodies=True):
+        return None
+
+    def save(self, dbfile, entries, to_delete):
         return None
 
-    def load(self):
+    def exists(self, dbfile):
+        return file_exists(dbfile)
+
+    def entryRow(self, entry, text=None):
+        ''' What bulkInsert() takes for entry. '''
+        return entry
+
+    def bulkInsert(self, dbfile, rows, batchsize=50000):
+        ''' Add rows built by entryRow(), saving batchsize at a time, and
+            return how many there were. '''
+        count = 0
+        rows = iter(rows)
+        for batch in iter(lambda: list(itertools.islice(rows, batchsize)), []):
+            self.save(dbfile, batch, [])
+            count += len(batch)
+        return count
+
+    def loadBodies(self, dbfile, entry_ids):
+        wanted = set(entry_ids)
+        return dict((x.entry_id, x.body)
+                    for x in self.load(dbfile) if x.entry_id in wanted)
+
+    def count(self, dbfile):
+        return len(self.load(dbfile, bodies=False))
+
+    def recompress(self, dbfile):
+        pass
+
+    def addAttachment(self, dbfile, stream, size, mime_type):
+        raise NotImplementedError('{0} journals cannot hold '
+                                  'attachments'.format(self.name))
+
+    def attachmentInfo(self, dbfile, attachment_id):
         return None
 
-    def save(self):
+    def readAttachment(self, dbfile, attachment_id, chunksize=1 << 16):
+        raise KeyError('No attachment {0}'.format(attachment_id))
+
+    def openAttachment(self, dbfile, attachment_id):
+        raise KeyError('No attachment {0}'.format(attachment_id))
+
+    def pruneAttachments(self, dbfile):
+        return 0
+
+    def backup(self, dbfile, target, pages=256, progress=None):
+        raise NotImplementedError('{0} journals cannot be backed up '
+                                  'online'.format(self.name))
+
+    def check(self, dbfile):
+        ''' Problems found checking the journal file, if any. '''
+        return []
+
+    def revisions(self, dbfile, entry_id):
+        return []
+
+    def revisionEntry(self, dbfile, revision_id):
+        raise KeyError('No revision {0}'.format(revision_id))
+
+    def deletedEntries(self, dbfile):
+        return []
+
+    def open(self, dbfile):
+        pass
+
+    def close(self):
+        pass
+
+    def dataVersion(self, dbfile):
+        ''' A value that changes when another process writes to dbfile, or
+            None if the engine cannot tell. '''
         return None
 
+    def sequence(self, dbfile):
+        ''' How far the journal's change log has got, for changesSince(). '''
+        return 0
+
+    def changesSince(self, dbfile, seq):
+        return []
+
+    def entriesByUuid(self, dbfile, uuids, bodies=True):
+        wanted = set(uuids)
+        return [x for x in self.load(dbfile, bodies) if x.uuid in wanted]
+
+    def iterEntries(self, dbfile, chunksize=500, start=None, end=None,
+                    text=None, bodies=True):
+        entries = self.load(dbfile, bodies or bool(text))
+        entries.sort(key=lambda x: (x.date_published, x.entry_id or 0))
+        for entry in entries:
+            if entryMatches(entry, start, end, text):
+                yield entry
+
+    def search(self, dbfile, text):
+        return list(self.iterEntries(dbfile, text=text))
+
+@registerEngine
 class Sqlite3Storage(BaseStorage):
-    def __init__(self):
+    name = 'sqlite3'
+    description = 'Sqlite3 Storage Engine'
+    extensions = ('.mentdb',)
+    online_backup = True
+
+    # Schema upgrades, oldest first. A journal's PRAGMA user_version records
+    # how many of them it has had; never reorder or remove one.
+    UPGRADES = ('upgradeBodyFormat',
+                'upgradeBodyCodec',
+                'upgradeBodyText',
+                'upgradeDateIndex',
+                'upgradeAttachments',
+                'upgradeRevisions',
+                'upgradeSync',
+                'upgradeTags',
+                'upgradeSettings',
+                'upgradeRevisionAttachments',
+                'upgradeRevisionTags')
+
+    # Every this many revisions of an entry one holds the whole body, so
+    # rebuilding any revision applies fewer deltas than this.
+    REVISION_INTERVAL = 16
+
+    def __init__(self, compression='zlib', threshold=1024):
+        ''' Bodies of at least threshold characters are stored compressed
+            with the named codec, if that makes them smaller. Pass None as
+            compression to store everything as text. '''
         super().__init__()
 
-        self.name = 'sqlite3'
-        self.description = 'Sqlite3 Storage Engine'
+        self.db = None
+        self.upgraded = set()
 
-    def new(self, dbfile):
+        if compression and compression not in CODEC_IDS:
+            raise ValueError('Unknown compression: {0}'.format(compression))
+        self.codec = CODEC_IDS[compression] if compression else CODEC_NONE
+        self.threshold = threshold
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.get('compression', 'zlib'),
+                   config.get('compress_threshold', 1024))
+
+    def open(self, dbfile):
+        ''' Hold one connection open for every following call until close(),
+            instead of connecting per call. The connection belongs to the
+            calling thread. '''
+        self.close()
+        self.db = self.connect(dbfile)
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def connect(self, dbfile):
+        if self.db:
+            return self.db
         db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.row_factory = sqlite3.Row
+        db.set_trace_callback(countStatement)
+        if dbfile not in self.upgraded and self.upgrade(db):
+            self.upgraded.add(dbfile)
+        return db
+
+    def disconnect(self, db):
+        if db is not self.db:
+            db.close()
+
+    def upgrade(self, db):
+        ''' Bring an existing journal up to the current schema. Returns False
+            if db holds no journal yet. '''
+        cur = db.cursor()
+        cur.execute('''
+            SELECT
+                name
+            FROM sqlite_master
+            WHERE type = 'table' AND name = 'entries'
+        ''')
+        if cur.fetchone() is None:
+            return False
+
+        # sqlite3 would run ALTER TABLE outside any transaction, so each
+        # upgrade opens its own, and commits it with the version it reaches:
+        # one cut short leaves the journal as it was before it started.
+        #
+        # An upgrade returns True if stored bodies need re-encoding. That is
+        # done once every column exists, so the upgrade records that it is
+        # owed in the same transaction, and the record is only dropped with
+        # the rewrite: a journal closed in between still gets it next time.
+        cur.execute('PRAGMA user_version')
+        version = cur.fetchone()[0]
+        for i in range(version, len(self.UPGRADES)):
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                if getattr(self, self.UPGRADES[i])(db):
+                    createSettingsTable(db)
+                    db.execute('''
+                        INSERT OR REPLACE INTO settings(name, value)
+                        VALUES ('rewrite_bodies', '1')
+                    ''')
+                cur.execute('PRAGMA user_version = {0:d}'.format(i + 1))
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+
+        row = db.execute('''
+            SELECT
+                value
+            FROM settings
+            WHERE name = 'rewrite_bodies'
+        ''').fetchone()
+        if row is not None:
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                self.rewriteBodies(db)
+                db.execute('''
+                    DELETE FROM settings
+                    WHERE name = 'rewrite_bodies'
+                ''')
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+
+        return True
+
+    def upgradeBodyFormat(self, db):
+        db.execute('''
+            ALTER TABLE entries
+            ADD COLUMN body_format INTEGER NOT NULL DEFAULT 0
+        ''')
+        return True
+
+    def upgradeBodyCodec(self, db):
+        # Existing bodies are left as they are; recompress() converts them.
+        db.execute('''
+            ALTER TABLE entries
+            ADD COLUMN body_codec INTEGER NOT NULL DEFAULT 0
+        ''')
+        db.execute('''
+            ALTER TABLE entries
+            ADD COLUMN body_z BLOB
+        ''')
+
+    def upgradeBodyText(self, db):
+        for column in ('body_text TEXT NOT NULL DEFAULT \'\'',
+                       'snippet TEXT NOT NULL DEFAULT \'\'',
+                       'word_count INTEGER NOT NULL DEFAULT 0'):
+            db.execute('ALTER TABLE entries ADD COLUMN ' + column)
+        return True
+
+    def upgradeDateIndex(self, db):
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS entries_date_published
+            ON entries ( date_published, entry_id )
+        ''')
+
+    def upgradeAttachments(self, db):
+        # sha256 is filled in once the data is written, so it can be NULL
+        # while an attachment is being added.
+        db.execute('''
+            CREATE TABLE attachments (
+                attachment_id INTEGER PRIMARY KEY,
+                sha256 TEXT UNIQUE,
+                mime_type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE entry_attachments (
+                entry_id INTEGER NOT NULL,
+                attachment_id INTEGER NOT NULL,
+                PRIMARY KEY ( entry_id, attachment_id )
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX entry_attachments_attachment
+            ON entry_attachments ( attachment_id )
+        ''')
+
+    def upgradeRevisions(self, db):
+        db.execute('''
+            CREATE TABLE revisions (
+                revision_id INTEGER PRIMARY KEY,
+                entry_id INTEGER NOT NULL,
+                date_saved TIMESTAMP NOT NULL,
+                date_published DATE NOT NULL,
+                title VARCHAR( 255 ) NOT NULL,
+                kind INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX revisions_entry
+            ON revisions ( entry_id, revision_id )
+        ''')
+
+    def upgradeSync(self, db, chunksize=1000):
+        db.execute('''
+            ALTER TABLE entries
+            ADD COLUMN uuid TEXT
+        ''')
+        db.execute('''
+            ALTER TABLE entries
+            ADD COLUMN content_hash TEXT
+        ''')
+        createSyncTables(db)
+
+        # Entries created at the same moment cannot be told apart by when,
+        # so those get their id mixed in.
+        cur = db.cursor()
+        cur.execute('''
+            SELECT
+                date_created
+            FROM entries
+            GROUP BY date_created
+            HAVING count(*) > 1
+        ''')
+        shared = set(row[0] for row in cur)
+
+        last = 0
+        while True:
+            cur.execute('''
+                SELECT
+                    {0}
+                FROM entries
+                WHERE entry_id > ?
+                ORDER BY entry_id
+                LIMIT ?
+            '''.format(ENTRY_COLUMNS), (last, chunksize))
+            entries = [self.rowToEntry(row) for row in cur.fetchall()]
+            if not entries:
+                break
+            values = list()
+            for entry in entries:
+                name = entry.date_created.isoformat()
+                if entry.date_created in shared:
+                    name += '/{0}'.format(entry.entry_id)
+                values.append({'entry_id': entry.entry_id,
+                               'uuid': str(uuid.uuid5(UUID_NAMESPACE, name)),
+                               'content_hash': contentHash(entry),
+                               'date_modified': entry.date_modified})
+            cur.executemany('''
+                UPDATE entries
+                SET
+                    uuid = :uuid,
+                    content_hash = :content_hash
+                WHERE entry_id = :entry_id
+            ''', values)
+            cur.executemany(LOG_CHANGE, values)
+            last = entries[-1].entry_id
+
+        db.execute('''
+            CREATE UNIQUE INDEX entries_uuid
+            ON entries ( uuid )
+        ''')
+
+    def upgradeTags(self, db):
+        db.execute('''
+            CREATE TABLE tags (
+                tag_id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE entry_tags (
+                entry_id INTEGER NOT NULL,
+                tag_id INTEGER NOT NULL,
+                PRIMARY KEY ( entry_id, tag_id )
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX entry_tags_tag
+            ON entry_tags ( tag_id, entry_id )
+        ''')
+
+    def upgradeSettings(self, db):
+        # An earlier upgrade may have made the table to note a rewrite.
+        createSettingsTable(db)
+
+    def upgradeRevisionAttachments(self, db, chunksize=1000):
+        db.execute('''
+            CREATE TABLE revision_attachments (
+                revision_id INTEGER NOT NULL,
+                attachment_id INTEGER NOT NULL,
+                PRIMARY KEY ( revision_id, attachment_id )
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX revision_attachments_attachment
+            ON revision_attachments ( attachment_id )
+        ''')
+
+        cur = db.cursor()
+        last = 0
+        while True:
+            cur.execute('''
+                SELECT
+                    revision_id,
+                    data
+                FROM revisions
+                WHERE revision_id > ?
+                ORDER BY revision_id
+                LIMIT ?
+            ''', (last, chunksize))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                self.linkRevisionAttachments(cur, row['revision_id'],
+                                             zlib.decompress(row['data']))
+            last = rows[-1]['revision_id']
+
+    def upgradeRevisionTags(self, db):
+        # Older revisions are given the uuid and tags their entry has now;
+        # those of entries already deleted are left without.
+        db.execute('''
+            ALTER TABLE revisions
+            ADD COLUMN uuid TEXT
+        ''')
+        db.execute('''
+            ALTER TABLE revisions
+            ADD COLUMN tags TEXT NOT NULL DEFAULT ''
+        ''')
+        db.execute('''
+            UPDATE revisions
+            SET
+                uuid = (
+                    SELECT
+                        uuid
+                    FROM entries
+                    WHERE entry_id = revisions.entry_id
+                ),
+                tags = coalesce((
+                    SELECT
+                        group_concat(name, ',')
+                    FROM entry_tags
+                    JOIN tags USING ( tag_id )
+                    WHERE entry_id = revisions.entry_id
+                ), '')
+        ''')
+
+    def rewriteBodies(self, db, chunksize=1000, where='1', params=(),
+                      commit=False):
+        ''' Re-encode stored bodies the way save() would now, walking the rows
+            matching where in entry_id order chunksize at a time. With commit,
+            each chunk is its own transaction, so other connections can save
+            in between; a row is never rewritten from a stale read. '''
+        cur = db.cursor()
+        last = 0
+        while True:
+            if commit:
+                cur.execute('BEGIN IMMEDIATE')
+            cur.execute('''
+                SELECT
+                    *
+                FROM entries
+                WHERE entry_id > ? AND ({0})
+                ORDER BY entry_id
+                LIMIT ?
+            '''.format(where), (last,) + tuple(params) + (chunksize,))
+            rows = cur.fetchall()
+            if not rows:
+                if commit:
+                    db.commit()
+                break
+
+            updates = list()
+            for row in rows:
+                columns = self.bodyColumns(self.rowBody(row))
+                if any(row[k] != v for k, v in columns.items()):
+                    columns['entry_id'] = row['entry_id']
+                    updates.append(columns)
+            cur.executemany('''
+                UPDATE entries
+                SET
+                    body = :body,
+                    body_format = :body_format,
+                    body_codec = :body_codec,
+                    body_z = :body_z,
+                    body_text = :body_text,
+                    snippet = :snippet,
+                    word_count = :word_count
+                WHERE entry_id = :entry_id
+            ''', updates)
+            last = rows[-1]['entry_id']
+            if commit:
+                db.commit()
+
+    def recompress(self, dbfile, chunksize=500):
+        ''' Bring every stored body in line with this engine's compression
+            settings. Safe to run on a background thread while the journal is
+            being edited and saved elsewhere. The settings the bodies were
+            last brought in line with are stored, so opening the journal
+            again with the same ones does not scan it. '''
+        settings = '{0}:{1}'.format(self.codec, self.threshold)
+        db = self.connect(dbfile)
+        try:
+            row = db.execute('''
+                SELECT
+                    value
+                FROM settings
+                WHERE name = 'compression'
+            ''').fetchone()
+            if row is not None and row[0] == settings:
+                return
+            if self.codec:
+                where = ('(body_codec = 0 AND length(body) >= ?) '
+                         'OR body_codec NOT IN (0, ?)')
+                params = (self.threshold, self.codec)
+            else:
+                where, params = 'body_codec != 0', ()
+            self.rewriteBodies(db, chunksize, where, params, commit=True)
+            db.execute('''
+                INSERT OR REPLACE INTO settings(name, value)
+                VALUES ('compression', ?)
+            ''', (settings,))
+            db.commit()
+        finally:
+            self.disconnect(db)
+
+    def bodyColumns(self, body, text=None):
+        ''' The stored form of an entry body, by column, along with the plain
+            text derived from it for search and previews. Callers that
+            already have that text can pass it to save parsing body again. '''
+        if text is None:
+            text = plainText(body)
+        body_format, body = minifyHtml(body)
+        body_codec, body_z = CODEC_NONE, None
+        if self.codec and len(body) >= self.threshold:
+            data = body.encode('utf-8')
+            packed = CODECS[self.codec][1](data)
+            if len(packed) < len(data):
+                body_codec, body_z, body = self.codec, packed, ''
+        return {'body': body,
+                'body_format': body_format,
+                'body_codec': body_codec,
+                'body_z': body_z,
+                'body_text': text,
+                'snippet': snippet(text),
+                'word_count': len(text.split())}
+
+    def entryRow(self, entry, text=None):
+        ''' The values save() and bulkInsert() write for entry, by column. '''
+        values = self.bodyColumns(entry.body, text)
+        values.update(entry_id=entry.entry_id,
+                      date_created=entry.date_created,
+                      date_modified=entry.date_modified,
+                      date_published=entry.date_published,
+                      title=entry.title,
+                      uuid=entry.uuid or str(uuid.uuid4()),
+                      content_hash=contentHash(entry),
+                      tags=list(entry.tags))
+        return values
+
+    def rowBody(self, row):
+        body = row['body']
+        if row['body_codec']:
+            body = CODECS[row['body_codec']][2](row['body_z']).decode('utf-8')
+        return expandHtml(row['body_format'], body)
+
+    def rowToEntry(self, row):
+        ''' Build an Entry from a row of ENTRY_COLUMNS, or of HEADER_COLUMNS,
+            in which case its body is left as None. '''
+        r = dict(zip(row.keys(), row))
+        return Entry(r['date_created'],
+                     r['date_modified'],
+                     r['date_published'],
+                     r['entry_id'],
+                     r['title'],
+                     self.rowBody(row) if 'body_format' in r else None,
+                     r['snippet'],
+                     r['word_count'],
+                     r['uuid'])
+
+    def new(self, dbfile):
+        db = self.connect(dbfile)
         cur = db.cursor()
         cur.execute('''
             CREATE TABLE entries (
@@ -41,73 +910,696 @@ class Sqlite3Storage(BaseStorage):
             )
         ''')
         db.commit()
-        db.close()
+        self.upgrade(db)
+        self.upgraded.add(dbfile)
+        self.disconnect(db)
 
-    def load(self, dbfile):
+    def load(self, dbfile, bodies=True):
+        ''' Return every entry. With bodies=False the bodies are not read and
+            stay None until fetched with loadBodies(). '''
         entries = list()
 
-        db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
-        db.row_factory = sqlite3.Row
+        with LOAD_SECONDS.time():
+            db = self.connect(dbfile)
+            cur = db.cursor()
+            cur.execute('''
+                SELECT
+                    {0}
+                FROM entries
+            '''.format(ENTRY_COLUMNS if bodies else HEADER_COLUMNS))
+            for row in cur:
+                entries.append(self.rowToEntry(row))
+            self.addTags(db, entries, everything=True)
+
+            self.disconnect(db)
+
+        ROWS_LOADED.inc(len(entries))
+        return entries
+
+    def addTags(self, db, entries, everything=False, chunksize=500):
+        ''' Fill in the tags of entries from entry_tags. With everything,
+            entries is the whole journal and the table is read in one go. '''
+        by_id = dict((x.entry_id, x) for x in entries)
+        if everything:
+            queries = [('', ())]
+        else:
+            ids = list(by_id)
+            queries = [('WHERE entry_id IN ({0})'.format(', '.join('?' * len(chunk))), chunk)
+                       for chunk in (ids[i:i + chunksize]
+                                     for i in range(0, len(ids), chunksize))]
+        for where, params in queries:
+            cur = db.execute('''
+                SELECT
+                    entry_id,
+                    name
+                FROM entry_tags
+                JOIN tags USING ( tag_id )
+                {0}
+                ORDER BY entry_id, name
+            '''.format(where), params)
+            for entry_id, group in itertools.groupby(cur, key=lambda x: x[0]):
+                entry = by_id.get(entry_id)
+                if entry is not None:
+                    entry.tags = [x[1] for x in group]
+
+    def linkTags(self, cur, rows):
+        ''' Store the tags of rows built by entryRow(), replacing any the
+            entries had. '''
+        cur.executemany('''
+            DELETE FROM entry_tags
+            WHERE entry_id = ?
+        ''', ((x['entry_id'],) for x in rows))
+        cur.executemany('''
+            INSERT OR IGNORE INTO tags(name)
+            VALUES (?)
+        ''', ((x,) for x in set(itertools.chain.from_iterable(x['tags'] for x in rows))))
+        cur.executemany('''
+            INSERT OR IGNORE INTO entry_tags(entry_id, tag_id)
+            SELECT
+                ?,
+                tag_id
+            FROM tags
+            WHERE name = ?
+        ''', ((x['entry_id'], tag) for x in rows for tag in x['tags']))
+
+    def loadBodies(self, dbfile, entry_ids, chunksize=500):
+        ''' Return a dict of entry id to body for the given ids. '''
+        bodies = dict()
+        entry_ids = list(entry_ids)
+        db = self.connect(dbfile)
+        try:
+            cur = db.cursor()
+            for i in range(0, len(entry_ids), chunksize):
+                chunk = entry_ids[i:i + chunksize]
+                cur.execute('''
+                    SELECT
+                        {0}
+                    FROM entries
+                    WHERE entry_id IN ({1})
+                '''.format(BODY_COLUMNS, ', '.join('?' * len(chunk))), chunk)
+                for row in cur:
+                    bodies[row['entry_id']] = self.rowBody(row)
+        finally:
+            self.disconnect(db)
+        return bodies
+
+    def count(self, dbfile):
+        db = self.connect(dbfile)
+        try:
+            return db.execute('SELECT count(*) FROM entries').fetchone()[0]
+        finally:
+            self.disconnect(db)
+
+    def dataVersion(self, dbfile):
+        ''' SQLite's data_version, which changes whenever another connection
+            commits, so only means something compared between calls on one
+            connection held with open(). '''
+        db = self.connect(dbfile)
+        try:
+            return db.execute('PRAGMA data_version').fetchone()[0]
+        finally:
+            self.disconnect(db)
+
+    def sequence(self, dbfile):
+        db = self.connect(dbfile)
+        try:
+            return db.execute('SELECT max(seq) FROM changes').fetchone()[0] or 0
+        finally:
+            self.disconnect(db)
+
+    def changesSince(self, dbfile, seq):
+        ''' The change log after seq, oldest first, as dicts of seq, uuid and
+            content_hash, which is None for a deleted entry. Only the latest
+            change to each entry is kept, so each uuid appears once. '''
+        db = self.connect(dbfile)
+        try:
+            cur = db.execute('''
+                SELECT
+                    seq,
+                    uuid,
+                    content_hash
+                FROM changes
+                WHERE seq > ?
+                ORDER BY seq
+            ''', (seq,))
+            return [dict(zip(row.keys(), row)) for row in cur]
+        finally:
+            self.disconnect(db)
+
+    def entriesByUuid(self, dbfile, uuids, bodies=True, chunksize=500):
+        ''' The stored entries with the given uuids; bodies is as for
+            load(). '''
+        entries = list()
+        uuids = list(uuids)
+        db = self.connect(dbfile)
+        try:
+            for i in range(0, len(uuids), chunksize):
+                chunk = uuids[i:i + chunksize]
+                cur = db.execute('''
+                    SELECT
+                        {0}
+                    FROM entries
+                    WHERE uuid IN ({1})
+                '''.format(ENTRY_COLUMNS if bodies else HEADER_COLUMNS,
+                           ', '.join('?' * len(chunk))), chunk)
+                entries.extend(self.rowToEntry(row) for row in cur)
+            self.addTags(db, entries)
+        finally:
+            self.disconnect(db)
+        ROWS_LOADED.inc(len(entries))
+        return entries
+
+    def iterEntries(self, dbfile, chunksize=500, start=None, end=None,
+                    text=None, bodies=True):
+        ''' Yield the entries published from start to end that mention text,
+            oldest first, fetching chunksize rows at once, so callers never
+            hold the whole journal in memory. bodies is as for load(). '''
+        where, params = entryFilter(start, end, text)
+        db = self.connect(dbfile)
+        try:
+            cur = db.cursor()
+            cur.execute('''
+                SELECT
+                    {0}
+                FROM entries
+                WHERE {1}
+                ORDER BY date_published, entry_id
+            '''.format(ENTRY_COLUMNS if bodies else HEADER_COLUMNS, where),
+                params)
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                ROWS_LOADED.inc(len(rows))
+                entries = [self.rowToEntry(row) for row in rows]
+                self.addTags(db, entries)
+                for entry in entries:
+                    yield entry
+        finally:
+            self.disconnect(db)
+
+    def bulkInsert(self, dbfile, rows, batchsize=50000, rebuild=True):
+        ''' Add rows built by entryRow(), batchsize to a transaction, and
+            return how many there were. The indexes are dropped first and
+            built again once at the end, which is much quicker than keeping
+            them up to date row by row; unique ones stay, so a clash fails
+            its batch rather than the rebuild. Pass rebuild=False when adding
+            a few rows to a large journal, where rebuilding costs more. '''
+        count = 0
+        db = self.connect(dbfile)
         cur = db.cursor()
         cur.execute('''
             SELECT
-                *
-            FROM entries
+                name,
+                sql
+            FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = 'entries' AND sql IS NOT NULL
         ''')
-        for row in cur:
-            r = dict(zip(row.keys(), row))
-            entry = Entry(r['date_created'],
-                          r['date_modified'],
-                          r['date_published'],
-                          r['entry_id'],
-                          r['title'],
-                          r['body'])
-            entries.append(entry)
+        indexes = [x for x in cur.fetchall()
+                   if rebuild and not x['sql'].upper().startswith('CREATE UNIQUE')]
+        try:
+            for index in indexes:
+                cur.execute('DROP INDEX {0}'.format(index['name']))
+            rows = iter(rows)
+            entry_id = self.nextEntryId(cur)
+            while True:
+                batch = list(itertools.islice(rows, batchsize))
+                if not batch:
+                    break
+                for row in batch:
+                    if row['entry_id'] is None:
+                        row['entry_id'] = entry_id
+                        entry_id += 1
+                cur.executemany(INSERT_ENTRY, batch)
+                cur.executemany(LOG_CHANGE, batch)
+                self.linkTags(cur, [x for x in batch if x['tags']])
+                db.commit()
+                count += len(batch)
+        finally:
+            db.rollback()
+            for index in indexes:
+                cur.execute(index['sql'])
+            db.commit()
+            self.disconnect(db)
 
-        db.close()
+        ROWS_SAVED.inc(count)
+        return count
+
+    def search(self, dbfile, text):
+        with SEARCH_SECONDS.time():
+            return self.searchEntries(dbfile, text)
+
+    def searchEntries(self, dbfile, text):
+        db = self.connect(dbfile)
+        cur = db.cursor()
+        pattern = likePattern(text)
+        cur.execute('''
+            SELECT
+                {0}
+            FROM entries
+            WHERE title LIKE :pattern ESCAPE '\\'
+                OR body_text LIKE :pattern ESCAPE '\\'
+            ORDER BY date_published, entry_id
+        '''.format(ENTRY_COLUMNS), {'pattern': pattern})
+        entries = [self.rowToEntry(row) for row in cur]
+        self.addTags(db, entries)
+        self.disconnect(db)
 
         return entries
 
     def save(self, dbfile, entries, to_delete):
-        db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
+        with SAVE_SECONDS.time():
+            self.saveEntries(dbfile, entries, to_delete)
+        ROWS_SAVED.inc(len(entries) + len(to_delete))
+
+    def saveEntries(self, dbfile, entries, to_delete):
+        db = self.connect(dbfile)
         cur = db.cursor()
         for entry in entries:
-            if entry.entry_id:
+            values = self.entryRow(entry)
+            previous = self.storedEntry(cur, entry.entry_id) if entry.entry_id else None
+            if previous is not None:
+                values['uuid'] = previous.uuid
                 cur.execute('''
                     UPDATE entries
                     SET
-                        date_modified = ?,
-                        date_published = ?,
-                        body = ?,
-                        title = ?
-                    WHERE entry_id = ?
-                ''', (entry.date_modified,
-                      entry.date_published,
-                      entry.body,
-                      entry.title,
-                      entry.entry_id))
+                        date_modified = :date_modified,
+                        date_published = :date_published,
+                        body = :body,
+                        body_format = :body_format,
+                        body_codec = :body_codec,
+                        body_z = :body_z,
+                        body_text = :body_text,
+                        snippet = :snippet,
+                        word_count = :word_count,
+                        title = :title,
+                        content_hash = :content_hash
+                    WHERE entry_id = :entry_id
+                ''', values)
             else:
-                cur.execute('''
-                    INSERT INTO entries(
-                        date_created,
-                        date_modified,
-                        date_published,
-                        body,
-                        title
-                    )
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (entry.date_created,
-                      entry.date_modified,
-                      entry.date_published,
-                      entry.body,
-                      entry.title))
+                # A new entry, or a deleted one coming back under its old id.
+                if not entry.entry_id:
+                    values['entry_id'] = self.nextEntryId(cur)
+                cur.execute(INSERT_ENTRY, values)
+                # Hand the new id back so the next save updates this row
+                # rather than inserting it a second time.
+                entry.entry_id = values['entry_id']
+            entry.uuid = values['uuid']
+            cur.execute(LOG_CHANGE, values)
+            # Saving an entry as it already was leaves its history alone.
+            if previous is None or contentHash(previous) != values['content_hash']:
+                self.recordRevision(cur, entry, previous)
+            self.linkAttachments(cur, entry)
+            self.linkTags(cur, [values])
             db.commit()
+            entry.snippet = values['snippet']
+            entry.word_count = values['word_count']
+            entry.modified = False
 
         for entry in to_delete:
+            previous = self.storedEntry(cur, entry.entry_id)
+            if previous is not None:
+                now = datetime.datetime.now()
+                self.addRevision(cur, previous, now,
+                                 REVISION_DELETED, 0, previous.body.encode('utf-8'))
+                cur.execute(LOG_CHANGE, {'uuid': previous.uuid,
+                                         'content_hash': None,
+                                         'date_modified': now})
             cur.execute('''
                 DELETE FROM entries
                 WHERE entry_id = ?
             ''', (entry.entry_id,))
+            cur.execute('''
+                DELETE FROM entry_attachments
+                WHERE entry_id = ?
+            ''', (entry.entry_id,))
+            cur.execute('''
+                DELETE FROM entry_tags
+                WHERE entry_id = ?
+            ''', (entry.entry_id,))
+            db.commit()
+
+        self.disconnect(db)
+
+    def storedEntry(self, cur, entry_id):
+        cur.execute('''
+            SELECT
+                {0}
+            FROM entries
+            WHERE entry_id = ?
+        '''.format(ENTRY_COLUMNS), (entry_id,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        entry = self.rowToEntry(row)
+        self.addTags(cur.connection, [entry])
+        return entry
+
+    def nextEntryId(self, cur):
+        ''' An id no entry has had yet, deleted ones included, so histories
+            of different entries never share an id. '''
+        cur.execute('''
+            SELECT
+                max(entry_id)
+            FROM (
+                SELECT max(entry_id) AS entry_id FROM entries
+                UNION ALL
+                SELECT max(entry_id) FROM revisions
+            )
+        ''')
+        return (cur.fetchone()[0] or 0) + 1
+
+    def recordRevision(self, cur, entry, previous):
+        ''' Add the revision entry is being saved as, previous being what it
+            replaces. Most revisions are stored as a delta against the one
+            before; every REVISION_INTERVAL-th holds the whole body. '''
+        cur.execute('''
+            SELECT
+                kind,
+                depth
+            FROM revisions
+            WHERE entry_id = ?
+            ORDER BY revision_id DESC
+            LIMIT 1
+        ''', (entry.entry_id,))
+        last = cur.fetchone()
+        if last is None and previous is not None:
+            # History starts here, so keep the version being replaced too.
+            self.addRevision(cur, previous, previous.date_modified,
+                             REVISION_FULL, 0, previous.body.encode('utf-8'))
+            last = {'kind': REVISION_FULL, 'depth': 0}
+
+        now = datetime.datetime.now()
+        full = entry.body.encode('utf-8')
+        if (previous is not None and last['kind'] != REVISION_DELETED
+                and last['depth'] + 1 < self.REVISION_INTERVAL):
+            delta = json.dumps(lineDelta(previous.body, entry.body),
+                               ensure_ascii=False,
+                               separators=(',', ':')).encode('utf-8')
+            if len(delta) < len(full):
+                self.addRevision(cur, entry, now, REVISION_DELTA,
+                                 last['depth'] + 1, delta)
+                return
+        self.addRevision(cur, entry, now, REVISION_FULL, 0, full)
+
+    def addRevision(self, cur, entry, date_saved, kind, depth, data):
+        cur.execute('''
+            INSERT INTO revisions(
+                entry_id,
+                date_saved,
+                date_published,
+                title,
+                uuid,
+                tags,
+                kind,
+                depth,
+                data
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (entry.entry_id, date_saved, entry.date_published, entry.title,
+              entry.uuid, ','.join(sorted(entry.tags)), kind, depth,
+              zlib.compress(data)))
+        self.linkRevisionAttachments(cur, cur.lastrowid, data)
+
+    def linkRevisionAttachments(self, cur, revision_id, data):
+        ''' Record which attachments a revision refers to, so restoring it
+            never finds them pruned. A delta only holds the lines it adds,
+            and any other line it rebuilds came from a revision before it,
+            which has its own links. '''
+        cur.executemany('''
+            INSERT OR IGNORE INTO revision_attachments(revision_id, attachment_id)
+            VALUES (?, ?)
+        ''', ((revision_id, int(x))
+              for x in set(ATTACHMENT_URL.findall(data.decode('utf-8')))))
+
+    def backup(self, dbfile, target, pages=256, progress=None, sleep=0.01):
+        ''' Copy the journal to target while it stays open for saving, pages
+            database pages at a time. The lock on the journal is let go for
+            sleep seconds between steps so saves are never held up for long,
+            and progress(remaining, total) is called after each step. A save
+            from another connection makes the copy start over. '''
+        db = self.connect(dbfile)
+        copy = sqlite3.connect(target)
+        try:
+            db.backup(copy, pages=pages, sleep=sleep,
+                      progress=(lambda status, remaining, total:
+                                progress(remaining, total)) if progress else None)
+        finally:
+            copy.close()
+            self.disconnect(db)
+
+    def check(self, dbfile):
+        ''' What PRAGMA integrity_check finds wrong with dbfile, if anything. '''
+        db = sqlite3.connect(dbfile)
+        try:
+            problems = [row[0] for row in db.execute('PRAGMA integrity_check')]
+        finally:
+            db.close()
+        return [] if problems == ['ok'] else problems
+
+    def revisions(self, dbfile, entry_id):
+        ''' The saved revisions of an entry, newest first, as dicts without
+            their bodies. '''
+        db = self.connect(dbfile)
+        cur = db.cursor()
+        cur.execute('''
+            SELECT
+                revision_id,
+                entry_id,
+                date_saved,
+                date_published,
+                title,
+                kind,
+                length(data) AS size
+            FROM revisions
+            WHERE entry_id = ?
+            ORDER BY revision_id DESC
+        ''', (entry_id,))
+        revisions = [dict(zip(row.keys(), row)) for row in cur]
+        self.disconnect(db)
+        return revisions
+
+    def deletedEntries(self, dbfile):
+        ''' The last revision of each deleted entry, most recently deleted
+            first, in the form revisions() gives. '''
+        db = self.connect(dbfile)
+        cur = db.cursor()
+        cur.execute('''
+            SELECT
+                revision_id,
+                entry_id,
+                date_saved,
+                date_published,
+                title,
+                kind,
+                length(data) AS size
+            FROM revisions AS r
+            WHERE kind = ?
+                AND revision_id = (
+                    SELECT
+                        max(revision_id)
+                    FROM revisions
+                    WHERE entry_id = r.entry_id
+                )
+                AND entry_id NOT IN (
+                    SELECT
+                        entry_id
+                    FROM entries
+                )
+            ORDER BY revision_id DESC
+        ''', (REVISION_DELETED,))
+        revisions = [dict(zip(row.keys(), row)) for row in cur]
+        self.disconnect(db)
+        return revisions
+
+    def revisionEntry(self, dbfile, revision_id):
+        ''' The entry as it was saved in a revision, uuid and tags included,
+            so one brought back is the same entry to sync. Its body is
+            rebuilt from the nearest revision at or before it holding the
+            whole body, so at most REVISION_INTERVAL - 1 deltas are applied. '''
+        db = self.connect(dbfile)
+        cur = db.cursor()
+        cur.execute('''
+            SELECT
+                entry_id
+            FROM revisions
+            WHERE revision_id = ?
+        ''', (revision_id,))
+        row = cur.fetchone()
+        if row is None:
+            self.disconnect(db)
+            raise KeyError('No revision {0}'.format(revision_id))
+
+        cur.execute('''
+            SELECT
+                *
+            FROM revisions
+            WHERE entry_id = :entry_id
+                AND revision_id <= :revision_id
+                AND revision_id >= (
+                    SELECT
+                        max(revision_id)
+                    FROM revisions
+                    WHERE entry_id = :entry_id
+                        AND revision_id <= :revision_id
+                        AND kind != :delta
+                )
+            ORDER BY revision_id
+        ''', {'entry_id': row['entry_id'],
+              'revision_id': revision_id,
+              'delta': REVISION_DELTA})
+        body = None
+        for row in cur:
+            data = zlib.decompress(row['data']).decode('utf-8')
+            if row['kind'] == REVISION_DELTA:
+                body = applyDelta(body, json.loads(data))
+            else:
+                body = data
+        self.disconnect(db)
+
+        return Entry(row['date_saved'],
+                     row['date_saved'],
+                     row['date_published'],
+                     row['entry_id'],
+                     row['title'],
+                     body,
+                     uuid=row['uuid'],
+                     tags=row['tags'].split(',') if row['tags'] else ())
+
+    def linkAttachments(self, cur, entry):
+        ''' Record which attachments the body of entry refers to, so
+            pruneAttachments() knows which are still in use. '''
+        cur.execute('''
+            DELETE FROM entry_attachments
+            WHERE entry_id = ?
+        ''', (entry.entry_id,))
+        cur.executemany('''
+            INSERT OR IGNORE INTO entry_attachments(entry_id, attachment_id)
+            VALUES (?, ?)
+        ''', ((entry.entry_id, int(x))
+              for x in set(ATTACHMENT_URL.findall(entry.body))))
+
+    def addAttachment(self, dbfile, stream, size, mime_type, chunksize=1 << 16):
+        ''' Store size bytes read from stream as an attachment and return its
+            id. The data goes through an incremental blob handle a chunk at a
+            time, so it is never all in memory. If the same content is
+            already stored, the new copy is dropped and the id of the old one
+            returned. '''
+        db = self.connect(dbfile)
+        try:
+            cur = db.cursor()
+            cur.execute('''
+                INSERT INTO attachments(mime_type, size, data)
+                VALUES (?, ?, zeroblob(?))
+            ''', (mime_type, size, size))
+            attachment_id = cur.lastrowid
+
+            digest = hashlib.sha256()
+            with db.blobopen('attachments', 'data', attachment_id) as blob:
+                written = 0
+                while written < size:
+                    chunk = stream.read(min(chunksize, size - written))
+                    if not chunk:
+                        raise ValueError('Attachment ended after {0} of {1} '
+                                         'bytes'.format(written, size))
+                    blob.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+
+            cur.execute('''
+                SELECT
+                    attachment_id
+                FROM attachments
+                WHERE sha256 = ?
+            ''', (digest.hexdigest(),))
+            row = cur.fetchone()
+            if row:
+                cur.execute('''
+                    DELETE FROM attachments
+                    WHERE attachment_id = ?
+                ''', (attachment_id,))
+                attachment_id = row[0]
+            else:
+                cur.execute('''
+                    UPDATE attachments
+                    SET sha256 = ?
+                    WHERE attachment_id = ?
+                ''', (digest.hexdigest(), attachment_id))
+                ATTACHMENT_BYTES.inc(size)
             db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        finally:
+            self.disconnect(db)
+        return attachment_id
+
+    def attachmentInfo(self, dbfile, attachment_id):
+        ''' The mime_type, size and sha256 of an attachment, or None if there
+            is no such attachment. '''
+        db = self.connect(dbfile)
+        cur = db.cursor()
+        cur.execute('''
+            SELECT
+                mime_type,
+                size,
+                sha256
+            FROM attachments
+            WHERE attachment_id = ?
+        ''', (attachment_id,))
+        row = cur.fetchone()
+        self.disconnect(db)
+        return dict(zip(row.keys(), row)) if row else None
+
+    def readAttachment(self, dbfile, attachment_id, chunksize=1 << 16):
+        ''' Yield the data of an attachment chunksize bytes at a time. '''
+        db = self.connect(dbfile)
+        try:
+            try:
+                blob = db.blobopen('attachments', 'data', attachment_id,
+                                   readonly=True)
+            except sqlite3.OperationalError:
+                raise KeyError('No attachment {0}'.format(attachment_id))
+            with blob:
+                while True:
+                    chunk = blob.read(chunksize)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            self.disconnect(db)
 
-        db.close()
+    def openAttachment(self, dbfile, attachment_id):
+        ''' The data of an attachment as a file, read from the database a
+            piece at a time as the file is read. Close it when done. '''
+        db = self.connect(dbfile)
+        try:
+            blob = db.blobopen('attachments', 'data', attachment_id,
+                               readonly=True)
+        except sqlite3.OperationalError:
+            self.disconnect(db)
+            raise KeyError('No attachment {0}'.format(attachment_id))
+        return BlobFile(blob, lambda: self.disconnect(db))
+
+    def pruneAttachments(self, dbfile):
+        ''' Delete the attachments neither a saved entry nor any revision,
+            deleted entries' included, refers to any more, and return how many
+            there were. '''
+        db = self.connect(dbfile)
+        cur = db.cursor()
+        cur.execute('''
+            DELETE FROM attachments
+            WHERE attachment_id NOT IN (
+                SELECT
+                    attachment_id
+                FROM entry_attachments
+                UNION
+                SELECT
+                    attachment_id
+                FROM revision_attachments
+            )
+        ''')
+        count = cur.rowcount
+        db.commit()
+        self.disconnect(db)
+        return count
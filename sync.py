@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Two-way sync between copies of a journal.
+
+    Each side keeps a change log: the latest change to every entry it has
+    held, by the entry's uuid, with a content hash (NULL once the entry is
+    deleted) and an ever-increasing seq. Each side also records the seq of
+    both sides the last time they synced. A sync then only looks at entries
+    either side changed since then, reading both logs in uuid order and
+    walking them together, a chunk at a time, so neither journal is ever
+    held in memory whole. Only entries whose hashes differ are copied.
+
+    An entry changed on one side only is copied to the other. One changed
+    on both sides, with different hashes, is a conflict: the side that
+    changed it last wins, and if both did so at the same moment the higher
+    hash does. Every machine settles a conflict the same way, and in a
+    journal the losing version is kept in the entry's history.
+
+    A side is a sqlite3 journal, or a directory holding one JSON file per
+    entry plus its own log, for keeping in a shared folder. '''
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import uuid
+
+import journal  # storage needs journal imported first
+import metrics
+from journal import Entry
+from storage import (LOG_CHANGE, Sqlite3Storage, contentHash, createSyncTables,
+                     engineFor)
+
+COPIED = metrics.counter('sync.entries_copied')
+DELETED = metrics.counter('sync.entries_deleted')
+CONFLICTS = metrics.counter('sync.conflicts')
+SYNC_SECONDS = metrics.histogram('sync.seconds')
+
+
+def mergeJoin(left, right):
+    ''' Walk two iterators of tuples sorted by their first item together,
+        yielding (key, left tuple, right tuple) with None for a side that
+        does not have the key. '''
+    left, right = iter(left), iter(right)
+    x, y = next(left, None), next(right, None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x[0] < y[0]):
+            yield x[0], x, None
+            x = next(left, None)
+        elif x is None or y[0] < x[0]:
+            yield y[0], None, y
+            y = next(right, None)
+        else:
+            yield x[0], x, y
+            x, y = next(left, None), next(right, None)
+
+
+class Peer(object):
+    '''One side of a sync: a change log in the SQLite database self.db, as
+       createSyncTables() lays it out, and entries to read and write by
+       uuid. Changes are (uuid, content hash, date modified) tuples.'''
+    db = None
+
+    def identity(self):
+        return self.db.execute('''
+            SELECT
+                value
+            FROM sync_state
+            WHERE name = 'identity'
+        ''').fetchone()[0]
+
+    def newIdentity(self):
+        ''' Take a new identity, for a side found to be a file copy of the
+            other. What it recorded about other sides stays true. '''
+        self.db.execute('''
+            UPDATE sync_state
+            SET value = ?
+            WHERE name = 'identity'
+        ''', (str(uuid.uuid4()),))
+        self.db.commit()
+
+    def sequence(self):
+        return self.db.execute('SELECT max(seq) FROM changes').fetchone()[0] or 0
+
+    def lastSync(self, identity):
+        ''' The seq of this side and of the side called identity when they
+            last synced, or zeros if they never have. '''
+        row = self.db.execute('''
+            SELECT
+                local_seq,
+                remote_seq
+            FROM sync_peers
+            WHERE identity = ?
+        ''', (identity,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def recordSync(self, identity, local_seq, remote_seq, when):
+        self.db.execute('''
+            INSERT OR REPLACE INTO sync_peers(identity, local_seq, remote_seq,
+                                              date_synced)
+            VALUES (?, ?, ?, ?)
+        ''', (identity, local_seq, remote_seq, when))
+        self.db.commit()
+
+    def changes(self, since, chunksize=1000):
+        ''' The latest change to each entry made after seq since, in uuid
+            order. Read a page at a time, so the side can be written to in
+            between. '''
+        last = ''
+        while True:
+            rows = self.db.execute('''
+                SELECT
+                    uuid,
+                    content_hash,
+                    date_modified
+                FROM changes
+                WHERE uuid > ? AND seq > ?
+                ORDER BY uuid
+                LIMIT ?
+            ''', (last, since, chunksize)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+            last = rows[-1][0]
+
+    def states(self, uuids, chunksize=500):
+        ''' The latest change to each of uuids this side has a record of. '''
+        uuids = list(uuids)
+        states = dict()
+        for i in range(0, len(uuids), chunksize):
+            chunk = uuids[i:i + chunksize]
+            for row in self.db.execute('''
+                SELECT
+                    uuid,
+                    content_hash,
+                    date_modified
+                FROM changes
+                WHERE uuid IN ({0})
+            '''.format(', '.join('?' * len(chunk))), chunk):
+                states[row[0]] = tuple(row)
+        return states
+
+    def entries(self, uuids):
+        ''' The entries with the given uuids that this side holds. '''
+        raise NotImplementedError
+
+    def apply(self, entries, deleted):
+        ''' Store entries, replacing any with the same uuid, and delete the
+            entries in deleted, a list of (uuid, date deleted). Each change
+            is logged with the entry's own date, not the time of the sync. '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JournalPeer(Peer):
+    '''A sqlite3 journal, created if it does not exist yet.'''
+    def __init__(self, path, storage=None):
+        self.path = path
+        self.storage = storage or Sqlite3Storage()
+        if not self.storage.exists(path):
+            self.storage.new(path)
+        self.storage.open(path)
+        self.db = self.storage.db
+
+    def entryIds(self, uuids, chunksize=500):
+        ids = dict()
+        for i in range(0, len(uuids), chunksize):
+            chunk = uuids[i:i + chunksize]
+            ids.update(self.db.execute('''
+                SELECT
+                    uuid,
+                    entry_id
+                FROM entries
+                WHERE uuid IN ({0})
+            '''.format(', '.join('?' * len(chunk))), chunk))
+        return ids
+
+    def entries(self, uuids):
+        return self.storage.entriesByUuid(self.path, uuids)
+
+    def apply(self, entries, deleted):
+        entries = list(entries)
+        ids = self.entryIds([x.uuid for x in entries] + [x[0] for x in deleted])
+
+        new, changed = list(), list()
+        for entry in entries:
+            # Ids are local to a journal, so only the uuid carries over.
+            entry.entry_id = ids.get(entry.uuid)
+            entry.modified = True
+            (changed if entry.entry_id else new).append(entry)
+
+        # New entries go in as one transaction; saving them one by one
+        # would commit each.
+        self.storage.bulkInsert(self.path,
+                                (self.storage.entryRow(x) for x in new),
+                                rebuild=False)
+        self.storage.save(self.path, changed,
+                          [Entry(entry_id=ids[x]) for x, when in deleted if x in ids])
+        self.db.executemany(LOG_CHANGE, ({'uuid': x,
+                                          'content_hash': None,
+                                          'date_modified': when}
+                                         for x, when in deleted))
+        self.db.commit()
+
+    def close(self):
+        self.storage.close()
+
+
+class DirectoryPeer(Peer):
+    '''A directory holding each entry as entries/XX/UUID.json, in the form
+       Entry.toDict() gives, with the change log in sync.db beside them.
+       Only sync should write to it.'''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'sync.db'),
+                                  detect_types=sqlite3.PARSE_DECLTYPES)
+        exists = self.db.execute('''
+            SELECT
+                name
+            FROM sqlite_master
+            WHERE type = 'table' AND name = 'changes'
+        ''').fetchone()
+        if exists is None:
+            createSyncTables(self.db)
+            self.db.commit()
+
+    def entryPath(self, entry_uuid):
+        return os.path.join(self.path, 'entries', entry_uuid[:2],
+                            entry_uuid + '.json')
+
+    def entries(self, uuids):
+        for entry_uuid in uuids:
+            try:
+                with open(self.entryPath(entry_uuid), encoding='utf-8') as f:
+                    yield Entry.fromDict(json.load(f))
+            except FileNotFoundError:
+                continue
+
+    def apply(self, entries, deleted):
+        changes = list()
+        for entry in entries:
+            entry.entry_id = None
+            path = self.entryPath(entry.uuid)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(entry.toDict(), f, ensure_ascii=False, indent=1)
+            os.replace(path + '.tmp', path)
+            changes.append({'uuid': entry.uuid,
+                            'content_hash': contentHash(entry),
+                            'date_modified': entry.date_modified})
+
+        for entry_uuid, when in deleted:
+            try:
+                os.remove(self.entryPath(entry_uuid))
+            except FileNotFoundError:
+                pass
+            changes.append({'uuid': entry_uuid,
+                            'content_hash': None,
+                            'date_modified': when})
+
+        self.db.executemany(LOG_CHANGE, changes)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def openPeer(path):
+    ''' A directory, or a path without an extension, is a DirectoryPeer;
+        anything else has to be a sqlite3 journal. '''
+    if os.path.isdir(path) or not os.path.splitext(path)[1]:
+        return DirectoryPeer(path)
+    if not issubclass(engineFor(path), Sqlite3Storage):
+        raise ValueError('Only sqlite3 journals can be synced: {0}'.format(path))
+    return JournalPeer(path)
+
+
+def winner(ours, theirs):
+    ''' Which of two different changes to the same entry stands. '''
+    return max(ours, theirs, key=lambda x: (x[2], x[1] or ''))
+
+
+def transfer(source, target, changes, stats, name):
+    entries = list(source.entries(x[0] for x in changes if x[1] is not None))
+    deleted = [(x[0], x[2]) for x in changes if x[1] is None]
+    target.apply(entries, deleted)
+    stats['copied to ' + name] += len(entries)
+    stats['deleted from ' + name] += len(deleted)
+    COPIED.inc(len(entries))
+    DELETED.inc(len(deleted))
+
+
+def syncChunk(a, b, chunk, stats, first=False, dry_run=False):
+    ''' Settle a chunk of mergeJoin() output. Entries only one side changed
+        are checked against the other side's current state first, so an
+        entry that already matches is not copied. On the first sync between
+        two sides every entry looks changed on both, so differences are not
+        counted as conflicts. '''
+    a_states = a.states(x[0] for x in chunk if x[1] is None)
+    b_states = b.states(x[0] for x in chunk if x[2] is None)
+
+    to_a, to_b = list(), list()
+    for entry_uuid, ours, theirs in chunk:
+        if ours and theirs:
+            if ours[1] == theirs[1]:
+                continue
+            if not first:
+                stats['conflicts'] += 1
+                CONFLICTS.inc()
+            change = winner(ours, theirs)
+        else:
+            change = ours or theirs
+            other = b_states.get(entry_uuid) if ours else a_states.get(entry_uuid)
+            if (other[1] if other else None) == change[1]:
+                continue
+        (to_b if change is ours else to_a).append(change)
+
+    if not dry_run:
+        transfer(b, a, to_a, stats, 'a')
+        transfer(a, b, to_b, stats, 'b')
+    else:
+        for changes, name in ((to_a, 'a'), (to_b, 'b')):
+            stats['copied to ' + name] += sum(1 for x in changes if x[1] is not None)
+            stats['deleted from ' + name] += sum(1 for x in changes if x[1] is None)
+
+
+def sync(a, b, chunksize=1000, dry_run=False):
+    ''' Bring peers a and b level with each other, and return how many
+        entries were copied and deleted each way and how many conflicts
+        were settled. With dry_run nothing is written. '''
+    stats = dict.fromkeys(('copied to a', 'deleted from a', 'copied to b',
+                           'deleted from b', 'conflicts'), 0)
+    with SYNC_SECONDS.time():
+        if a.identity() == b.identity():
+            b.newIdentity()
+
+        # Either side may have lost a sync the other remembers, as when a
+        # file is restored from a backup; starting further back only means
+        # comparing more entries.
+        a_since, b_seen = a.lastSync(b.identity())
+        b_since, a_seen = b.lastSync(a.identity())
+        a_since, b_since = min(a_since, a_seen), min(b_since, b_seen)
+
+        # Whatever is written from here on is logged after these, so the
+        # next sync compares it again, finds it level and moves on.
+        a_head, b_head = a.sequence(), b.sequence()
+
+        pairs = mergeJoin(a.changes(a_since, chunksize),
+                          b.changes(b_since, chunksize))
+        while True:
+            chunk = list(itertools.islice(pairs, chunksize))
+            if not chunk:
+                break
+            syncChunk(a, b, chunk, stats, not (a_since and b_since), dry_run)
+
+        if not dry_run:
+            when = datetime.datetime.now()
+            a.recordSync(b.identity(), a_head, b_head, when)
+            b.recordSync(a.identity(), b_head, a_head, when)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync two copies of a '
+                                                 'journal both ways.')
+    parser.add_argument('a', help='a journal, or a directory to sync through')
+    parser.add_argument('b', help='another journal or directory')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would change without changing it')
+    args = parser.parse_args()
+
+    a, b = openPeer(args.a), openPeer(args.b)
+    try:
+        stats = sync(a, b, dry_run=args.dry_run)
+    finally:
+        a.close()
+        b.close()
+    for name, count in stats.items():
+        print('{0}: {1}'.format(name.capitalize(), count), file=sys.stderr)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+
+SEPARATORS = re.compile(r'[,;]')
+SPACES = re.compile(r'\s+')
+
+def normalizeTag(name):
+    ''' The form a tag is stored in: lower case, single spaced, and without
+        a leading #, so "#Travel " and "travel" are the same tag. '''
+    return SPACES.sub(' ', name).strip().lstrip('#').strip().lower()
+
+def normalizeTags(names):
+    ''' names normalized, in order and without repeats or blanks. '''
+    tags = list()
+    for name in names:
+        tag = normalizeTag(name)
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+def parseTags(text):
+    ''' The tags in text, separated by commas or semicolons. '''
+    return normalizeTags(SEPARATORS.split(text))
+
+def formatTags(tags):
+    return ', '.join(tags)
+
+class TagIndex(object):
+    ''' An inverted index of entries by tag.
+
+        Each tag maps to the set of entries carrying it, so the entries with
+        all of several tags come from intersecting those sets, smallest
+        first, without looking at any entry lacking one of them. Entries are
+        indexed by identity and their tags are read when they are added and
+        removed, so an entry's tags must only change while it is out of the
+        index, as Journal.updateEntry() arranges. '''
+
+    def __init__(self, entries=()):
+        self.entries = dict()
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        for tag in entry.tags:
+            self.entries.setdefault(tag, set()).add(entry)
+
+    def discard(self, entry):
+        for tag in entry.tags:
+            tagged = self.entries.get(tag)
+            if tagged is not None:
+                tagged.discard(entry)
+                if not tagged:
+                    del self.entries[tag]
+
+    def clear(self):
+        self.entries.clear()
+
+    def counts(self):
+        ''' Each tag with how many entries carry it, by name. '''
+        return sorted((tag, len(x)) for tag, x in self.entries.items())
+
+    def find(self, tags):
+        ''' The set of entries carrying every one of tags. '''
+        sets = sorted((self.entries.get(x, set()) for x in set(tags)), key=len)
+        if not sets:
+            return set()
+        return sets[0].intersection(*sets[1:])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import journal  # storage needs journal imported first
+import logstorage
+from journal import Entry
+from logstorage import LogStorage
+
+
+class CompactionTest(unittest.TestCase):
+    '''Compacting a log keeps every live entry and the ids handed out.'''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'journal.mentlog')
+        self.storage = LogStorage()
+        self.storage.new(self.filename)
+
+    def tearDown(self):
+        logstorage.INDEXES.pop(os.path.realpath(self.filename), None)
+        self.directory.cleanup()
+
+    def save(self, *titles):
+        entries = list()
+        for i, title in enumerate(titles):
+            entry = Entry(date_published=datetime.date(2020, 1, i + 1),
+                          title=title,
+                          body='<p>{0}</p>'.format(title))
+            entries.append(entry)
+        self.storage.save(self.filename, entries, [])
+        return entries
+
+    def reopen(self):
+        # Forget the index, so the next call replays the file from the start.
+        logstorage.INDEXES.pop(os.path.realpath(self.filename), None)
+        return sorted(self.storage.load(self.filename), key=lambda x: x.entry_id)
+
+    def test_round_trip(self):
+        saved = self.save('one', 'two', 'three')
+        self.storage.compact(self.filename)
+
+        loaded = self.reopen()
+        self.assertEqual([x.entry_id for x in loaded], [x.entry_id for x in saved])
+        self.assertEqual([x.title for x in loaded], ['one', 'two', 'three'])
+        self.assertEqual([x.body for x in loaded], [x.body for x in saved])
+
+    def test_deleted_ids_stay_used(self):
+        saved = self.save('one', 'two', 'three')
+        self.storage.save(self.filename, [], [saved[-1]])
+        self.storage.compact(self.filename)
+        self.reopen()
+
+        added = self.save('four')
+        self.assertGreater(added[0].entry_id, saved[-1].entry_id)
+        self.assertEqual([x.title for x in self.reopen()], ['one', 'two', 'four'])
+
+
+class RecoveryTest(unittest.TestCase):
+    '''Only a write cut short at the end of a log is dropped.'''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'journal.mentlog')
+        self.storage = LogStorage()
+        self.storage.new(self.filename)
+
+    def tearDown(self):
+        logstorage.INDEXES.pop(os.path.realpath(self.filename), None)
+        self.directory.cleanup()
+
+    def save(self, *titles):
+        entries = [Entry(date_published=datetime.date(2020, 1, 1), title=x,
+                         body='<p>{0}</p>'.format(x))
+                   for x in titles]
+        self.storage.save(self.filename, entries, [])
+        return entries
+
+    def reopen(self):
+        logstorage.INDEXES.pop(os.path.realpath(self.filename), None)
+        return sorted(self.storage.load(self.filename), key=lambda x: x.entry_id)
+
+    def test_torn_tail(self):
+        self.save('one')
+        size = os.path.getsize(self.filename)
+        self.save('two')
+        with open(self.filename, 'r+b') as f:
+            f.truncate(os.path.getsize(self.filename) - 3)
+
+        self.assertEqual([x.title for x in self.reopen()], ['one'])
+        self.save('three')
+        self.assertEqual([x.title for x in self.reopen()], ['one', 'three'])
+        self.assertGreater(os.path.getsize(self.filename), size)
+
+    def test_bad_length(self):
+        self.save('one')
+        self.save('two')
+        with open(self.filename, 'r+b') as f:
+            # The top byte of the first record's length, so it seems to run
+            # past the end of the file.
+            f.seek(len(logstorage.MAGIC) + 3)
+            f.write(b'\x01')
+
+        with self.assertRaises(ValueError):
+            self.reopen()
+
+    def test_uuid(self):
+        saved = self.save('one')
+        self.assertTrue(saved[0].uuid)
+        self.assertEqual(self.reopen()[0].uuid, saved[0].uuid)
+
+    def test_version_1(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'MENTLOG\x01')
+        saved = self.save('one', 'two')
+        self.storage.compact(self.filename)
+
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(len(logstorage.MAGIC)), logstorage.MAGIC)
+        loaded = self.reopen()
+        self.assertEqual([x.title for x in loaded], ['one', 'two'])
+        self.assertEqual([x.uuid for x in loaded], [x.uuid for x in saved])
+
+
+if __name__ == '__main__':
+    unittest.main()
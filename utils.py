@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
+import contextlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
 def file_exists(filepath):
     ''' Check if a file exists and can be accessed. '''
     try:
@@ -10,3 +15,113 @@ def file_exists(filepath):
         return False
 
     return True
+
+def applyChunk(func, chunk):
+    return [func(x) for x in chunk]
+
+def mapChunks(func, chunks, processes=0):
+    ''' Yield (chunk, [func(x) for x in chunk]) for each of chunks, in order.
+        With processes, the work is spread over that many worker processes
+        with no more than two chunks per process in flight, so memory stays
+        bounded however many chunks there are. func must be picklable. '''
+    if not processes:
+        for chunk in chunks:
+            yield chunk, applyChunk(func, chunk)
+        return
+
+    with ProcessPoolExecutor(processes) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(applyChunk, func, chunk)))
+            if len(pending) >= processes * 2:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+class ReadWriteLock(object):
+    ''' A lock that admits many concurrent readers or a single writer.
+
+        Waiting writers take priority over new readers so that a steady stream
+        of reads cannot starve a save. Both sides are re-entrant for the
+        thread holding them, and the writer may also take the read side. A
+        writer that lets go of the write side first carries on as a reader. '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    def _read_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def _counted(self):
+        ''' Whether this thread's read hold is one of _readers. A writer's
+            is not, until it lets go of the write side. '''
+        return getattr(self._local, 'counted', False)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            depth = self._read_depth()
+            if not depth:
+                if self._writer != me:
+                    while self._writer is not None or self._writers_waiting:
+                        self._cond.wait()
+                    self._readers += 1
+                self._local.counted = self._writer != me
+            self._local.depth = depth + 1
+
+    def release_read(self):
+        with self._cond:
+            depth = self._read_depth() - 1
+            self._local.depth = depth
+            if not depth and self._counted():
+                self._local.counted = False
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if self._read_depth():
+                raise RuntimeError('cannot upgrade a read lock to a write lock')
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                if self._read_depth() and not self._counted():
+                    self._local.counted = True
+                    self._readers += 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()